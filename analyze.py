@@ -1,150 +1,251 @@
 #!/usr/bin/python
 
+from bin.params import ParameterHandler
+
+ph = ParameterHandler()
+
+if ph.server_mode == 'eventlet':
+    # Before anything else imports socket, threading or time: every viewer and
+    # every stream becomes a green thread instead of an OS thread, and database
+    # queries yield to them while they wait for Postgres
+    import eventlet
+    from eventlet import tpool
+    from psycogreen.eventlet import patch_psycopg
+
+    eventlet.monkey_patch()
+    patch_psycopg()
+
 import io
 import json
-import re
-import subprocess
+import os
+import signal
 import threading
 import time
 
-import psycopg2
-import psycopg2.extras
-from decorator import contextmanager
-from flask import Flask, Response, render_template, make_response, copy_current_request_context
+from flask import Flask, Response, g, render_template, make_response, jsonify, request
 from flask_socketio import SocketIO, emit
 from matplotlib.backends.backend_agg import FigureCanvasAgg
-from matplotlib.dates import DateFormatter, SecondLocator
+from matplotlib.dates import AutoDateLocator, DateFormatter, SecondLocator
 from matplotlib.figure import Figure
-from psycopg2 import pool
 
-from bin.params import ParameterHandler
+import metrics
+from broadcast import Broadcaster
+from latency import SKETCH_WINDOWS, WINDOWS, merged_stats, sketch_series, sliding_stats, trailing_stats
+from live import LiveSamples
+from metrics import Counter, Gauge, Histogram
+from netdev import RateSampler
+from render_cache import RenderCache
+from rollups import RESOLUTIONS, rollup_resolution
+from speedtests import SpeedtestManager, run_schedule, speedtest_runner
+from storage import open_storage
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
-socketio = SocketIO(app)
-ph = ParameterHandler()
+socketio = SocketIO(app, async_mode='eventlet' if ph.server_mode == 'eventlet' else 'threading')
+store = open_storage()
+# Graphs are drawn from minute rollups, so they can not change more often than once a minute
+graph_cache = RenderCache(ttl=60)
+# Latest samples pushed by the collectors, the live chart never queries the database for them
+live = LiveSamples(ph.live_port, ph.live_samples)
+
+REQUEST_SECONDS = Histogram('rpi_http_request_seconds', 'Time to the response, for event streams to the start of it',
+                            ['endpoint', 'status'])
+RENDER_SECONDS = Histogram('rpi_graph_render_seconds', 'Time matplotlib takes to draw a graph', ['graph'])
+STREAM_CLIENTS = Gauge('rpi_stream_clients', 'Clients of an event stream or Socket.IO namespace', ['stream'])
+STREAM_DROPS = Counter('rpi_stream_dropped_clients_total', 'Event stream clients dropped for falling behind',
+                       ['stream'])
+GRAPH_CACHE = Counter('rpi_graph_cache_requests_total', 'Graph requests by whether they were cached', ['result'])
+GRAPH_CACHE.track(lambda: graph_cache.hits, 'hit')
+GRAPH_CACHE.track(lambda: graph_cache.misses, 'miss')
+LIVE_RECEIVED = Counter('rpi_live_samples_received_total', 'Live samples received from the collectors')
+LIVE_RECEIVED.track(lambda: live.received)
+
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    if 'started' in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.started, request.endpoint or 'none', response.status_code)
+    return response
+
+
+@app.route('/metrics')
+def metrics_data():
+    return Response(metrics.exposition(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/db-pool')
+def db_pool_stats():
+    return jsonify(store.stats())
+
+
+def json_body(value):
+    return json.dumps(value).encode('utf-8')
 
 
-@contextmanager
-def get_conn():
-    db = pool.SimpleConnectionPool(1, 10, host='0.0.0.0',
-                                   database=ph.db_name,
-                                   user=ph.db_username,
-                                   password=ph.db_password)
-    con = db.getconn()
-    try:
-        yield con
-    finally:
-        db.putconn(con)
+# The day and the week merge up to 1440 or 168 rollup sketches per destination
+# and only change when a minute is rolled up, so they are taken once a minute
+# and not with every snapshot
+sketch_cache = RenderCache(ttl=60, serialize=json_body)
+
+
+def sketch_windows():
+    windows = {}
+    for seconds in SKETCH_WINDOWS:
+        sketches = store.destination_sketches(seconds // 3600, rollup_resolution(seconds // 3600))
+        windows[seconds] = {destination: merged_stats(rows) for destination, rows in sketches.items()}
+    return windows
+
+
+def latency_windows(destinations):
+    # Statistics of every window for every destination, from one query for the
+    # raw samples and the cached sketch windows
+    now = time.time()
+    samples = store.destination_samples(max(WINDOWS))
+    sketches = sketch_cache.get('sketch_windows', (), sketch_windows).value
+    latency = {}
+    for destination in destinations:
+        times, pingtimes = samples.get(destination, ([], []))
+        windows = trailing_stats(times, pingtimes, now)
+        for seconds in SKETCH_WINDOWS:
+            windows[seconds] = sketches[seconds].get(destination) or merged_stats([])
+        latency[destination] = [dict(windows[seconds], window=seconds) for seconds in WINDOWS + SKETCH_WINDOWS]
+    return latency
 
 
 @app.route('/stats')
 def index():
-    with get_conn() as conn:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    return render_template('index.html', destinations=dashboard_snapshot().value['destinations'])
 
-        destination_overview_query = """
-            SELECT
-              destination,
-              min(pingtime),
-              round(avg(pingtime), 2) AS avg,
-              max(pingtime)
-            FROM
-              pings
-            WHERE
-              recorded_at > now() - INTERVAL '1 hour'
-            GROUP BY
-              destination;
-        """
 
-        cur.execute(destination_overview_query)
+def publish_speedtest(job):
+    socketio.emit('progress', job, namespace='/speedtest')
 
-        destinations = cur.fetchall()
 
-    return render_template('index.html', destinations=destinations)
+# One speedtest at a time for every viewer and the schedule
+speedtests = SpeedtestManager(speedtest_runner(), store.save_speedtest, publish_speedtest)
 
 
 @socketio.on('start_test', namespace='/speedtest')
 def speedtest(message):
-    @copy_current_request_context
-    def speedtest_handler():
-        speedtest_cli = subprocess.Popen(['speedtest-cli --simple'],
-                                         shell=True,
-                                         stdout=subprocess.PIPE)
-        while speedtest_cli.poll() is None:
-            time.sleep(1)
-        emit('testing', {'data': speedtest_cli.stdout.read().decode('utf-8')})
-    t = threading.Thread(target=speedtest_handler)
-    t.start()
+    speedtests.start('viewer')
+
+
+@socketio.on('connect', namespace='/speedtest')
+def speedtest_connect():
+    # Viewers arriving during a test follow it from there
+    STREAM_CLIENTS.inc('/speedtest')
+    job = speedtests.current()
+    if job is not None:
+        emit('progress', job)
+
+
+@socketio.on('disconnect', namespace='/speedtest')
+def speedtest_disconnect():
+    STREAM_CLIENTS.dec('/speedtest')
+
+
+def link_idle():
+    # Samples older than a minute mean the collector is not publishing, go ahead then
+    traffic = live.latest_traffic(ph.outbound_interface)
+    return traffic is None or time.time() - traffic['time'] > 60 or \
+        traffic['download'] + traffic['upload'] < ph.speedtest_idle_mbps
+
+
+class TrafficFeed:
+    # One /proc/net/dev sampler for every client of the /traffic namespace. It is
+    # started by the first client and stops once the last one has disconnected.
+    def __init__(self, interface, interval=1.0):
+        self._interface = interface
+        self._interval = interval
+        self._clients = 0
+        self._running = False
+        self._lock = threading.Lock()
+
+    def connect(self):
+        with self._lock:
+            self._clients += 1
+            if self._running:
+                return
+            self._running = True
+        socketio.start_background_task(self._run)
+
+    def disconnect(self):
+        with self._lock:
+            self._clients = max(0, self._clients - 1)
+
+    def clients(self):
+        with self._lock:
+            return self._clients
+
+    def _run(self):
+        sampler = RateSampler(self._interface)
+        sampler.sample()
+        while True:
+            socketio.sleep(self._interval)
+            with self._lock:
+                if self._clients == 0:
+                    self._running = False
+                    return
+            rates = sampler.sample()
+            if rates is None:
+                continue
+            # Traffic coming in on the LAN side is what clients upload
+            curr_time = time.strftime('%H:%M:%S', time.localtime(rates.timestamp))
+            upload = ('%2.2f' % rates.rx_mbps) + 'Mbps'
+            download = ('%2.2f' % rates.tx_mbps) + 'Mbps'
+            parsed_output = curr_time + ' ' + download + ' ' + upload
+            socketio.emit('traffic', {'data': parsed_output}, namespace='/traffic')
+
+
+traffic_feed = TrafficFeed(ph.outbound_interface)
+STREAM_CLIENTS.track(traffic_feed.clients, '/traffic')
 
 
 @socketio.on('connect', namespace='/traffic')
 def traffic():
-    @copy_current_request_context
-    def traffic_handler():
-        traffic_cli = subprocess.Popen(['sudo ifstat -i ' + ph.outbound_interface + ' -t -b -w -n'],
-                                       shell=True,
-                                       stdout=subprocess.PIPE)
-
-        while traffic_cli.poll() is None:
-            output = traffic_cli.stdout.readline().decode('utf-8').strip()
-            if output is not None:
-                curr_time = download = upload = ''
-                match_output = re.search(r'(\d\d:\d\d:\d\d)\s*(\d+\.\d+)\s*(\d+\.\d+)',
-                                         ' '.join(output.split()))
-                if match_output is not None:
-                    curr_time = match_output.group(1)
-                    upload = ('%2.2f' % (float(match_output.group(2))/1000)) + 'Mbps'
-                    download = ('%2.2f' % (float(match_output.group(3))/1000)) + 'Mbps'
-
-                parsed_output = curr_time + ' ' + download + ' ' + upload
-                emit('traffic', {'data': parsed_output})
-            time.sleep(1)
-    t = threading.Thread(target=traffic_handler)
-    t.start()
+    traffic_feed.connect()
 
 
-@app.route('/graphs/<destination>', methods=['POST', 'GET'])
-def graph(destination):
-    with get_conn() as conn:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-
-        destination_history_query = """
-            WITH intervals AS (
-                SELECT
-                  begin_time,
-                  LEAD(begin_time)
-                  OVER (
-                    ORDER BY begin_time ) AS end_time
-                FROM
-                      generate_series(
-                          now() - INTERVAL '1 hours',
-                          now(),
-                          INTERVAL '1 minutes'
-                      ) begin_time
-            )
-            SELECT
-              i.begin_time AT TIME ZONE 'Europe/Berlin' AS begin_time,
-              i.end_time AT TIME ZONE 'Europe/Berlin' AS end_time,
-              p.destination,
-              count(p.pingtime),
-              round(avg(p.pingtime),2) AS avg,
-              max(p.pingtime),
-              min(p.pingtime)
-            FROM intervals i LEFT JOIN pings p
-            ON p.recorded_at >= i.begin_time AND
-              p.recorded_at < i.end_time
-            WHERE 
-              i.end_time IS NOT NULL
-              AND destination = %s
-            GROUP BY i.begin_time, i.end_time, p.destination
-            ORDER BY i.begin_time ASC;
-        """
-
-        cur.execute(destination_history_query, (destination,))
-
-        times = cur.fetchall()
+@socketio.on('disconnect', namespace='/traffic')
+def traffic_disconnect():
+    traffic_feed.disconnect()
+
+
+def history_hours():
+    # Graphs cover the last hour unless ?hours= asks for more, up to the rollup retention
+    return min(max(request.args.get('hours', 1, type=int), 1), 24 * 90)
+
+
+def format_time_axis(ax, hours):
+    ax.xaxis_date()
+    if hours == 1:
+        ax.xaxis.set_major_formatter(DateFormatter('%H:%M'))
+        ax.xaxis.set_major_locator(SecondLocator(interval=60))
+    else:
+        ax.xaxis.set_major_formatter(DateFormatter('%d.%m %H:%M'))
+        ax.xaxis.set_major_locator(AutoDateLocator())
+
+
+def offload(function, *args):
+    # matplotlib holds the CPU for a second or more, in a real thread it does
+    # not stall every green thread meanwhile
+    if ph.server_mode == 'eventlet':
+        return tpool.execute(function, *args)
+    return function(*args)
 
+
+def render_ping_graph(destination, hours):
+    times = store.ping_history(destination, hours, rollup_resolution(hours))
+    with RENDER_SECONDS.time('ping'):
+        return offload(draw_ping_graph, times, hours)
+
+
+def draw_ping_graph(times, hours):
     fig = Figure(figsize=(30, 8), dpi=80, facecolor='w', edgecolor='k', tight_layout=True)
     ax = fig.add_subplot(111)
 
@@ -178,10 +279,7 @@ def graph(destination):
     ax.set_ylabel('Round Trip (ms)')
     ax.set_ylim(bottom=0)
 
-    ax.xaxis_date()
-    my_fmt = DateFormatter('%H:%M')
-    ax.xaxis.set_major_formatter(my_fmt)
-    ax.xaxis.set_major_locator(SecondLocator(interval=60))
+    format_time_axis(ax, hours)
     ax.legend()
     ax.grid()
 
@@ -190,24 +288,16 @@ def graph(destination):
     fig.set_canvas(FigureCanvasAgg(fig))
     fig.savefig(png_output, transparent=True, format='png')
 
-    response = make_response(png_output.getvalue())
-    response.headers['content-type'] = 'image/png'
-    return response
-
+    return png_output.getvalue()
 
-@app.route('/graphs/traffic')
-def live_traffic():
-    with get_conn() as conn:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-        destination_history_query = """
-            SELECT * FROM traffic WHERE recorded_at >= now() - INTERVAL '10 minutes';
-        """
+def render_traffic_graph(hours):
+    times = store.traffic_history(ph.outbound_interface, hours, rollup_resolution(hours))
+    with RENDER_SECONDS.time('traffic'):
+        return offload(draw_traffic_graph, times, hours)
 
-        cur.execute(destination_history_query)
-
-        times = cur.fetchall()
 
+def draw_traffic_graph(times, hours):
     fig = Figure(figsize=(30, 8), dpi=80, facecolor='w', edgecolor='k', tight_layout=True)
     ax = fig.add_subplot(111)
 
@@ -230,13 +320,10 @@ def live_traffic():
     )
 
     ax.set_xlabel('Time')
-    ax.set_ylabel('Bandwidth')
+    ax.set_ylabel('Bandwidth (Mbps)')
     ax.set_ylim(bottom=0)
 
-    ax.xaxis_date()
-    my_fmt = DateFormatter('%H:%M')
-    ax.xaxis.set_major_formatter(my_fmt)
-    ax.xaxis.set_major_locator(SecondLocator(interval=60))
+    format_time_axis(ax, hours)
     ax.legend()
     ax.grid()
 
@@ -245,97 +332,256 @@ def live_traffic():
     fig.set_canvas(FigureCanvasAgg(fig))
     fig.savefig(png_output, transparent=True, format='png')
 
-    response = make_response(png_output.getvalue())
-    response.headers['content-type'] = 'image/png'
-    return response
+    return png_output.getvalue()
+
+
+def cached_response(rendered, content_type='image/png'):
+    response = make_response(rendered.body)
+    response.headers['content-type'] = content_type
+    response.set_etag(rendered.etag)
+    response.last_modified = rendered.last_modified
+    response.cache_control.max_age = max(0, int(rendered.expires - time.time()))
+    return response.make_conditional(request)
+
+
+@app.route('/graphs/<destination>', methods=['POST', 'GET'])
+def graph(destination):
+    hours = history_hours()
+    return cached_response(graph_cache.get('graph', (destination, hours),
+                                           lambda: render_ping_graph(destination, hours)))
+
+
+@app.route('/graphs/traffic')
+def live_traffic():
+    hours = history_hours()
+    return cached_response(graph_cache.get('traffic', (hours,), lambda: render_traffic_graph(hours)))
+
+
+def history_resolution(hours):
+    resolution = request.args.get('resolution')
+    return resolution if resolution in RESOLUTIONS else rollup_resolution(hours)
+
+
+def columns(rows, names):
+    return {name: [float(row[name]) if row[name] is not None else None for row in rows] for name in names}
+
+
+# JSON counterparts of the graphs, one array per series. Clients that already
+# have data pass ?since=<epoch seconds of their last point> and only get the
+# buckets from there on, the last one again since it may have grown meanwhile.
+@app.route('/api/history/<destination>')
+def history_data(destination):
+    hours = history_hours()
+    resolution = history_resolution(hours)
+    rows = store.ping_history(destination, hours, resolution, request.args.get('since', type=float))
+    data = columns(rows, ['time', 'min', 'avg', 'max', 'count', 'lost'])
+    data.update(destination=destination, resolution=resolution)
+    return jsonify(data)
+
+
+@app.route('/api/traffic')
+def traffic_data():
+    hours = history_hours()
+    resolution = history_resolution(hours)
+    rows = store.traffic_history(ph.outbound_interface, hours, resolution, request.args.get('since', type=float))
+    data = columns(rows, ['time', 'upload', 'download', 'upload_max', 'download_max'])
+    data.update(interface=ph.outbound_interface, resolution=resolution)
+    return jsonify(data)
+
+
+# Percentiles, jitter and loss from the raw samples, which are only kept for
+# RETENTION_HOURS: the trailing windows of the stats page and a ?window= seconds
+# long window sliding over the last ?hours= in ?step= seconds
+@app.route('/api/stats/<destination>')
+def latency_data(destination):
+    hours = min(history_hours(), ph.retention_hours)
+    window = min(max(request.args.get('window', 300, type=int), 10), hours * 3600)
+    step = min(max(request.args.get('step', 60, type=int), 10), window)
+    now = time.time()
+    times, pingtimes = store.ping_samples(destination, hours * 3600)
+    return jsonify({'destination': destination,
+                    'windows': {str(seconds): stats
+                                for seconds, stats in trailing_stats(times, pingtimes, now).items()},
+                    'series': dict(sliding_stats(times, pingtimes, window, step, now - hours * 3600, now),
+                                   window=window, step=step)})
+
+
+# Percentiles per rollup bucket and of the whole ?hours= window, merged from the
+# bucket sketches, so they cover the whole rollup retention
+@app.route('/api/percentiles/<destination>')
+def percentile_data(destination):
+    hours = history_hours()
+    resolution = history_resolution(hours)
+    rows = store.ping_sketches(destination, hours, resolution)
+    return jsonify({'destination': destination,
+                    'resolution': resolution,
+                    'window': merged_stats(rows),
+                    'series': sketch_series(rows)})
 
 
 @app.route('/packetloss/<destination>')
 def packetloss(destination):
-    with get_conn() as conn:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-
-        destination_history_query = """
-        WITH intervals AS (
-                SELECT
-                  begin_time,
-                  LEAD(begin_time)
-                  OVER ( ORDER BY begin_time ) AS end_time
-                  FROM generate_series(
-                          now() - INTERVAL '1 hours',
-                          now(),
-                          INTERVAL '1 minutes'
-                      ) begin_time
-            )
-            SELECT
-              i.begin_time AT TIME ZONE 'Europe/Zagreb' AS begin_time,
-              i.end_time AT TIME ZONE 'Europe/Zagreb' AS end_time,
-              p.destination,
-              count(*),
-              round(avg(p.pingtime),2) AS avg,
-              max(p.pingtime),
-              min(p.pingtime)
-            FROM intervals i LEFT JOIN pings p
-            ON p.recorded_at >= i.begin_time AND
-              p.recorded_at < i.end_time
-            WHERE 
-              i.end_time IS NOT NULL
-              AND destination = 'www.amazon.de'
-              AND p.pingtime IS NULL
-            GROUP BY i.begin_time, i.end_time, p.destination
-            ORDER BY i.begin_time ASC;
-        """
-
-        cur.execute(destination_history_query, (destination,))
-
-        times = cur.fetchall()
-
-    packets_lost = sum([row['count'] for row in times])
-    if packets_lost is None:
-        packets_lost = 0.0
-    packets_lost_total = '%3.3f' % (packets_lost/(60.0 * 60.0)) + '% (' + str(packets_lost) + '/3600)'
+    loss = store.packet_loss(destination)
+
+    packets_lost = loss['lost']
+    packets_sent = loss['count']
+    loss_percent = 100.0 * packets_lost / packets_sent if packets_sent else 0.0
+    packets_lost_total = '%3.3f' % loss_percent + '% (' + str(packets_lost) + '/' + str(packets_sent) + ')'
 
     return packets_lost_total
 
 
+# The whole page in one response: every destination's last hour in minute buckets
+# with its min, avg, max and loss, its latency windows, and the traffic of the
+# LAN interface. Viewers share one snapshot, taken at most once per SNAPSHOT_TTL
+# seconds and serialized once for /api/snapshot.
+SNAPSHOT_HOURS = 1
+SNAPSHOT_TTL = 10
+snapshot_cache = RenderCache(ttl=SNAPSHOT_TTL, refresh_delay=0, serialize=json_body)
+
+
+def destination_snapshot(destination, rows, latency):
+    # count of the rollup rows are the replies, loss is relative to the pings sent
+    replies = sum(row['count'] for row in rows)
+    lost = sum(row['lost'] for row in rows)
+    lows = [float(row['min']) for row in rows if row['min'] is not None]
+    highs = [float(row['max']) for row in rows if row['max'] is not None]
+    total = sum(float(row['avg']) * row['count'] for row in rows if row['avg'] is not None)
+    return {'destination': destination,
+            'min': min(lows) if lows else None,
+            'avg': round(total / replies, 2) if replies else None,
+            'max': max(highs) if highs else None,
+            'lost': lost,
+            'sent': replies + lost,
+            'loss_percent': round(100.0 * lost / (replies + lost), 3) if replies + lost else 0.0,
+            'series': columns(rows, ['time', 'min', 'avg', 'max', 'count', 'lost']),
+            'latency': latency}
+
+
+def take_snapshot():
+    rows = {}
+    for row in store.ping_snapshot(SNAPSHOT_HOURS):
+        rows.setdefault(row['destination'], []).append(row)
+    latency = latency_windows(sorted(rows))
+    traffic = store.traffic_history(ph.outbound_interface, SNAPSHOT_HOURS, 'minute')
+    snapshot = {'time': time.time(),
+                'hours': SNAPSHOT_HOURS,
+                'resolution': 'minute',
+                'destinations': [destination_snapshot(destination, rows[destination], latency[destination])
+                                 for destination in sorted(rows)],
+                'traffic': dict(columns(traffic, ['time', 'upload', 'download', 'upload_max', 'download_max']),
+                                interface=ph.outbound_interface)}
+    return snapshot
+
+
+def dashboard_snapshot():
+    return snapshot_cache.get('snapshot', (), take_snapshot)
+
+
+@app.route('/api/snapshot')
+def snapshot_data():
+    return cached_response(dashboard_snapshot(), 'application/json')
+
+
+def chart_point(timestamp, ping, download, upload):
+    return {'time': time.strftime('%H:%M:%S', time.localtime(timestamp)),
+            'ping': float(ping) if ping is not None else None,
+            'download': float(download),
+            'upload': float(upload)}
+
+
+def latest_sample():
+    ping = live.latest_ping()
+    traffic = live.latest_traffic(ph.outbound_interface)
+    if ping is not None and traffic is not None:
+        point = chart_point(ping['time'], ping['pingtime'], traffic['download'], traffic['upload'])
+    else:
+        # Collectors that do not publish yet, or a server that can not receive
+        ping = store.latest_ping()
+        traffic = store.latest_traffic(ph.outbound_interface)
+        if ping is None or traffic is None:
+            return None
+        point = chart_point(float(ping['time']), ping['pingtime'], traffic['download'], traffic['upload'])
+    json_data = json.dumps(point)
+    return f"data:{json_data}\n\n"
+
+
+def live_count():
+    return min(max(request.args.get('n', 1, type=int), 1), ph.live_samples)
+
+
+# The last ?n= points of the live chart, so a freshly loaded page starts full
+@app.route('/api/live')
+def live_chart_data():
+    points = live.chart_points(ph.outbound_interface, live_count())
+    return jsonify({'points': [chart_point(point['time'], point['ping'], point['download'], point['upload'])
+                               for point in points]})
+
+
+# The latest ?n= samples of a single destination or interface as received
+@app.route('/api/live/pings/<destination>')
+def live_ping_data(destination):
+    data = live.last('pings', destination, live_count())
+    data.update(destination=destination)
+    return jsonify(data)
+
+
+@app.route('/api/live/traffic')
+def live_traffic_data():
+    data = live.last('traffic', ph.outbound_interface, live_count())
+    data.update(interface=ph.outbound_interface)
+    return jsonify(data)
+
+
+# Stored speedtests of the last ?hours=, POST starts one or joins the running one
+@app.route('/api/speedtests', methods=['GET', 'POST'])
+def speedtest_data():
+    if request.method == 'POST':
+        job, started = speedtests.start('api')
+        return jsonify(job), 202 if started else 200
+    rows = store.speedtests(history_hours())
+    data = columns(rows, ['time', 'duration', 'ping', 'download', 'upload'])
+    data.update(reason=[row['reason'] for row in rows], error=[row['error'] for row in rows],
+                running=speedtests.current())
+    return jsonify(data)
+
+
+# Every /chart-data client is fed from the same sample, taken once per second
+chart_feed = Broadcaster(latest_sample, interval=1.0)
+STREAM_CLIENTS.track(chart_feed.subscriber_count, '/chart-data')
+STREAM_DROPS.track(lambda: chart_feed.dropped, '/chart-data')
+
+
 @app.route('/chart-data')
 def chart_data():
-    def generate_random_data():
-        get_last_traffic = """
-        SELECT
-            recorded_at,
-            download,
-            upload
-        FROM traffic
-        ORDER BY recorded_at DESC
-        LIMIT 1
-        """
-        get_last_ping = """
-        SELECT
-            recorded_at::timestamp with time zone AT TIME ZONE 'Europe/Zagreb',
-            pingtime
-        FROM pings
-        ORDER BY recorded_at DESC
-        LIMIT 1
-        """
-        while True:
-            with get_conn() as conn:
-                cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-                cur.execute(get_last_traffic)
-                traffics = cur.fetchall()
-                cur.execute(get_last_ping)
-                pings = cur.fetchall()
-            timestamp = pings[0][0]
-            ping = float(pings[0][1])
-            download = float(traffics[0][1])
-            upload = float(traffics[0][2])
-            json_data = json.dumps(
-                {'time': timestamp.strftime('%H:%M:%S'), 'ping': ping, 'download': download, 'upload': upload})
-            yield f"data:{json_data}\n\n"
-            time.sleep(1)
-
-    return Response(generate_random_data(), mimetype='text/event-stream')
+    return Response(chart_feed.stream(), mimetype='text/event-stream')
+
+
+def shutdown(signum, frame):
+    # Ends the event streams, the server stops accepting and waits for the
+    # requests in flight, Socket.IO connections get SERVER_SHUTDOWN_TIMEOUT seconds.
+    # Signals arrive in the eventlet hub, nothing here may block.
+    chart_feed.close()
+    eventlet.spawn_after(ph.server_shutdown_timeout, os._exit, 0)
+    raise SystemExit(0)
+
+
+def serve():
+    # SERVER_CONNECTIONS green threads serve the clients, SERVER_THREADS real
+    # ones draw the graphs
+    tpool.set_num_threads(ph.server_threads)
+    signal.signal(signal.SIGTERM, shutdown)
+    # eventlet.wsgi holds streamed output back until 4 KiB have piled up, the
+    # events of /chart-data have to go out one by one. Other responses are a
+    # single chunk anyway.
+    socketio.run(app, host='0.0.0.0', port=ph.server_port, max_size=ph.server_connections, minimum_chunk_size=0,
+                 log_output=False)
 
 
 if __name__ == '__main__':
-    app.run(port=80, host='0.0.0.0', debug=True, threaded=True)
+    if ph.speedtest_schedule:
+        socketio.start_background_task(run_schedule, speedtests, ph.speedtest_schedule, link_idle)
+    if ph.server_mode == 'eventlet':
+        serve()
+    else:
+        app.run(port=ph.server_port, host='0.0.0.0', debug=True, threaded=True)
@@ -0,0 +1,242 @@
+#!/usr/bin/python
+
+import asyncio
+import logging
+import math
+import signal
+import sys
+import time
+from collections import deque, namedtuple
+
+from bin.params import ParameterHandler
+from netdev import RateSampler
+from probes import Prober
+from shaping import Shaper, format_rate, parse_rate, shaping_settings
+from storage import open_storage
+
+# Usage: autorate.py [--dry-run]
+#        autorate.py --replay [hours]
+# Adjusts the HFSC rates of shaping.py to the link, the way cake-autorate does
+# for cake: while a direction is loaded and the round trip to the reflectors
+# stays near its baseline the rate goes up, as soon as the delay grows
+# (bufferbloat) it drops below the throughput actually achieved, and without
+# load it drifts back to the base rate. Throughput is read from /proc/net/dev of
+# the WAN (Wi-Fi) interface, delay is measured by ICMP probes to the TARGETS of
+# config.json.
+#
+# --dry-run measures and logs the rates without changing them, --replay runs the
+# controller over the pings and traffic recorded in the last hours and prints
+# its decisions as CSV.
+Reflector = namedtuple('Reflector', ['name', 'protocol', 'host', 'port', 'url', 'size', 'timeout'])
+
+# Load is the achieved throughput relative to the current rate
+HIGH_LOAD = 0.75
+# Below this load a direction is considered idle, bufferbloat is not its fault
+BUFFERBLOAT_MIN_LOAD = 0.5
+ADJUST_UP_LOAD_HIGH = 1.05
+ADJUST_DOWN_BUFFERBLOAT = 0.9
+ADJUST_DOWN_LOAD_LOW = 0.99
+ADJUST_UP_LOAD_LOW = 1.01
+# No increase for this long after a decrease, and no second decrease either
+BUFFERBLOAT_REFRACTORY = 2.0
+# The baseline follows lower round trips quickly and higher ones very slowly
+BASELINE_ALPHA_INCREASE = 0.001
+BASELINE_ALPHA_DECREASE = 0.9
+# Rates are only changed when they move by more than this much
+MIN_CHANGE = 0.01
+
+log = logging.getLogger(__name__)
+ph = ParameterHandler()
+
+
+class Direction:
+    def __init__(self, name, minimum, base, maximum):
+        self.name = name
+        self.minimum = minimum
+        self.base = base
+        self.maximum = maximum
+        self.rate = base
+        self._decreased_at = -BUFFERBLOAT_REFRACTORY
+
+    def adjust(self, achieved, bufferbloat, now):
+        load = achieved / self.rate
+        refractory = now - self._decreased_at < BUFFERBLOAT_REFRACTORY
+        if bufferbloat and load >= BUFFERBLOAT_MIN_LOAD:
+            if not refractory:
+                self.rate = min(self.rate, achieved) * ADJUST_DOWN_BUFFERBLOAT
+                self._decreased_at = now
+        elif load >= HIGH_LOAD:
+            if not refractory:
+                self.rate *= ADJUST_UP_LOAD_HIGH
+        elif self.rate > self.base:
+            self.rate = max(self.base, self.rate * ADJUST_DOWN_LOAD_LOW)
+        elif self.rate < self.base:
+            self.rate = min(self.base, self.rate * ADJUST_UP_LOAD_LOW)
+        self.rate = min(max(self.rate, self.minimum), self.maximum)
+        return self.rate
+
+
+class Autorate:
+    def __init__(self, settings):
+        self.delay_threshold = settings['delay_threshold_ms']
+        self.download = Direction('download', *[parse_rate(settings['download'][limit])
+                                                for limit in ('min', 'base', 'max')])
+        self.upload = Direction('upload', *[parse_rate(settings['upload'][limit])
+                                            for limit in ('min', 'base', 'max')])
+        self.detection_threshold = settings['detection_threshold']
+        self._baselines = {}
+        # Whether each of the latest round trips was delayed, over all reflectors
+        self._delayed = deque(maxlen=settings['detection_window'])
+
+    def observe(self, reflector, rtt):
+        # Lost probes say nothing about queueing, they are left out
+        if rtt is None:
+            return
+        baseline = self._baselines.get(reflector, rtt)
+        alpha = BASELINE_ALPHA_INCREASE if rtt > baseline else BASELINE_ALPHA_DECREASE
+        baseline += alpha * (rtt - baseline)
+        self._baselines[reflector] = baseline
+        self._delayed.append(rtt - baseline > self.delay_threshold)
+
+    def bufferbloat(self):
+        return sum(self._delayed) >= self.detection_threshold
+
+    def update(self, now, download_mbps, upload_mbps):
+        bufferbloat = self.bufferbloat()
+        self.download.adjust(download_mbps, bufferbloat, now)
+        self.upload.adjust(upload_mbps, bufferbloat, now)
+        return bufferbloat
+
+
+def autorate_settings():
+    # Defaults follow setup_hfsc_shape.sh: 90% of the line rate, never above the
+    # ingress policer at 97% for download
+    max_download, max_upload = parse_rate(ph.max_download), parse_rate(ph.max_upload)
+    settings = {'interval': 1.0,
+                'reflector_interval': 0.5,
+                'delay_threshold_ms': 15,
+                'detection_window': 6,
+                'detection_threshold': 3,
+                'download': {'min': format_rate(max_download * 0.25),
+                             'base': format_rate(max_download * 0.9),
+                             'max': format_rate(max_download * 0.97)},
+                'upload': {'min': format_rate(max_upload * 0.25),
+                           'base': format_rate(max_upload * 0.9),
+                           'max': format_rate(max_upload)}}
+    for key, value in ph.autorate.items():
+        if isinstance(value, dict):
+            settings[key] = dict(settings[key], **value)
+        else:
+            settings[key] = value
+    return settings
+
+
+def reflectors(settings):
+    return [Reflector(name=target['host'], protocol='icmp', host=target['host'], port=None, url=None,
+                      size=int(target.get('size', 56)), timeout=settings['reflector_interval'])
+            for target in ph.targets if target.get('protocol', 'icmp') == 'icmp']
+
+
+async def reflect(prober, reflector, controller, interval):
+    loop = asyncio.get_event_loop()
+    next_probe = loop.time()
+    while True:
+        result = await prober.probe(reflector)
+        controller.observe(reflector.name, result.rtt)
+        next_probe += interval
+        await asyncio.sleep(max(0.0, next_probe - loop.time()))
+
+
+async def control(controller, shaper, interval, dry_run):
+    loop = asyncio.get_event_loop()
+    # Received on the Wi-Fi side is download, sent is upload
+    sampler = RateSampler(ph.inboud_interface)
+    sampler.sample()
+    applied = (None, None)
+    next_tick = loop.time()
+    while True:
+        next_tick += interval
+        await asyncio.sleep(max(0.0, next_tick - loop.time()))
+        rates = sampler.sample()
+        if rates is None:
+            continue
+        bufferbloat = controller.update(time.monotonic(), rates.rx_mbps, rates.tx_mbps)
+        download, upload = controller.download.rate, controller.upload.rate
+        if applied[0] is not None and abs(download - applied[0]) <= applied[0] * MIN_CHANGE \
+                and abs(upload - applied[1]) <= applied[1] * MIN_CHANGE:
+            continue
+        status = 'download {:.2f}/{:.2f} upload {:.2f}/{:.2f} Mbit/s{}'.format(
+            rates.rx_mbps, download, rates.tx_mbps, upload, ' bufferbloat' if bufferbloat else '')
+        if dry_run:
+            print(time.strftime('%H:%M:%S'), status)
+        else:
+            log.info(status)
+            # A failed batch is retried on the next tick
+            if not shaper.apply(download, upload):
+                continue
+        applied = (download, upload)
+
+
+async def run(settings, dry_run):
+    loop = asyncio.get_event_loop()
+    controller = Autorate(settings)
+    prober = Prober(loop)
+    shaper = Shaper(shaping_settings())
+    tasks = [asyncio.ensure_future(reflect(prober, reflector, controller, settings['reflector_interval']))
+             for reflector in reflectors(settings)]
+    tasks.append(asyncio.ensure_future(control(controller, shaper, settings['interval'], dry_run)))
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: [task.cancel() for task in tasks])
+    try:
+        # A failing reflector or controller takes the service down, so systemd
+        # restarts it and the error ends up in the journal
+        await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        # SIGINT or SIGTERM
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+        prober.close()
+
+
+def replay(settings, hours):
+    # Feeds the recorded samples through the controller in time order. Pings
+    # were recorded once a second and not every reflector interval, so the
+    # controller reacts more slowly than it would live.
+    store = open_storage()
+    controller = Autorate(settings)
+    pings = []
+    for reflector in reflectors(settings):
+        times, pingtimes = store.ping_samples(reflector.name, hours * 3600)
+        pings.extend((float(t), reflector.name, None if p is None or math.isnan(p) else float(p))
+                     for t, p in zip(times, pingtimes))
+    pings.sort()
+    times, uploads, downloads = store.traffic_samples(ph.inboud_interface, hours * 3600)
+
+    print('time,download,upload,download_rate,upload_rate,bufferbloat')
+    next_ping = 0
+    for now, upload, download in zip(times, uploads, downloads):
+        while next_ping < len(pings) and pings[next_ping][0] <= now:
+            controller.observe(pings[next_ping][1], pings[next_ping][2])
+            next_ping += 1
+        bufferbloat = controller.update(float(now), float(download), float(upload))
+        print('{:.1f},{:.2f},{:.2f},{:.2f},{:.2f},{}'.format(now, download, upload, controller.download.rate,
+                                                             controller.upload.rate, int(bufferbloat)))
+
+
+def main(arguments):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    settings = autorate_settings()
+    if arguments and arguments[0] == '--replay':
+        replay(settings, float(arguments[1]) if len(arguments) > 1 else 1.0)
+        return
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(run(settings, '--dry-run' in arguments))
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
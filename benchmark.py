@@ -0,0 +1,500 @@
+#!/usr/bin/python
+
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from pathlib import Path
+
+from bin.params import ParameterHandler
+
+# Usage: benchmark.py [options]       (benchmark.py --help lists them)
+#        benchmark.py --compare before.json after.json
+# Reproducible load test of the dashboard and the collectors. It fills storage of
+# its own with synthetic pings and traffic, starts analyze.py on it, measures
+# latency and throughput of the dashboard endpoints under concurrent clients and
+# the ingest rate of the collector write path, and prints everything as JSON.
+# --compare puts two such results side by side.
+#
+# The benchmark runs on a config of its own (see RPI_CONFIG in bin/params.py), the
+# storage and the web server of the dashboard are never touched. The postgres
+# backend needs a database for it, owned by DB_USERNAME:
+#
+#     CREATE DATABASE pi_benchmark WITH OWNER pi;
+#
+# Its tables are dropped and created again from bin/sql on every run. The
+# ringfile backend runs in a temporary directory.
+SyntheticPing = namedtuple('SyntheticPing', ['recorded_at', 'destination', 'ping_time', 'ttl', 'bytes'])
+SyntheticTraffic = namedtuple('SyntheticTraffic', ['timestamp', 'interface', 'upload', 'download',
+                                                   'upload_pps', 'download_pps', 'errors', 'drops'])
+
+SCHEMAS = ('create_pings.sql', 'create_traffic.sql', 'create_rollups.sql', 'create_speedtests.sql')
+TABLES = ('pings', 'traffic', 'pings_minute', 'pings_hour', 'traffic_minute', 'traffic_hour', 'speedtests')
+ENDPOINTS = ('/stats', '/api/snapshot', '/graphs/{destination}', '/packetloss/{destination}', '/graphs/traffic')
+STREAMS = ('/chart-data',)
+SERVER_START_TIMEOUT = 60
+STREAM_TIMEOUT = 10
+# Congestion comes and goes with this period, round trips grow up to BLOAT times
+BLOAT_PERIOD = 600
+BLOAT = 4
+PACKET_SIZE = 1000
+
+ph = ParameterHandler()
+
+
+def synthetic_pings(random_source, destinations, start, end, rate, loss):
+    # Round trips around a baseline per destination with log-normal jitter and
+    # recurring bufferbloat, probes lost at random
+    baselines = {destination: 10.0 + 10.0 * index for index, destination in enumerate(destinations)}
+    step = 1.0 / rate
+    now = start
+    while now < end:
+        recorded_at = datetime.fromtimestamp(now, timezone.utc)
+        bloat = 1 + BLOAT * max(0.0, math.sin(2 * math.pi * now / BLOAT_PERIOD)) ** 8
+        for destination in destinations:
+            if random_source.random() < loss:
+                yield SyntheticPing(recorded_at, destination, None, None, None)
+            else:
+                ping_time = round(baselines[destination] * bloat * random_source.lognormvariate(0, 0.15), 3)
+                yield SyntheticPing(recorded_at, destination, ping_time, 57, 64)
+        now += step
+
+
+def synthetic_traffic(random_source, interfaces, start, end, rate, peak_mbps):
+    # Busy evenings, quiet nights, upload a fifth of download
+    step = 1.0 / rate
+    now = start
+    while now < end:
+        timestamp = datetime.fromtimestamp(now)
+        hour = timestamp.hour + timestamp.minute / 60
+        level = 0.55 + 0.45 * math.sin(2 * math.pi * (hour - 14) / 24)
+        for interface in interfaces:
+            download = round(peak_mbps * level * random_source.lognormvariate(0, 0.5) / 2, 2)
+            upload = round(download * 0.2 * random_source.lognormvariate(0, 0.3), 2)
+            yield SyntheticTraffic(timestamp, interface, upload, download,
+                                   round(upload * 1e6 / 8 / PACKET_SIZE, 1), round(download * 1e6 / 8 / PACKET_SIZE, 1),
+                                   0, int(random_source.random() < 0.001))
+        now += step
+
+
+def summary(values, scale=1000.0):
+    # Nearest rank percentiles, in milliseconds unless scaled otherwise
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def percentile(fraction):
+        return round(ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))] * scale, 3)
+
+    return OrderedDict([('min', round(ordered[0] * scale, 3)),
+                        ('mean', round(sum(ordered) / len(ordered) * scale, 3)),
+                        ('p50', percentile(0.5)), ('p90', percentile(0.9)), ('p99', percentile(0.99)),
+                        ('max', round(ordered[-1] * scale, 3))])
+
+
+def benchmark_config(args, directory):
+    # The config of the dashboard with storage, ports and schedules of the benchmark
+    source = os.environ.get('RPI_CONFIG', os.path.join(ph.project_path, 'bin', 'config.json'))
+    config = json.loads(Path(source).read_text(), object_pairs_hook=OrderedDict)
+    config.update(STORAGE_BACKEND=args.backend,
+                  DB_NAME=args.database,
+                  RING_STORE_PATH=os.path.join(directory, 'rings'),
+                  RING_CAPACITY=max(int(args.hours * 3600 * max(args.ping_rate, args.traffic_rate)), 3600),
+                  RETENTION_HOURS=args.retention,
+                  SERVER_PORT=args.port,
+                  # Samples of collectors that are running must not end up in the benchmark
+                  LIVE_PORT=args.port + 1,
+                  SPEEDTEST_SCHEDULE=[],
+                  PING_METRICS_PORT=0,
+                  TRAFFIC_METRICS_PORT=0)
+    path = os.path.join(directory, 'config.json')
+    Path(path).write_text(json.dumps(config, indent=2))
+    return path
+
+
+def prepare_postgres(database, retention_hours):
+    # Fresh tables from bin/sql with the hourly partitions bin/partitions.py would
+    # keep, samples older than those end up in the default partitions
+    import psycopg2
+    import db
+
+    try:
+        conn = db.connect()
+    except psycopg2.OperationalError as err:
+        sys.exit('{}The benchmark needs a database of its own: CREATE DATABASE {} WITH OWNER {};'
+                 .format(err, database, ph.db_username))
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS {} CASCADE;'.format(', '.join(TABLES)))
+        for schema in SCHEMAS:
+            cursor.execute(Path(ph.project_path, 'bin', 'sql', schema).read_text())
+        for table, now in (('pings', datetime.now(timezone.utc)), ('traffic', datetime.now())):
+            current_hour = now.replace(minute=0, second=0, microsecond=0)
+            for offset in range(-retention_hours, 2):
+                hour = current_hour + timedelta(hours=offset)
+                cursor.execute('CREATE TABLE {table}_p{hour} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s);'
+                               .format(table=table, hour=hour.strftime('%Y%m%d%H')),
+                               (hour.isoformat(), (hour + timedelta(hours=1)).isoformat()))
+    conn.close()
+
+
+def finish_postgres():
+    # Retention the way bin/partitions.py does it: whatever is older than the
+    # hourly partitions is gone, rollups stay
+    import db
+
+    conn = db.connect()
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute('TRUNCATE pings_default, traffic_default;')
+        cursor.execute('VACUUM ANALYZE;')
+    conn.close()
+
+
+def write_all(writer, entries):
+    started = time.perf_counter()
+    rows = 0
+    for entry in entries:
+        writer.add(entry, block=True)
+        rows += 1
+    writer.close()
+    seconds = time.perf_counter() - started
+    return OrderedDict([('rows', rows), ('seconds', round(seconds, 3)), ('rows_per_second', round(rows / seconds, 1))])
+
+
+def fill(args, destinations, interfaces):
+    # Through the writers of the collectors, so the rollups are built like in production
+    from storage import open_storage
+
+    random_source = random.Random(args.seed)
+    end = time.time()
+    start = end - args.hours * 3600
+    if args.backend == 'postgres':
+        prepare_postgres(args.database, args.retention)
+    result = OrderedDict()
+    result['pings'] = write_all(open_storage().ping_writer(),
+                                synthetic_pings(random_source, destinations, start, end, args.ping_rate, args.loss))
+    result['traffic'] = write_all(open_storage().traffic_writer(),
+                                  synthetic_traffic(random_source, interfaces, start, end, args.traffic_rate,
+                                                    args.peak_mbps))
+    if args.backend == 'postgres':
+        finish_postgres()
+    return result
+
+
+def start_server(config_path, port, log_path):
+    with open(log_path, 'w') as log_file:
+        server = subprocess.Popen([sys.executable, 'analyze.py'], cwd=ph.project_path, stdout=log_file,
+                                  stderr=subprocess.STDOUT, env=dict(os.environ, RPI_CONFIG=config_path),
+                                  start_new_session=True)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline and server.poll() is None:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            connection.request('GET', '/metrics')
+            if connection.getresponse().status == 200:
+                connection.close()
+                return server
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.5)
+    stop_server(server)
+    raise RuntimeError('analyze.py did not come up on port {}:\n{}'.format(port, Path(log_path).read_text()[-2000:]))
+
+
+def stop_server(server):
+    # The whole process group, debug mode of Flask runs the server in a child
+    try:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait(30)
+    except subprocess.TimeoutExpired:
+        os.killpg(server.pid, signal.SIGKILL)
+        server.wait()
+    except ProcessLookupError:
+        pass
+
+
+def request_once(port, path):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    started = time.perf_counter()
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        return response.status, time.perf_counter() - started
+    finally:
+        connection.close()
+
+
+def measure_requests(port, path, clients, seconds):
+    # Every client sends its next request as soon as the last one was answered,
+    # over a connection of its own that is kept open
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        own_latencies, own_errors = [], 0
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                if response.status == 200:
+                    own_latencies.append(time.perf_counter() - started)
+                else:
+                    own_errors += 1
+            except (OSError, http.client.HTTPException):
+                own_errors += 1
+                connection.close()
+        connection.close()
+        with lock:
+            latencies.extend(own_latencies)
+            errors.append(own_errors)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return OrderedDict([('path', path), ('clients', clients), ('requests', len(latencies)), ('errors', sum(errors)),
+                        ('seconds', round(elapsed, 3)), ('throughput', round(len(latencies) / elapsed, 2)),
+                        ('latency_ms', summary(latencies))])
+
+
+def measure_stream(port, path, clients, seconds):
+    # Event streams: time to the first event and events per second of every client
+    first_events = []
+    counts = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def client():
+        # Events come every second, a stream quiet for STREAM_TIMEOUT has failed
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=STREAM_TIMEOUT)
+        started = time.perf_counter()
+        first_event, events, failed = None, 0, 0
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            while time.monotonic() < deadline:
+                line = response.readline()
+                if not line:
+                    failed = 1
+                    break
+                if line.startswith(b'data:'):
+                    events += 1
+                    if first_event is None:
+                        first_event = time.perf_counter() - started
+        except (OSError, http.client.HTTPException):
+            failed = 1
+        finally:
+            connection.close()
+        with lock:
+            if first_event is not None:
+                first_events.append(first_event)
+            counts.append(events)
+            errors.append(failed)
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return OrderedDict([('path', path), ('clients', clients), ('events', sum(counts)), ('errors', sum(errors)),
+                        ('events_per_client_second', round(sum(counts) / clients / seconds, 3)),
+                        ('first_event_ms', summary(first_events))])
+
+
+def server_metrics(port):
+    # Where the time went on the server: mean of the histograms of metrics.py
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    connection.request('GET', '/metrics')
+    text = connection.getresponse().read().decode('utf-8')
+    connection.close()
+    series = {}
+    for name, part, labels, value in re.findall(r'^(rpi_\w+_seconds)_(sum|count)\{(.*)\} (\S+)$', text, re.M):
+        # query="ping_history" becomes ping_history, endpoint="graph",status="200" graph 200
+        labels = ' '.join(re.findall(r'"([^"]*)"', labels))
+        series.setdefault((name, labels), {})[part] = float(value)
+    result = OrderedDict()
+    for (name, labels), values in sorted(series.items()):
+        if values.get('count'):
+            result.setdefault(name, OrderedDict())[labels] = OrderedDict(
+                [('count', int(values['count'])), ('mean_ms', round(values['sum'] / values['count'] * 1000, 3))])
+    return result
+
+
+def measure_dashboard(args, config_path, directory, destinations):
+    server = start_server(config_path, args.port, os.path.join(directory, 'analyze.log'))
+    try:
+        endpoints = []
+        for endpoint in args.endpoints:
+            path = endpoint.format(destination=destinations[0])
+            # The first request renders what the graph cache does not have yet
+            status, first = request_once(args.port, path)
+            for clients in args.clients:
+                result = measure_requests(args.port, path, clients, args.seconds)
+                result['first_ms'] = round(first * 1000, 3) if status == 200 else None
+                endpoints.append(result)
+        streams = [measure_stream(args.port, path, clients, args.seconds)
+                   for path in STREAMS for clients in args.clients]
+        return endpoints, streams, server_metrics(args.port)
+    finally:
+        stop_server(server)
+
+
+def measure_ingest(args, destinations, interfaces):
+    # add() the way the collectors call it, as fast as it takes rows, then until
+    # close() has written out everything that was taken
+    from storage import open_storage
+
+    random_source = random.Random(args.seed + 1)
+    end = time.time()
+    ping_start = end - args.ingest_rows / args.ping_rate / len(destinations)
+    traffic_start = end - args.ingest_rows / args.traffic_rate / len(interfaces)
+    result = OrderedDict()
+    for table, writer, samples in (
+            ('pings', open_storage().ping_writer(),
+             synthetic_pings(random_source, destinations, ping_start, end, args.ping_rate, args.loss)),
+            ('traffic', open_storage().traffic_writer(),
+             synthetic_traffic(random_source, interfaces, traffic_start, end, args.traffic_rate, args.peak_mbps))):
+        entries = list(islice(samples, args.ingest_rows))
+        add_latencies = []
+        started = time.perf_counter()
+        for entry in entries:
+            added = time.perf_counter()
+            writer.add(entry)
+            add_latencies.append(time.perf_counter() - added)
+        writer.close()
+        seconds = time.perf_counter() - started
+        result[table] = OrderedDict([('rows', len(entries)), ('written', writer.written), ('dropped', writer.dropped),
+                                     ('seconds', round(seconds, 3)),
+                                     ('rows_per_second', round(writer.written / seconds, 1)),
+                                     ('add_us', summary(add_latencies, scale=1e6))])
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ph.project_path, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    directory = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        config_path = benchmark_config(args, directory)
+        # Every module imported from here on reads the config of the benchmark
+        os.environ['RPI_CONFIG'] = config_path
+        destinations = ['benchmark-{}'.format(index + 1) for index in range(args.destinations)]
+        interfaces = [ph.outbound_interface, ph.inboud_interface]
+        results = OrderedDict()
+        results['benchmark'] = OrderedDict([('started_at', datetime.now(timezone.utc).isoformat()),
+                                            ('revision', git_revision()),
+                                            ('python', platform.python_version()),
+                                            ('machine', platform.machine()),
+                                            ('settings', vars(args))])
+        print('Filling {} hours of samples'.format(args.hours), file=sys.stderr)
+        results['fill'] = fill(args, destinations, interfaces)
+        print('Measuring the dashboard', file=sys.stderr)
+        results['endpoints'], results['streams'], results['server'] = \
+            measure_dashboard(args, config_path, directory, destinations)
+        print('Measuring ingest', file=sys.stderr)
+        results['ingest'] = measure_ingest(args, destinations, interfaces)
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def change(before, after):
+    if before is None or after is None:
+        return '{:>10} {:>10} {:>8}'.format('-', '-', '')
+    difference = '{:+.1f}%'.format((after - before) / before * 100) if before else ''
+    return '{:>10} {:>10} {:>8}'.format(before, after, difference)
+
+
+def compare(before_path, after_path):
+    before, after = (json.loads(Path(path).read_text()) for path in (before_path, after_path))
+    print('{:<32} {:>7}  {:<30} {:<30} {:<30}'.format('endpoint', 'clients', 'p50 ms', 'p99 ms', 'requests/s'))
+    old = {(result['path'], result['clients']): result for result in before.get('endpoints', [])}
+    for result in after.get('endpoints', []):
+        previous = old.get((result['path'], result['clients']))
+        if previous is None:
+            continue
+        print('{:<32} {:>7}  {} {} {}'.format(result['path'], result['clients'],
+                                               change((previous['latency_ms'] or {}).get('p50'),
+                                                      (result['latency_ms'] or {}).get('p50')),
+                                               change((previous['latency_ms'] or {}).get('p99'),
+                                                      (result['latency_ms'] or {}).get('p99')),
+                                               change(previous['throughput'], result['throughput'])))
+    print()
+    print('{:<32} {:<30}'.format('ingest', 'rows/s'))
+    for table, result in after.get('ingest', {}).items():
+        previous = before.get('ingest', {}).get(table)
+        if previous is not None:
+            print('{:<32} {}'.format(table, change(previous['rows_per_second'], result['rows_per_second'])))
+
+
+def integers(text):
+    return [int(part) for part in text.split(',') if part]
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description='Load test of the dashboard and the collectors, results as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two results and exit')
+    parser.add_argument('--backend', choices=('postgres', 'ringfile'), default=ph.storage_backend)
+    parser.add_argument('--database', default='pi_benchmark', help='postgres database the benchmark owns')
+    parser.add_argument('--hours', type=float, default=24.0, help='history to fill')
+    parser.add_argument('--retention', type=int, default=ph.retention_hours, help='hours of raw samples kept')
+    parser.add_argument('--destinations', type=int, default=2)
+    parser.add_argument('--ping-rate', type=float, default=1.0, help='probes per second and destination')
+    parser.add_argument('--traffic-rate', type=float, default=1.0 / ph.traffic_sample_interval,
+                        help='samples per second and interface')
+    parser.add_argument('--loss', type=float, default=0.01, help='share of lost probes')
+    parser.add_argument('--peak-mbps', type=float, default=30.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--clients', type=integers, default=[1, 4, 16], help='comma separated client counts')
+    parser.add_argument('--seconds', type=float, default=10.0, help='per endpoint and client count')
+    parser.add_argument('--endpoints', type=lambda text: text.split(','), default=list(ENDPOINTS),
+                        help='comma separated paths, {destination} is the first synthetic one')
+    parser.add_argument('--ingest-rows', type=int, default=20000)
+    parser.add_argument('--port', type=int, default=8099, help='port of the benchmarked server, the next one too')
+    parser.add_argument('--output', help='file for the JSON results instead of stdout')
+    args = parser.parse_args(arguments)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.backend == 'postgres' and args.database == ph.db_name:
+        parser.error('--database is the database of the dashboard, the benchmark would wipe it')
+    output = json.dumps(run(args), indent=2)
+    if args.output:
+        Path(args.output).write_text(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import json
+import os
 from collections import OrderedDict
 from pathlib import Path
 
@@ -9,8 +10,9 @@ class ParameterHandler:
     def __init__(self):
         self._this_path = Path(__file__).absolute().parent
         self.project_path = self._this_path.parent
-        self._config = json.loads(self._this_path.joinpath('config.json').read_text(),
-                                  encoding='utf-8', object_hook=OrderedDict)
+        # RPI_CONFIG points a process at another config, benchmark.py runs on one of its own
+        config_path = Path(os.environ.get('RPI_CONFIG', self._this_path.joinpath('config.json')))
+        self._config = json.loads(config_path.read_text(), encoding='utf-8', object_hook=OrderedDict)
 
     @property
     def project_path(self):
@@ -28,6 +30,130 @@ class ParameterHandler:
     def outbound_interface(self):
         return self._config.get('OUTBOUND_TRAFFIC_INTERFACE')
 
+    @property
+    def traffic_sample_interval(self):
+        return float(self._config.get('TRAFFIC_SAMPLE_INTERVAL', 1.0))
+
+    @property
+    def targets(self):
+        return self._config.get('TARGETS', [])
+
+    @property
+    def connectivity_probe(self):
+        return self._config.get('CONNECTIVITY_PROBE', 'icmp')
+
+    @property
+    def connectivity_timeout(self):
+        return float(self._config.get('CONNECTIVITY_TIMEOUT', 2.0))
+
+    @property
+    def connectivity_port(self):
+        return int(self._config.get('CONNECTIVITY_PORT', 443))
+
+    @property
+    def wifi_check_interval(self):
+        return float(self._config.get('WIFI_CHECK_INTERVAL', 30))
+
+    @property
+    def wifi_scan_interval(self):
+        return float(self._config.get('WIFI_SCAN_INTERVAL', 120))
+
+    @property
+    def wifi_switch_margin(self):
+        return self._config.get('WIFI_SWITCH_MARGIN', 15)
+
+    @property
+    def wifi_switch_confirmations(self):
+        return self._config.get('WIFI_SWITCH_CONFIRMATIONS', 3)
+
+    @property
+    def wifi_min_dwell(self):
+        return self._config.get('WIFI_MIN_DWELL', 300)
+
+    @property
+    def ssid_quality_interval(self):
+        return self._config.get('SSID_QUALITY_INTERVAL', 300)
+
+    @property
+    def ssid_quality_max_age(self):
+        return self._config.get('SSID_QUALITY_MAX_AGE', 7)
+
+    @property
+    def shaping(self):
+        return self._config.get('SHAPING', {})
+
+    @property
+    def autorate(self):
+        return self._config.get('AUTORATE', {})
+
+    @property
+    def server_mode(self):
+        return self._config.get('SERVER_MODE', 'threading')
+
+    @property
+    def server_port(self):
+        return self._config.get('SERVER_PORT', 80)
+
+    @property
+    def server_connections(self):
+        return self._config.get('SERVER_CONNECTIONS', 256)
+
+    @property
+    def server_threads(self):
+        return self._config.get('SERVER_THREADS', 2)
+
+    @property
+    def server_shutdown_timeout(self):
+        return self._config.get('SERVER_SHUTDOWN_TIMEOUT', 10)
+
+    @property
+    def speedtest_command(self):
+        return self._config.get('SPEEDTEST_COMMAND', ['speedtest-cli', '--simple'])
+
+    @property
+    def speedtest_url(self):
+        return self._config.get('SPEEDTEST_URL', '')
+
+    @property
+    def speedtest_seconds(self):
+        return self._config.get('SPEEDTEST_SECONDS', 10)
+
+    @property
+    def speedtest_schedule(self):
+        return self._config.get('SPEEDTEST_SCHEDULE', [])
+
+    @property
+    def speedtest_idle_mbps(self):
+        return self._config.get('SPEEDTEST_IDLE_MBPS', 2.0)
+
+    @property
+    def live_port(self):
+        return int(self._config.get('LIVE_PORT', 5005))
+
+    @property
+    def live_samples(self):
+        return int(self._config.get('LIVE_SAMPLES', 600))
+
+    @property
+    def ping_metrics_port(self):
+        return int(self._config.get('PING_METRICS_PORT', 9101))
+
+    @property
+    def traffic_metrics_port(self):
+        return int(self._config.get('TRAFFIC_METRICS_PORT', 9102))
+
+    @property
+    def storage_backend(self):
+        return self._config.get('STORAGE_BACKEND', 'postgres')
+
+    @property
+    def ring_store_path(self):
+        return self._config.get('RING_STORE_PATH') or self.project_path + '/data'
+
+    @property
+    def ring_capacity(self):
+        return int(self._config.get('RING_CAPACITY', 259200))
+
     @property
     def db_name(self):
         return self._config.get('DB_NAME')
@@ -40,6 +166,22 @@ class ParameterHandler:
     def db_password(self):
         return self._config.get('DB_PASSWORD')
 
+    @property
+    def db_pool_size(self):
+        return self._config.get('DB_POOL_SIZE', 5)
+
+    @property
+    def db_pool_idle_timeout(self):
+        return self._config.get('DB_POOL_IDLE_TIMEOUT', 300)
+
+    @property
+    def retention_hours(self):
+        return self._config.get('RETENTION_HOURS', 3)
+
+    @property
+    def partitions_ahead(self):
+        return self._config.get('PARTITIONS_AHEAD', 3)
+
     @property
     def max_download(self):
         return self._config.get('MAX_DOWNLOAD')
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+
+import logger
+from params import ParameterHandler
+
+ph = ParameterHandler()
+
+# pings.recorded_at has a time zone, traffic.recorded_at has local time without one,
+# partition bounds follow the type of the column
+partitioned_tables = {
+    'pings': lambda: datetime.now(timezone.utc),
+    'traffic': lambda: datetime.now(),
+}
+
+partition_name_format = '%Y%m%d%H'
+
+
+def partition_name(table, hour):
+    return '{}_p{}'.format(table, hour.strftime(partition_name_format))
+
+
+def existing_partitions(cursor, table):
+    cursor.execute("""
+        SELECT
+          child.relname
+        FROM pg_inherits
+          JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+          JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+        WHERE parent.relname = %s;
+    """, (table,))
+    partitions = {}
+    for (name,) in cursor.fetchall():
+        try:
+            partitions[name] = datetime.strptime(name[len(table) + 2:], partition_name_format)
+        except ValueError:
+            # The default partition only catches rows no hourly partition exists for
+            pass
+    return partitions
+
+
+def create_partitions(cursor, table, now, hours_ahead):
+    current_hour = now.replace(minute=0, second=0, microsecond=0)
+    for hour in (current_hour + timedelta(hours=h) for h in range(0, hours_ahead + 1)):
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table}
+                FOR VALUES FROM (%s) TO (%s);
+            """.format(partition=partition_name(table, hour), table=table),
+                           (hour.isoformat(), (hour + timedelta(hours=1)).isoformat()))
+        except psycopg2.Error as err:
+            # Happens when rows for this hour already went to the default partition
+            logger.warning('Failed to create partition', partition_name(table, hour), str(err))
+
+
+def drop_partitions(cursor, table, now, retention_hours):
+    # Retention is a matter of dropping whole hours, no DELETE, no vacuum afterwards
+    oldest_kept = now.replace(tzinfo=None) - timedelta(hours=retention_hours)
+    for name, hour in existing_partitions(cursor, table).items():
+        if hour + timedelta(hours=1) <= oldest_kept:
+            logger.info('Dropping partition', name)
+            cursor.execute('DROP TABLE IF EXISTS {};'.format(name))
+    cursor.execute('DELETE FROM {table}_default WHERE recorded_at < %s;'.format(table=table),
+                   ((now - timedelta(hours=retention_hours)).isoformat(),))
+
+
+def main():
+    with psycopg2.connect(database=ph.db_name,
+                          user=ph.db_username,
+                          password=ph.db_password,
+                          host='0.0.0.0') as conn:
+        conn.autocommit = True
+        cursor = conn.cursor()
+        for table, clock in partitioned_tables.items():
+            now = clock()
+            create_partitions(cursor, table, now, ph.partitions_ahead)
+            drop_partitions(cursor, table, now, ph.retention_hours)
+        cursor.close()
+
+
+if __name__ == '__main__':
+    main()
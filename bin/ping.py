@@ -1,25 +1,66 @@
 #!/usr/bin/python
 
+import socket
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
 
 import logger
+from params import ParameterHandler
 
-destinations = ['www.google.de', 'www.amazon.de']
+ph = ParameterHandler()
+# The hosts of the ICMP targets that ping.py monitors, else of any target, else the old defaults
+destinations = [target['host'] for target in ph.targets if target.get('protocol', 'icmp') == 'icmp'] or \
+               [target['host'] for target in ph.targets] or ['www.google.de', 'www.amazon.de']
+
+
+def icmp_probe(destination, wlan_interface, timeout):
+    ping_result = subprocess.run(['ping', destination, '-c', '1', '-W', str(max(1, int(timeout))),
+                                  '-I', wlan_interface],
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+    return ping_result == 0
+
+
+def tcp_probe(destination, wlan_interface, timeout):
+    deadline = time.monotonic() + timeout
+    address = socket.getaddrinfo(destination, ph.connectivity_port, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe_socket:
+        # Only binding to the device makes sure the handshake goes over Wi-Fi, which needs root
+        probe_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, wlan_interface.encode('utf-8'))
+        probe_socket.settimeout(max(0.1, deadline - time.monotonic()))
+        try:
+            probe_socket.connect(address)
+        except ConnectionRefusedError:
+            # A reset from the host made the round trip just as well
+            pass
+    return True
 
 
 def is_connected(wlan_interface):
+    # All hosts are probed at the same time, the first one that answers decides.
+    # Nobody waits for the others, and no answer within the timeout means no connection.
     logger.info('Checking availability of hosts (connection probe)')
-    ping_results = []
-    for destination in destinations:
-        ping_result = subprocess.run(['ping', destination, '-c', '1', '-I', wlan_interface], stdout=subprocess.DEVNULL)\
-            .returncode
-        logger.info('Ping:', destination, ', host is', 'reachable' if ping_result is 0 else 'unreachable')
-        ping_results.append(ping_result)
-
-    for ping_result in ping_results:
-        if ping_result == 0:
-            logger.info('Success, one or more hosts are reachable')
-            return True
+    timeout = ph.connectivity_timeout
+    probe = tcp_probe if ph.connectivity_probe == 'tcp' else icmp_probe
+    executor = ThreadPoolExecutor(max_workers=max(1, len(destinations)))
+    try:
+        probes = {executor.submit(probe, destination, wlan_interface, timeout): destination
+                  for destination in destinations}
+        for done in as_completed(probes, timeout=timeout):
+            destination = probes[done]
+            try:
+                reachable = done.result()
+            except OSError as err:
+                logger.info('Ping:', destination, ', host is unreachable:', err)
+                continue
+            logger.info('Ping:', destination, ', host is', 'reachable' if reachable else 'unreachable')
+            if reachable:
+                logger.info('Success, one or more hosts are reachable')
+                return True
+    except TimeoutError:
+        logger.warning('No host answered within', timeout, 'seconds')
+    finally:
+        executor.shutdown(wait=False)
 
     logger.warning('None of hosts is reachable')
     return False
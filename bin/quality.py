@@ -0,0 +1,122 @@
+#!/usr/bin/python
+
+import time
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+import psycopg2.extras
+
+import logger
+from params import ParameterHandler
+
+ph = ParameterHandler()
+
+# Quality of the Wi-Fi networks as measured by ping.py and traffic.py while the
+# Pi was connected to them. Only the network in use can be measured, so the
+# results are kept in ssid_quality and loaded once, which makes scoring a
+# network a dictionary lookup instead of a probe.
+#
+# Score adjustment of a network: one point less per 10 ms of 95th percentile
+# ping time and per half a percent of lost pings, up to ten points more for
+# the highest download rate seen. Networks without recent measurements are
+# neither rewarded nor punished.
+LATENCY_POINTS_MS = 10
+LOSS_POINTS = 200
+THROUGHPUT_POINTS_MBPS = 5
+MAX_LATENCY_MS = 500
+MAX_THROUGHPUT_MBPS = 50
+# Weight of a new measurement in the moving averages
+SMOOTHING = 0.3
+# Measurements need this many pings to count
+MIN_SAMPLES = 60
+
+MEASURE_QUERY = """
+    SELECT
+      count(*) AS samples,
+      percentile_cont(0.5) WITHIN GROUP (ORDER BY pingtime) AS pingtime_p50,
+      percentile_cont(0.95) WITHIN GROUP (ORDER BY pingtime) AS pingtime_p95,
+      (count(*) - count(pingtime))::numeric / count(*) AS loss_ratio,
+      (SELECT max(download) FROM traffic WHERE interface = %s AND recorded_at >= %s) AS download_max
+    FROM pings
+    WHERE recorded_at >= %s;
+"""
+
+UPSERT_QUALITY = """
+    INSERT INTO ssid_quality AS q
+      (ssid, measured_at, samples, pingtime_p50, pingtime_p95, loss_ratio, download_max)
+    VALUES (%(ssid)s, now(), %(samples)s, %(pingtime_p50)s, %(pingtime_p95)s, %(loss_ratio)s, %(download_max)s)
+    ON CONFLICT (ssid) DO UPDATE SET
+      measured_at = EXCLUDED.measured_at,
+      samples = q.samples + EXCLUDED.samples,
+      pingtime_p50 = coalesce(q.pingtime_p50 * {keep} + EXCLUDED.pingtime_p50 * {smoothing}, EXCLUDED.pingtime_p50),
+      pingtime_p95 = coalesce(q.pingtime_p95 * {keep} + EXCLUDED.pingtime_p95 * {smoothing}, EXCLUDED.pingtime_p95),
+      loss_ratio = q.loss_ratio * {keep} + EXCLUDED.loss_ratio * {smoothing},
+      download_max = GREATEST(q.download_max * {keep} + EXCLUDED.download_max * {smoothing}, EXCLUDED.download_max)
+    RETURNING *;
+""".format(keep=1 - SMOOTHING, smoothing=SMOOTHING)
+
+
+class QualityTable:
+    def __init__(self, interface):
+        self.interface = interface
+        self._conn = None
+        self._quality = None
+        self._measured_at = time.monotonic()
+
+    def _cursor(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = psycopg2.connect(database=ph.db_name,
+                                          user=ph.db_username,
+                                          password=ph.db_password,
+                                          host='0.0.0.0')
+            self._conn.autocommit = True
+        return self._conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    def quality(self):
+        if self._quality is None:
+            self._quality = {}
+            try:
+                cursor = self._cursor()
+                cursor.execute('SELECT * FROM ssid_quality WHERE measured_at > now() - %s * INTERVAL \'1 day\';',
+                               (ph.ssid_quality_max_age,))
+                self._quality = {row['ssid']: row for row in cursor.fetchall()}
+            except psycopg2.Error as err:
+                logger.warning('Can not load Wi-Fi quality, scoring by signal only: ' + str(err).strip())
+                self._conn = None
+        return self._quality
+
+    def adjustment(self, ssid):
+        row = self.quality().get(ssid)
+        if row is None:
+            return 0
+        adjustment = -float(row['loss_ratio']) * LOSS_POINTS
+        if row['pingtime_p95'] is not None:
+            adjustment -= min(float(row['pingtime_p95']), MAX_LATENCY_MS) / LATENCY_POINTS_MS
+        if row['download_max'] is not None:
+            adjustment += min(float(row['download_max']), MAX_THROUGHPUT_MBPS) / THROUGHPUT_POINTS_MBPS
+        return adjustment
+
+    def measure(self, ssid, connected_since):
+        # Every SSID_QUALITY_INTERVAL seconds, the samples recorded since then or
+        # since the network was joined are added to its record
+        if time.monotonic() - self._measured_at < ph.ssid_quality_interval:
+            return
+        now = datetime.now(timezone.utc)
+        start = max(connected_since, now - timedelta(seconds=ph.ssid_quality_interval))
+        self._measured_at = time.monotonic()
+        try:
+            cursor = self._cursor()
+            # traffic.recorded_at is local time without a time zone
+            cursor.execute(MEASURE_QUERY, (self.interface, start.astimezone().replace(tzinfo=None), start))
+            measured = cursor.fetchone()
+            if measured['samples'] < MIN_SAMPLES:
+                return
+            cursor.execute(UPSERT_QUALITY, dict(measured, ssid=ssid))
+            row = cursor.fetchone()
+        except psycopg2.Error as err:
+            logger.warning('Can not measure Wi-Fi quality of ' + ssid + ': ' + str(err).strip())
+            self._conn = None
+            return
+        self.quality()[ssid] = row
+        logger.info('Quality of', ssid, ': p95', round(float(row['pingtime_p95'] or 0), 1), 'ms, loss',
+                    round(100 * float(row['loss_ratio']), 2), '%, score adjustment', round(self.adjustment(ssid), 1))
@@ -15,11 +15,11 @@ cron = CronTab(user=ph.db_username)
 
 
 cron_templates = [
-    '1m|sudo python' + ph.python_version + ' ' + ph.project_path + '/bin/startup.py',
-    '1m|python' + ph.python_version + ' ' + ph.project_path + '/ping.py www.amazon.de',
-    '1m|python' + ph.python_version + ' ' + ph.project_path + '/traffic.py',
-    '3h|psql --command="delete from traffic where traffic.recorded_at < now() - interval \'3 hours\';"',
-    '3h|psql --command="delete from pings where pings.recorded_at < now() - interval \'3 hours\';"',
+    '1h|python' + ph.python_version + ' ' + ph.project_path + '/bin/partitions.py',
+    '3h|psql --command="delete from pings_minute where bucket < now() - interval \'7 days\';"',
+    '3h|psql --command="delete from traffic_minute where bucket < now() - interval \'7 days\';"',
+    '3h|psql --command="delete from pings_hour where bucket < now() - interval \'90 days\';"',
+    '3h|psql --command="delete from traffic_hour where bucket < now() - interval \'90 days\';"',
     'd4|sudo reboot']
 
 
@@ -51,30 +51,51 @@ def execute(cmd):
     return p.returncode
 
 
-def add_server_service():
+def add_service(name):
     try:
-        with open(ph.project_path + '/bin/analyze.service', 'r') as svc_template_file:
-            analyze_service = svc_template_file.read().format(project_path=ph.project_path)
-        with open('/etc/systemd/system/analyze.service', 'w+') as service_file:
-            service_file.write(analyze_service)
+        with open(ph.project_path + '/bin/' + name, 'r') as svc_template_file:
+            service = svc_template_file.read().format(project_path=ph.project_path,
+                                                      python_version=ph.python_version,
+                                                      db_username=ph.db_username)
+        with open('/etc/systemd/system/' + name, 'w+') as service_file:
+            service_file.write(service)
             service_file.close()
     except IOError as err:
-        logger.error('Failed to add service for statistics server. Reason: ' + str(err))
+        logger.error('Failed to add service ' + name + '. Reason: ' + str(err))
         return 1
 
-    start_service = subprocess.Popen(['systemctl', 'start', 'analyze.service'])
+    start_service = subprocess.Popen(['systemctl', 'start', name])
     start_service.wait()
     if start_service.returncode is not 0:
-        logger.warning('Failed to start statistics server service. Proceeding to next step anyway')
+        logger.warning('Failed to start ' + name + '. Proceeding to next step anyway')
         logger.warning('Reason: ' + start_service.stderr.read().decode('utf-8'))
 
-    add_service_auto = subprocess.Popen(['systemctl', 'enable', 'analyze.service'])
+    add_service_auto = subprocess.Popen(['systemctl', 'enable', name])
     add_service_auto.wait()
     if add_service_auto.returncode is not 0:
-        logger.warning('Failed to setup statistics server service to start on boot. Proceeding to next step anyway')
+        logger.warning('Failed to setup ' + name + ' to start on boot. Proceeding to next step anyway')
         logger.warning('Reason: ' + add_service_auto.stderr.read().decode('utf-8'))
 
 
+def add_server_service():
+    return add_service('analyze.service')
+
+
+def add_collector_services():
+    add_service('ping.service')
+    add_service('traffic.service')
+
+
+def add_wifi_service():
+    # Replaces the startup.py cron job
+    return add_service('wifi.service')
+
+
+def add_autorate_service():
+    # Builds the shaping tree of shaping.py itself if it is missing
+    return add_service('autorate.service')
+
+
 def install_requirements():
     return execute(['pip', 'install', '--user', '--requirement', './requirements.txt'])
 
@@ -110,6 +131,9 @@ def main():
     #     return 1
     # add_crontabs()
     # add_server_service()
+    # add_collector_services()
+    # add_wifi_service()
+    # add_autorate_service()
     create_db()
 
 
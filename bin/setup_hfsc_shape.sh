@@ -1,5 +1,9 @@
 #!/bin/bash
 # Source: https://gist.github.com/eqhmcow/939373
+#
+# shaping.py builds the same tree from the SHAPING settings of config.json and
+# changes only what differs from the kernel state, without tearing it down.
+# This script is kept as the reference for the tree and its rationale.
 
 # As the "bufferbloat" folks have recently re-discovered and/or more widely
 # publicized, congestion avoidance algorithms (such as those found in TCP) do
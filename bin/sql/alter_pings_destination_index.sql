@@ -0,0 +1,3 @@
+-- Upgrades a pings table created before it had an index per destination. On a
+-- partitioned table the index is created on every partition.
+CREATE index IF NOT EXISTS pings_destination_recorded_at ON pings(destination, recorded_at);
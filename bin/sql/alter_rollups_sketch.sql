@@ -0,0 +1,4 @@
+-- Upgrades ping rollups created before they kept quantile sketches. Percentiles of
+-- older buckets are not known, they count as empty sketches.
+ALTER TABLE pings_minute ADD COLUMN IF NOT EXISTS pingtime_sketch bytea;
+ALTER TABLE pings_hour ADD COLUMN IF NOT EXISTS pingtime_sketch bytea;
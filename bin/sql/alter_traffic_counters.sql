@@ -0,0 +1,13 @@
+-- Upgrades a traffic table created before per interface packet, error and drop counters were recorded.
+-- Older rows were all sampled on OUTBOUND_TRAFFIC_INTERFACE of config.json, pass it in:
+--   psql -v outbound_interface=eth0 -f bin/sql/alter_traffic_counters.sql
+\set ON_ERROR_STOP on
+ALTER TABLE traffic ADD COLUMN IF NOT EXISTS interface text;
+ALTER TABLE traffic ADD COLUMN IF NOT EXISTS upload_pps numeric;
+ALTER TABLE traffic ADD COLUMN IF NOT EXISTS download_pps numeric;
+ALTER TABLE traffic ADD COLUMN IF NOT EXISTS errors integer;
+ALTER TABLE traffic ADD COLUMN IF NOT EXISTS drops integer;
+
+UPDATE traffic SET interface = :'outbound_interface' WHERE interface IS NULL;
+
+CREATE index IF NOT EXISTS traffic_interface_recorded_at ON traffic(interface, recorded_at);
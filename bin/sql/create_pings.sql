@@ -1,3 +1,5 @@
+-- Raw pings are split into hourly partitions, bin/partitions.py creates them ahead
+-- of time and drops the ones older than RETENTION_HOURS
 CREATE TABLE pings
 (
 	recorded_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
@@ -5,6 +7,10 @@ CREATE TABLE pings
 	ttl integer,
 	bytes_received integer,
 	pingtime numeric
-);
+) PARTITION BY RANGE (recorded_at);
 
-CREATE index pings_recorded_at ON pings(recorded_at);
\ No newline at end of file
+CREATE TABLE pings_default PARTITION OF pings DEFAULT;
+
+CREATE index pings_recorded_at ON pings(recorded_at);
+-- Per destination reads of the raw samples, like the latency windows of the dashboard
+CREATE index pings_destination_recorded_at ON pings(destination, recorded_at);
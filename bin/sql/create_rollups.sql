@@ -0,0 +1,54 @@
+-- Aggregates maintained by ping.py and traffic.py together with every batch of raw rows.
+-- Average ping time is pingtime_sum / (count - lost), average bandwidth is upload_sum / count.
+-- pingtime_sketch is a serialized sketch.Sketch of the ping times, rows backfilled here have none.
+CREATE TABLE pings_minute
+(
+	destination text NOT NULL,
+	bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+	count integer NOT NULL,
+	lost integer NOT NULL,
+	pingtime_sum numeric NOT NULL,
+	pingtime_min numeric,
+	pingtime_max numeric,
+	pingtime_sketch bytea,
+	PRIMARY KEY (destination, bucket)
+);
+
+CREATE TABLE pings_hour (LIKE pings_minute INCLUDING ALL);
+
+CREATE TABLE traffic_minute
+(
+	interface text NOT NULL,
+	bucket TIMESTAMP without TIME ZONE NOT NULL,
+	count integer NOT NULL,
+	upload_sum numeric NOT NULL,
+	upload_max numeric,
+	download_sum numeric NOT NULL,
+	download_max numeric,
+	errors integer NOT NULL,
+	drops integer NOT NULL,
+	PRIMARY KEY (interface, bucket)
+);
+
+CREATE TABLE traffic_hour (LIKE traffic_minute INCLUDING ALL);
+
+-- Backfill from the raw rows that are already there
+INSERT INTO pings_minute
+SELECT destination, date_trunc('minute', recorded_at), count(*), count(*) - count(pingtime),
+       coalesce(sum(pingtime), 0), min(pingtime), max(pingtime), NULL
+FROM pings WHERE destination IS NOT NULL GROUP BY 1, 2;
+
+INSERT INTO pings_hour
+SELECT destination, date_trunc('hour', recorded_at), count(*), count(*) - count(pingtime),
+       coalesce(sum(pingtime), 0), min(pingtime), max(pingtime), NULL
+FROM pings WHERE destination IS NOT NULL GROUP BY 1, 2;
+
+INSERT INTO traffic_minute
+SELECT interface, date_trunc('minute', recorded_at), count(*), sum(upload), max(upload),
+       sum(download), max(download), coalesce(sum(errors), 0), coalesce(sum(drops), 0)
+FROM traffic WHERE interface IS NOT NULL GROUP BY 1, 2;
+
+INSERT INTO traffic_hour
+SELECT interface, date_trunc('hour', recorded_at), count(*), sum(upload), max(upload),
+       sum(download), max(download), coalesce(sum(errors), 0), coalesce(sum(drops), 0)
+FROM traffic WHERE interface IS NOT NULL GROUP BY 1, 2;
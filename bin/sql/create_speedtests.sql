@@ -0,0 +1,15 @@
+-- Speedtests run from the dashboard, by the API or on SPEEDTEST_SCHEDULE, see speedtests.py.
+-- Failed tests keep their error and whatever phases finished before it.
+CREATE TABLE speedtests
+(
+	id serial PRIMARY KEY,
+	started_at TIMESTAMP WITH TIME ZONE NOT NULL,
+	duration real,
+	reason text NOT NULL,
+	ping real,
+	download real,
+	upload real,
+	error text
+);
+
+CREATE INDEX speedtests_started_at ON speedtests (started_at);
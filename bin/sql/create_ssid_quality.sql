@@ -0,0 +1,12 @@
+-- Measured quality per Wi-Fi network, kept by bin/wifi.py while the Pi is connected to it.
+-- Values are moving averages over the measurements, the supervisor scores networks from them.
+CREATE TABLE ssid_quality
+(
+	ssid text PRIMARY KEY,
+	measured_at TIMESTAMP WITH TIME ZONE NOT NULL,
+	samples integer NOT NULL,
+	pingtime_p50 numeric,
+	pingtime_p95 numeric,
+	loss_ratio numeric NOT NULL,
+	download_max numeric
+);
@@ -1,8 +1,18 @@
+-- Raw traffic samples are split into hourly partitions, bin/partitions.py creates
+-- them ahead of time and drops the ones older than RETENTION_HOURS
 CREATE TABLE traffic
 (
 	recorded_at TIMESTAMP without TIME ZONE DEFAULT now(),
+	interface text,
 	upload numeric,
-	download numeric
-);
+	download numeric,
+	upload_pps numeric,
+	download_pps numeric,
+	errors integer,
+	drops integer
+) PARTITION BY RANGE (recorded_at);
 
-CREATE index traffic_recorded_at ON traffic(recorded_at);
\ No newline at end of file
+CREATE TABLE traffic_default PARTITION OF traffic DEFAULT;
+
+CREATE index traffic_recorded_at ON traffic(recorded_at);
+CREATE index traffic_interface_recorded_at ON traffic(interface, recorded_at);
@@ -0,0 +1,55 @@
+-- Moves unpartitioned pings and traffic tables (create_pings.sql and create_traffic.sql
+-- before partitioning, with alter_traffic_counters.sql applied) over to hourly partitions.
+-- bin/partitions.py keeps creating and dropping partitions from then on.
+-- Requires PostgreSQL 11 or newer. Retention and the partitions ahead are RETENTION_HOURS
+-- and PARTITIONS_AHEAD of config.json:
+--   psql -v retention_hours=3 -v partitions_ahead=3 -f bin/sql/migrate_partitions.sql
+-- Any error rolls everything back, the old tables are only dropped once their rows are copied.
+\set ON_ERROR_STOP on
+\if :{?retention_hours}
+\else
+\set retention_hours 3
+\endif
+\if :{?partitions_ahead}
+\else
+\set partitions_ahead 3
+\endif
+
+BEGIN;
+
+ALTER TABLE pings RENAME TO pings_unpartitioned;
+ALTER INDEX pings_recorded_at RENAME TO pings_unpartitioned_recorded_at;
+ALTER INDEX IF EXISTS pings_destination_recorded_at RENAME TO pings_unpartitioned_destination_recorded_at;
+ALTER TABLE traffic RENAME TO traffic_unpartitioned;
+ALTER INDEX traffic_recorded_at RENAME TO traffic_unpartitioned_recorded_at;
+ALTER INDEX IF EXISTS traffic_interface_recorded_at RENAME TO traffic_unpartitioned_interface_recorded_at;
+
+\ir create_pings.sql
+\ir create_traffic.sql
+
+-- The same hourly partitions bin/partitions.py creates, for the rows copied below
+-- and the next few hours
+SELECT format('CREATE TABLE pings_p%s PARTITION OF pings FOR VALUES FROM (%L) TO (%L)',
+              to_char(hour, 'YYYYMMDDHH24'), hour || '+00', hour + INTERVAL '1 hour' || '+00')
+FROM generate_series(date_trunc('hour', now() AT TIME ZONE 'UTC') - :retention_hours * INTERVAL '1 hour',
+                     date_trunc('hour', now() AT TIME ZONE 'UTC') + :partitions_ahead * INTERVAL '1 hour',
+                     INTERVAL '1 hour') AS hour \gexec
+SELECT format('CREATE TABLE traffic_p%s PARTITION OF traffic FOR VALUES FROM (%L) TO (%L)',
+              to_char(hour, 'YYYYMMDDHH24'), hour, hour + INTERVAL '1 hour')
+FROM generate_series(date_trunc('hour', localtimestamp) - :retention_hours * INTERVAL '1 hour',
+                     date_trunc('hour', localtimestamp) + :partitions_ahead * INTERVAL '1 hour',
+                     INTERVAL '1 hour') AS hour \gexec
+
+-- Only the rows that are still within retention are worth keeping
+INSERT INTO pings
+SELECT recorded_at, destination, ttl, bytes_received, pingtime
+FROM pings_unpartitioned WHERE recorded_at >= now() - :retention_hours * INTERVAL '1 hour';
+
+INSERT INTO traffic
+SELECT recorded_at, interface, upload, download, upload_pps, download_pps, errors, drops
+FROM traffic_unpartitioned WHERE recorded_at >= localtimestamp - :retention_hours * INTERVAL '1 hour';
+
+DROP TABLE pings_unpartitioned;
+DROP TABLE traffic_unpartitioned;
+
+COMMIT;
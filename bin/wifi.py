@@ -0,0 +1,193 @@
+#!/usr/bin/python
+
+import os
+import queue
+import re
+import subprocess
+import threading
+import time
+from datetime import datetime, timezone
+
+import pynmcli
+
+import logger
+import ping
+from params import ParameterHandler
+from quality import QualityTable
+from startup import start_vnc
+
+ph = ParameterHandler()
+
+ssids = ph.preferred_ssids
+wlan_interface = ph.inboud_interface
+
+# Resident replacement of the startup.py cron job. NetworkManager events from
+# `nmcli monitor` wake it up as soon as the link changes, otherwise it looks at
+# the Wi-Fi every WIFI_CHECK_INTERVAL seconds. Profiles are listed once and kept
+# until NetworkManager reports a change, scans are limited to one per
+# WIFI_SCAN_INTERVAL while connected, and a better network has to win
+# WIFI_SWITCH_CONFIRMATIONS checks in a row by WIFI_SWITCH_MARGIN before the
+# supervisor leaves a working connection, and never within WIFI_MIN_DWELL
+# seconds of the last switch.
+MONITOR_RESTART_DELAY = 5
+# A disconnected Pi scans as often as this
+DISCONNECTED_SCAN_INTERVAL = 10
+# Score of a network for every place it is further up PREFERRED_SSIDS, on top of
+# its signal strength and the quality measured on it earlier (see quality.py)
+PREFERENCE_WEIGHT = 10
+# Time NetworkManager gets to bring a connection up before we try again
+RECONNECT_DELAY = 30
+
+PROFILE_EVENT = re.compile(r'connection profile|profile .* (added|removed|changed)', re.IGNORECASE)
+
+
+class WifiSupervisor:
+    def __init__(self, interface, preferred_ssids):
+        self.interface = interface
+        self.preferred_ssids = list(preferred_ssids)
+        self._events = queue.Queue()
+        self._profiles = None
+        self._scanned_at = 0
+        self._switched_at = 0
+        self._candidate = None
+        self._candidate_wins = 0
+        self.quality = QualityTable(interface)
+        self._ssid_in_use = None
+        self._connected_since = None
+
+    def profiles(self):
+        # NAME -> UUID of the NetworkManager connection profiles
+        if self._profiles is None:
+            available_profiles = pynmcli.get_data(pynmcli.NetworkManager.Connection().show().execute())
+            self._profiles = {profile.get('NAME'): profile.get('UUID') for profile in available_profiles}
+        return self._profiles
+
+    def scan(self, connected):
+        # NetworkManager keeps the results of its own scans, asking for them is cheap,
+        # a rescan keeps the radio busy for seconds and is only done now and then
+        interval = ph.wifi_scan_interval if connected else DISCONNECTED_SCAN_INTERVAL
+        rescan = time.monotonic() - self._scanned_at >= interval
+        if rescan:
+            self._scanned_at = time.monotonic()
+        wlan_probe = pynmcli.get_data(pynmcli.NetworkManager.Device()
+                                      .wifi('list ifname ', self.interface, ' --rescan ', 'yes' if rescan else 'no')
+                                      .execute())
+        networks = {}
+        for available_wlan in wlan_probe:
+            ssid = available_wlan.get('SSID')
+            if ssid not in ssids:
+                continue
+            try:
+                signal = int(available_wlan.get('SIGNAL'))
+            except (TypeError, ValueError):
+                signal = 0
+            network = networks.setdefault(ssid, {'ssid': ssid, 'signal': 0, 'in_use': False})
+            # The best access point of an SSID is the one we would end up with
+            network['signal'] = max(network['signal'], signal)
+            network['in_use'] = network['in_use'] or available_wlan.get('IN-USE') == '*'
+        return list(networks.values())
+
+    def score(self, network):
+        preference = len(self.preferred_ssids) - self.preferred_ssids.index(network['ssid'])
+        return network['signal'] + PREFERENCE_WEIGHT * preference + self.quality.adjustment(network['ssid'])
+
+    def connect(self, ssid):
+        uuid = self.profiles().get(ssid)
+        if uuid is not None:
+            logger.info('Profile for', ssid, 'already exists, reusing it')
+            nmcli_result = pynmcli.NetworkManager.Connection().up(uuid).execute()
+        else:
+            logger.info('Profile for', ssid, 'does not exist, creating it')
+            nmcli_result = pynmcli.NetworkManager.Device().wifi().connect(ssid + ' password ' + ssids.get(ssid)) \
+                .execute()
+            self._profiles = None
+        logger.info(nmcli_result)
+        self._switched_at = time.monotonic()
+        self._candidate, self._candidate_wins = None, 0
+        # Power saving is switched on again with every new connection
+        subprocess.run(['iwconfig', self.interface, 'power', 'off'])
+
+    def check(self, reason):
+        connected = ping.is_connected(self.interface)
+        networks = sorted(self.scan(connected), key=self.score, reverse=True)
+        if not networks:
+            logger.critical('None of requested ssids is available:', ' '.join(self.preferred_ssids))
+            return
+        best = networks[0]
+        in_use = next((network for network in networks if network['in_use']), None)
+
+        if not connected or in_use is None:
+            if time.monotonic() - self._switched_at < RECONNECT_DELAY:
+                logger.info('Not connected (' + reason + '), still waiting for the last connection attempt')
+                return
+            logger.info('Not connected (' + reason + '), connecting to', best['ssid'],
+                        'with signal', best['signal'])
+            self.connect(best['ssid'])
+            return
+
+        if in_use['ssid'] != self._ssid_in_use:
+            self._ssid_in_use, self._connected_since = in_use['ssid'], datetime.now(timezone.utc)
+        self.quality.measure(in_use['ssid'], self._connected_since)
+
+        if best is in_use or self.score(best) < self.score(in_use) + ph.wifi_switch_margin:
+            self._candidate, self._candidate_wins = None, 0
+            return
+
+        # Hysteresis: the same better network has to come out on top repeatedly
+        if self._candidate == best['ssid']:
+            self._candidate_wins += 1
+        else:
+            self._candidate, self._candidate_wins = best['ssid'], 1
+        logger.info('Found more preferred wlan available:', best['ssid'], 'score', self.score(best),
+                    'against', in_use['ssid'], 'score', self.score(in_use),
+                    '(' + str(self._candidate_wins) + '/' + str(ph.wifi_switch_confirmations) + ')')
+        if self._candidate_wins >= ph.wifi_switch_confirmations and \
+                time.monotonic() - self._switched_at >= ph.wifi_min_dwell:
+            logger.info('Reconnecting...')
+            self.connect(best['ssid'])
+
+    def relevant(self, event):
+        return event.startswith(self.interface + ':') or 'onnectivity' in event or \
+               'primary connection' in event or PROFILE_EVENT.search(event) is not None
+
+    def monitor(self):
+        while True:
+            with subprocess.Popen(['nmcli', 'monitor'], stdout=subprocess.PIPE, universal_newlines=True,
+                                  env=dict(os.environ, LC_ALL='C')) as nmcli_monitor:
+                for line in nmcli_monitor.stdout:
+                    if self.relevant(line.strip()):
+                        self._events.put(line.strip())
+            logger.warning('nmcli monitor exited, restarting it')
+            time.sleep(MONITOR_RESTART_DELAY)
+
+    def next_event(self):
+        try:
+            event = self._events.get(timeout=ph.wifi_check_interval)
+        except queue.Empty:
+            return 'periodic check'
+        # Events come in bursts while a connection is set up, one check covers all of them
+        time.sleep(1)
+        while True:
+            if PROFILE_EVENT.search(event):
+                self._profiles = None
+            try:
+                event = self._events.get_nowait()
+            except queue.Empty:
+                return event
+
+    def run(self):
+        logger.info('Supervising', self.interface, 'for', ' '.join(self.preferred_ssids))
+        threading.Thread(target=self.monitor, name='nmcli-monitor', daemon=True).start()
+        subprocess.run(['iwconfig', self.interface, 'power', 'off'])
+        start_vnc()
+        reason = 'startup'
+        while True:
+            try:
+                self.check(reason)
+            except Exception as err:
+                logger.error('Wi-Fi check failed: ' + str(err))
+            reason = self.next_event()
+
+
+if __name__ == '__main__':
+    WifiSupervisor(wlan_interface, ssids).run()
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+import logging
+import queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Subscriber:
+    _CLOSED = object()
+
+    def __init__(self, queue_size):
+        self._queue = queue.Queue(maxsize=queue_size)
+
+    def offer(self, payload):
+        try:
+            self._queue.put_nowait(payload)
+            return True
+        except queue.Full:
+            return False
+
+    def close(self):
+        # Make room for the marker, the client is gone or too slow anyway
+        while True:
+            try:
+                self._queue.put_nowait(self._CLOSED)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def __iter__(self):
+        while True:
+            payload = self._queue.get()
+            if payload is self._CLOSED:
+                return
+            yield payload
+
+
+class Broadcaster:
+    # Calls produce() once per interval, no matter how many clients listen, and hands
+    # the same payload to every subscriber. Each subscriber has a bounded queue and is
+    # dropped when it falls queue_size payloads behind. The producer thread only runs
+    # while somebody is subscribed.
+    def __init__(self, produce, interval=1.0, queue_size=10):
+        self._produce = produce
+        self._interval = interval
+        self._queue_size = queue_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.dropped = 0
+
+    def subscribe(self):
+        subscriber = Subscriber(self._queue_size)
+        with self._lock:
+            self._subscribers.add(subscriber)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='broadcaster', daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+        subscriber.close()
+
+    def close(self):
+        # Ends every stream, on shutdown
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, set()
+        for subscriber in subscribers:
+            subscriber.close()
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, payload):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            if not subscriber.offer(payload):
+                self.dropped += 1
+                self.unsubscribe(subscriber)
+
+    def _run(self):
+        deadline = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+            try:
+                payload = self._produce()
+            except Exception:
+                log.exception('Failed to produce broadcast payload')
+                payload = None
+            if payload is not None:
+                self.publish(payload)
+            deadline = max(deadline + self._interval, time.monotonic())
+            time.sleep(max(0.0, deadline - time.monotonic()))
+
+    def stream(self):
+        subscriber = self.subscribe()
+        try:
+            for payload in subscriber:
+                yield payload
+        finally:
+            self.unsubscribe(subscriber)
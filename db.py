@@ -0,0 +1,373 @@
+#!/usr/bin/python
+
+import io
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError
+
+from bin.params import ParameterHandler
+from metrics import SIZE_BUCKETS, Counter, Gauge, Histogram
+
+ph = ParameterHandler()
+log = logging.getLogger(__name__)
+
+WRITE_SECONDS = Histogram('rpi_storage_write_seconds', 'Time of one write to storage, a COPY batch with its rollups',
+                          ['table'])
+WRITE_ROWS = Histogram('rpi_storage_write_rows', 'Rows per write to storage', ['table'], buckets=SIZE_BUCKETS)
+WRITE_FAILURES = Counter('rpi_storage_write_failures_total', 'Writes to storage that failed and are retried',
+                         ['table'])
+ROWS_WRITTEN = Counter('rpi_storage_rows_written_total', 'Rows written to storage', ['table'])
+ROWS_DROPPED = Counter('rpi_storage_rows_dropped_total', 'Rows given up on, queue full or database away too long',
+                       ['table'])
+ROWS_QUEUED = Gauge('rpi_storage_rows_queued', 'Rows waiting for the next write', ['table'])
+
+
+# For details: http://initd.org/psycopg/docs/module.html#psycopg2.connect
+def connect():
+    return psycopg2.connect(database=ph.db_name,
+                            user=ph.db_username,
+                            password=ph.db_password,
+                            host='0.0.0.0')
+
+
+class SharedConnection:
+    # One long-lived connection for a resident process. It is opened lazily and
+    # re-opened once if the server went away between two statements.
+    def __init__(self):
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = connect()
+            # There is no need for transactions here, no risk of inconsistency etc
+            self._conn.autocommit = True
+        return self._conn
+
+    def run(self, statement):
+        # statement is called with a fresh cursor and may be replayed once on a new connection
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    with self._connection().cursor() as cursor:
+                        return statement(cursor)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    self._close()
+                    if attempt > 0:
+                        raise
+
+    def execute(self, sql_command, args=None):
+        self.run(lambda cursor: cursor.execute(sql_command, args))
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+            self._conn = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+class ConnectionPool:
+    # Thread-safe pool shared by the whole process. Connections are opened on demand
+    # up to max_size, callers wait for a free one instead of failing, connections
+    # idle for longer than idle_timeout are closed and a connection that sat unused
+    # for check_after seconds is tested before it is handed out again.
+    def __init__(self, max_size=5, idle_timeout=300.0, checkout_timeout=10.0, check_after=30.0):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.check_after = check_after
+        self._idle = []
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._stats = {'checkouts': 0, 'waits': 0, 'wait_seconds': 0.0, 'timeouts': 0,
+                       'opened': 0, 'closed_idle': 0, 'closed_broken': 0}
+
+    def _close_expired(self):
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.pop(0)
+            conn.close()
+            self._stats['closed_idle'] += 1
+
+    def _take(self):
+        with self._cond:
+            started = None
+            while True:
+                self._close_expired()
+                if self._idle:
+                    # Most recently used first, so surplus connections age out
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._in_use < self.max_size:
+                    conn, last_used = None, None
+                    break
+                now = time.monotonic()
+                if started is None:
+                    started = now
+                    self._stats['waits'] += 1
+                remaining = self.checkout_timeout - (now - started)
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolError('no database connection available within {}s'.format(self.checkout_timeout))
+                self._cond.wait(remaining)
+            if started is not None:
+                self._stats['wait_seconds'] += time.monotonic() - started
+            self._in_use += 1
+            self._stats['checkouts'] += 1
+            return conn, last_used
+
+    @staticmethod
+    def _healthy(conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        conn, last_used = self._take()
+        try:
+            if conn is not None and time.monotonic() - last_used > self.check_after and not self._healthy(conn):
+                conn.close()
+                with self._cond:
+                    self._stats['closed_broken'] += 1
+                conn = None
+            if conn is None:
+                conn = connect()
+                with self._cond:
+                    self._stats['opened'] += 1
+        except BaseException:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, close=False):
+        if not close and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+        with self._cond:
+            self._in_use -= 1
+            if close or conn.closed:
+                conn.close()
+                self._stats['closed_broken'] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.putconn(conn, close=True)
+            raise
+        except BaseException:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(max_size=self.max_size, in_use=self._in_use, idle=len(self._idle))
+            return stats
+
+    def closeall(self):
+        with self._cond:
+            for conn, _ in self._idle:
+                conn.close()
+            self._idle = []
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+class WriteBuffer:
+    # Collects samples in a bounded queue and writes them with a single COPY once
+    # batch_size rows are waiting or flush_interval seconds have passed. A full
+    # queue drops its oldest row for a new one. When the database is unreachable
+    # at most max_queued rows are kept for the next attempt, the oldest go first.
+    # Every rollup is called as rollup(cursor, entries) in the same transaction as
+    # the COPY, so aggregates never count a batch twice or miss one.
+    _CLOSE = object()
+
+    def __init__(self, table, columns, to_row, batch_size=500, flush_interval=5.0, max_queued=10000,
+                 connection=None, rollups=()):
+        self.table = table
+        self.columns = tuple(columns)
+        self._to_row = to_row
+        self._rollups = tuple(rollups)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_queued = max_queued
+        self._db = connection or SharedConnection()
+        self._queue = queue.Queue(maxsize=max_queued)
+        self.dropped = 0
+        self.written = 0
+        self._closed = False
+        ROWS_QUEUED.track(self._queue.qsize, table)
+        self._thread = threading.Thread(target=self._run, name='write-buffer-' + table, daemon=True)
+        self._thread.start()
+
+    def add(self, entry, block=False):
+        # Collectors never wait, bulk loads like the one of benchmark.py wait for room instead of dropping
+        if block:
+            self._queue.put(entry)
+            return
+        while True:
+            try:
+                self._queue.put_nowait(entry)
+                return
+            except queue.Full:
+                pass
+            try:
+                oldest = self._queue.get_nowait()
+            except queue.Empty:
+                continue
+            if oldest is self._CLOSE:
+                # Closing, the new row would not be written anyway
+                self._queue.put(oldest)
+                oldest = entry
+            self.dropped += 1
+            ROWS_DROPPED.inc(self.table)
+            if oldest is entry:
+                return
+
+    def _convertible(self, entry):
+        try:
+            self._to_row(entry)
+            return True
+        except Exception:
+            return False
+
+    def _copy(self, entries):
+        data = io.StringIO()
+        for entry in entries:
+            data.write('\t'.join(_copy_value(value) for value in self._to_row(entry)))
+            data.write('\n')
+        copy_command = 'COPY {} ({}) FROM STDIN'.format(self.table, ', '.join(self.columns))
+
+        def statement(cursor):
+            data.seek(0)
+            cursor.execute('BEGIN')
+            try:
+                cursor.copy_expert(copy_command, data)
+                for rollup in self._rollups:
+                    rollup(cursor, entries)
+                cursor.execute('COMMIT')
+            except BaseException:
+                try:
+                    cursor.execute('ROLLBACK')
+                except psycopg2.Error:
+                    pass
+                raise
+
+        self._db.run(statement)
+
+    def _flush(self, pending):
+        try:
+            with WRITE_SECONDS.time(self.table):
+                self._copy(pending)
+        except psycopg2.Error as err:
+            WRITE_FAILURES.inc(self.table)
+            overflow = len(pending) - self._max_queued
+            if overflow > 0:
+                self.dropped += overflow
+                ROWS_DROPPED.inc(self.table, amount=overflow)
+                del pending[:overflow]
+            log.warning('Writing %d rows to %s failed, keeping them for the next flush: %s',
+                        len(pending), self.table, err)
+            return pending
+        except Exception:
+            # Not the database but the rows or a rollup, the same batch would fail
+            # again. Rows that do not convert are dropped and the rest is retried,
+            # when they all convert a rollup failed on them and the batch is dropped.
+            WRITE_FAILURES.inc(self.table)
+            log.exception('Writing %d rows to %s failed', len(pending), self.table)
+            kept = [entry for entry in pending if self._convertible(entry)]
+            if len(kept) == len(pending):
+                kept = []
+            self.dropped += len(pending) - len(kept)
+            ROWS_DROPPED.inc(self.table, amount=len(pending) - len(kept))
+            return kept
+        self.written += len(pending)
+        WRITE_ROWS.observe(len(pending), self.table)
+        ROWS_WRITTEN.inc(self.table, amount=len(pending))
+        return []
+
+    def _run(self):
+        pending = []
+        closing = False
+        retrying = False
+        deadline = time.monotonic() + self._flush_interval
+        while not closing:
+            try:
+                row = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                if row is self._CLOSE:
+                    closing = True
+                else:
+                    pending.append(row)
+            except queue.Empty:
+                pass
+
+            # After a failed write only the timer triggers the next attempt
+            batch_full = not retrying and len(pending) >= self._batch_size
+            if closing or batch_full or time.monotonic() >= deadline:
+                while True:
+                    try:
+                        row = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if row is self._CLOSE:
+                        closing = True
+                    else:
+                        pending.append(row)
+                if pending:
+                    pending = self._flush(pending)
+                retrying = bool(pending)
+                deadline = time.monotonic() + self._flush_interval
+
+        if pending:
+            self.dropped += len(pending)
+            ROWS_DROPPED.inc(self.table, amount=len(pending))
+            log.error('Dropped %d rows for %s on shutdown', len(pending), self.table)
+
+    def close(self, timeout=None):
+        # Writes out everything that is still queued, then releases the connection
+        if self._closed:
+            return
+        self._closed = True
+        while self._thread.is_alive():
+            try:
+                self._queue.put(self._CLOSE, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self._thread.join(timeout)
+        self._db.close()
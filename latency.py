@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+import numpy
+
+from sketch import merge_serialized, Sketch
+
+# Latency statistics over the raw samples of one destination. Samples come as two
+# columns in time order: epoch seconds and round trip times in ms, NaN for a ping
+# that got no answer. Everything is done with whole array operations, a window of
+# an hour at one ping per second is a few thousand values.
+PERCENTILES = (50, 95, 99)
+# Trailing windows shown on the stats page, in seconds
+WINDOWS = (60, 300, 3600)
+# Windows beyond the raw retention, their percentiles come from the rollup sketches
+SKETCH_WINDOWS = (86400, 7 * 86400)
+
+# RFC 3550 smooths the jitter with a gain of 1/16
+JITTER_GAIN = 1 / 16
+
+
+def _round(value, digits=3):
+    return None if value is None or numpy.isnan(value) else round(float(value), digits)
+
+
+def jitter(pingtimes):
+    # RFC 3550 interarrival jitter, J += (|D| - J) / 16, where D is the difference
+    # between consecutive round trips. Unrolled, the estimate after the last
+    # difference is a geometrically weighted sum of all |D|, which needs no loop.
+    replies = pingtimes[~numpy.isnan(pingtimes)]
+    differences = numpy.abs(numpy.diff(replies))
+    if not len(differences):
+        return None
+    weights = JITTER_GAIN * (1 - JITTER_GAIN) ** numpy.arange(len(differences) - 1, -1, -1, dtype=numpy.float64)
+    return float(numpy.dot(weights, differences))
+
+
+def loss_bursts(pingtimes):
+    # Lengths of the runs of consecutive lost pings
+    lost = numpy.isnan(pingtimes).astype(numpy.int8)
+    edges = numpy.diff(numpy.r_[0, lost, 0])
+    return numpy.flatnonzero(edges == -1) - numpy.flatnonzero(edges == 1)
+
+
+def latency_stats(pingtimes):
+    pingtimes = numpy.asarray(pingtimes, dtype=numpy.float64)
+    replies = pingtimes[~numpy.isnan(pingtimes)]
+    bursts = loss_bursts(pingtimes)
+    stats = {'count': len(pingtimes),
+             'lost': len(pingtimes) - len(replies),
+             'loss_ratio': _round((len(pingtimes) - len(replies)) / len(pingtimes), 4) if len(pingtimes) else None,
+             'loss_bursts': len(bursts),
+             'max_loss_burst': int(bursts.max()) if len(bursts) else 0,
+             'jitter': _round(jitter(pingtimes))}
+    if len(replies):
+        stats.update(min=_round(replies.min()), avg=_round(replies.mean()), max=_round(replies.max()))
+        for percentile, value in zip(PERCENTILES, numpy.percentile(replies, PERCENTILES)):
+            stats['p{}'.format(percentile)] = _round(value)
+    else:
+        stats.update(min=None, avg=None, max=None)
+        stats.update({'p{}'.format(percentile): None for percentile in PERCENTILES})
+    return stats
+
+
+def trailing_stats(times, pingtimes, now, windows=WINDOWS):
+    # Statistics of the last `window` seconds for each window, keyed by its length
+    times = numpy.asarray(times, dtype=numpy.float64)
+    pingtimes = numpy.asarray(pingtimes, dtype=numpy.float64)
+    return {window: latency_stats(pingtimes[numpy.searchsorted(times, now - window, 'right'):])
+            for window in windows}
+
+
+def sliding_stats(times, pingtimes, window, step, start, end):
+    # Statistics of a window sliding over [start, end] in steps, one column per
+    # statistic and `time` for the end of each window
+    times = numpy.asarray(times, dtype=numpy.float64)
+    pingtimes = numpy.asarray(pingtimes, dtype=numpy.float64)
+    # Only windows that lie within [start, end], the latest one ending at end
+    steps = int((end - start - window) // step) + 1 if end - start >= window else 0
+    ends = (end - step * numpy.arange(steps, dtype=numpy.float64))[::-1]
+    if not len(ends):
+        ends = numpy.array([end], dtype=numpy.float64)
+    lows = numpy.searchsorted(times, ends - window, 'right')
+    highs = numpy.searchsorted(times, ends, 'right')
+    series = {'time': [float(window_end) for window_end in ends]}
+    for low, high in zip(lows, highs):
+        for name, value in latency_stats(pingtimes[low:high]).items():
+            series.setdefault(name, []).append(value)
+    return series
+
+
+def sketch_stats(sketch, count, lost):
+    stats = {'count': count,
+             'lost': lost,
+             'loss_ratio': _round(lost / count, 4) if count else None}
+    for percentile, value in zip(PERCENTILES, sketch.quantiles([p / 100 for p in PERCENTILES])):
+        stats['p{}'.format(percentile)] = value
+    return stats
+
+
+def merged_stats(rows):
+    # Percentiles of a whole window from the sketches of its rollup rows
+    return sketch_stats(merge_serialized(row['sketch'] for row in rows),
+                        sum(row['count'] for row in rows), sum(row['lost'] for row in rows))
+
+
+def sketch_series(rows):
+    series = {'time': [float(row['time']) for row in rows]}
+    for row in rows:
+        sketch = Sketch.from_bytes(row['sketch']) if row['sketch'] is not None else Sketch()
+        for name, value in sketch_stats(sketch, row['count'], row['lost']).items():
+            series.setdefault(name, []).append(value)
+    return series
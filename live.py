@@ -0,0 +1,184 @@
+#!/usr/bin/python
+
+import bisect
+import json
+import logging
+import math
+import socket
+import threading
+from array import array
+
+from metrics import Counter
+
+log = logging.getLogger(__name__)
+
+# The collectors send every sample they record as a small UDP datagram to the web
+# server, which keeps the most recent ones per destination and interface in fixed
+# size arrays. The live chart is served from those arrays without touching the
+# database. Datagrams that nobody receives are simply lost, the database still has
+# every sample.
+LIVE_HOST = '127.0.0.1'
+
+PING_FIELDS = ('pingtime',)
+TRAFFIC_FIELDS = ('upload', 'download', 'upload_pps', 'download_pps')
+
+SEND_FAILURES = Counter('rpi_live_send_failures_total', 'Live samples that could not be sent', ['kind'])
+
+
+class RecentSamples:
+    def __init__(self, fields, size):
+        self.fields = tuple(fields)
+        self.size = size
+        self._times = array('d', [0.0] * size)
+        self._columns = {field: array('d', [math.nan] * size) for field in self.fields}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def append(self, timestamp, values):
+        with self._lock:
+            position = self._count % self.size
+            self._times[position] = timestamp
+            for field in self.fields:
+                value = values.get(field)
+                self._columns[field][position] = math.nan if value is None else value
+            self._count += 1
+
+    def _positions(self, n):
+        n = min(n, self._count, self.size)
+        return [(self._count - n + i) % self.size for i in range(n)]
+
+    def last(self, n):
+        # Oldest to newest, one list per field, lost pings are None
+        with self._lock:
+            positions = self._positions(n)
+            data = {'time': [self._times[p] for p in positions]}
+            for field in self.fields:
+                column = self._columns[field]
+                data[field] = [None if math.isnan(column[p]) else column[p] for p in positions]
+            return data
+
+    def latest(self, at=None):
+        # The newest sample, or the newest one recorded at or before `at`
+        with self._lock:
+            positions = self._positions(self.size)
+            if at is not None:
+                times = [self._times[p] for p in positions]
+                positions = positions[:bisect.bisect_right(times, at)]
+            if not positions:
+                return None
+            p = positions[-1]
+            sample = {'time': self._times[p]}
+            for field in self.fields:
+                value = self._columns[field][p]
+                sample[field] = None if math.isnan(value) else value
+            return sample
+
+    def __len__(self):
+        return min(self._count, self.size)
+
+
+class LivePublisher:
+    # Collector side, sending never blocks and never fails
+    def __init__(self, port, host=LIVE_HOST):
+        self._address = (host, port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def publish(self, kind, key, timestamp, values):
+        message = json.dumps({'kind': kind, 'key': key, 'time': timestamp, 'values': values})
+        try:
+            self._socket.sendto(message.encode('utf-8'), self._address)
+        except OSError:
+            SEND_FAILURES.inc(kind)
+
+    def publish_ping(self, ping_entry):
+        ping_time = None if ping_entry.ping_time is None else float(ping_entry.ping_time)
+        self.publish('pings', ping_entry.destination, ping_entry.recorded_at.timestamp(), {'pingtime': ping_time})
+
+    def publish_traffic(self, traffic_entry):
+        self.publish('traffic', traffic_entry.interface, traffic_entry.timestamp.timestamp(),
+                     {'upload': traffic_entry.upload, 'download': traffic_entry.download,
+                      'upload_pps': traffic_entry.upload_pps, 'download_pps': traffic_entry.download_pps})
+
+    def close(self):
+        self._socket.close()
+
+
+class LiveSamples:
+    # Web server side: the receiving thread is started on first use, so processes
+    # that never serve a request (like the reloader parent) do not take the port
+    def __init__(self, port, size=600, host=LIVE_HOST):
+        self._address = (host, port)
+        self._size = size
+        self._series = {'pings': {}, 'traffic': {}}
+        self._fields = {'pings': PING_FIELDS, 'traffic': TRAFFIC_FIELDS}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.received = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._receive, name='live-samples', daemon=True)
+            self._thread.start()
+
+    def _receive(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            receiver.bind(self._address)
+        except OSError as err:
+            log.warning('Live samples are not available, can not listen on %s:%d: %s',
+                        self._address[0], self._address[1], err)
+            return
+        while True:
+            data, _ = receiver.recvfrom(4096)
+            try:
+                message = json.loads(data.decode('utf-8'))
+                self.series(message['kind'], message['key'], create=True).append(message['time'], message['values'])
+                self.received += 1
+            except (ValueError, KeyError, TypeError):
+                log.warning('Ignoring malformed live sample %r', data[:100])
+
+    def series(self, kind, key, create=False):
+        self.start()
+        with self._lock:
+            series = self._series[kind].get(key)
+            if series is None and create:
+                series = self._series[kind][key] = RecentSamples(self._fields[kind], self._size)
+            return series
+
+    def keys(self, kind):
+        self.start()
+        with self._lock:
+            return sorted(self._series[kind])
+
+    def last(self, kind, key, n):
+        series = self.series(kind, key)
+        if series is None:
+            return {field: [] for field in ('time',) + self._fields[kind]}
+        return series.last(n)
+
+    def latest_ping(self, at=None):
+        # Newest ping of any destination, like the chart has always shown
+        samples = [self.series('pings', destination).latest(at) for destination in self.keys('pings')]
+        samples = [sample for sample in samples if sample is not None]
+        return max(samples, key=lambda sample: sample['time']) if samples else None
+
+    def latest_traffic(self, interface, at=None):
+        series = self.series('traffic', interface)
+        return series.latest(at) if series is not None else None
+
+    def chart_points(self, interface, n):
+        # The last n one second ticks of the live chart, built from the arrays
+        traffic = self.series('traffic', interface)
+        if traffic is None or not len(traffic):
+            return []
+        newest = math.floor(traffic.latest()['time'])
+        points = []
+        for tick in range(newest - n + 1, newest + 1):
+            ping, traffic_sample = self.latest_ping(tick), traffic.latest(tick)
+            if ping is not None and traffic_sample is not None:
+                points.append({'time': tick, 'ping': ping['pingtime'],
+                               'download': traffic_sample['download'], 'upload': traffic_sample['upload']})
+        return points
@@ -0,0 +1,220 @@
+#!/usr/bin/python
+
+import http.server
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# Counters, gauges and histograms kept in process and exposed in the Prometheus
+# text format: by the /metrics route of analyze.py and, for the collectors, by
+# serve() on a port of their own. An update is a dictionary lookup and an
+# addition under a lock, cheap enough to stay on. Metrics are created once at
+# module level, labels are passed positionally in the order they were declared:
+#
+#     WRITES = Histogram('rpi_storage_write_seconds', 'Time of one batch', ['table'])
+#     with WRITES.time('pings'):
+#         ...
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Seconds, from a cached query to a slow matplotlib render on a Pi
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+log = logging.getLogger(__name__)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._functions = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError('{} takes the labels {}, got {}'.format(self.name, self.labels, labels))
+        return tuple(str(label) for label in labels)
+
+    def track(self, function, *labels):
+        # The value is function() at the time of every scrape, for numbers kept elsewhere anyway
+        with self._lock:
+            self._functions[self._key(labels)] = function
+
+    def samples(self):
+        # (name suffix, label pairs, value) of every series
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, function in functions.items():
+            try:
+                values[key] = function()
+            except Exception:
+                log.exception('Failed to read %s', self.name)
+        for key in sorted(values):
+            yield '', list(zip(self.labels, key)), values[key]
+
+    def exposition(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation.replace('\\', '\\\\').replace('\n', '\\n')),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, pairs, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, _format_labels(pairs), _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Non-cumulative count per bucket and +Inf, then the sum
+                series = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            index = 0
+            while index < len(self.buckets) and value > self.buckets[index]:
+                index += 1
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def track(self, function, *labels):
+        raise TypeError('Histograms can not be tracked')
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(series) for key, series in self._values.items()}
+        for key in sorted(values):
+            series = values[key]
+            pairs = list(zip(self.labels, key))
+            count = 0
+            for bound, observations in zip(self.buckets + (float('inf'),), series):
+                count += observations
+                yield '_bucket', pairs + [('le', _format_value(float(bound)))], count
+            yield '_sum', pairs, series[-1]
+            yield '_count', pairs, count
+
+
+def exposition():
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.exposition())
+    return '\n'.join(lines) + '\n'
+
+
+# Counted wherever a program is started, so a loop forking tc or nmcli shows up
+SUBPROCESSES = Counter('rpi_subprocesses_total', 'Child processes started', ['command'])
+
+
+def _resident_bytes():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+PROCESS_START = Gauge('process_start_time_seconds', 'Start time of the process since the epoch')
+PROCESS_START.set(time.time())
+PROCESS_CPU = Counter('process_cpu_seconds_total', 'User and system CPU time spent')
+PROCESS_CPU.track(lambda: sum(os.times()[:2]))
+PROCESS_MEMORY = Gauge('process_resident_memory_bytes', 'Resident memory size')
+PROCESS_MEMORY.track(_resident_bytes)
+PROCESS_THREADS = Gauge('rpi_threads', 'Python threads alive')
+PROCESS_THREADS.track(threading.active_count)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, message_format, *args):
+        pass
+
+
+def serve(port, host='0.0.0.0'):
+    # For processes without a web server of their own. Port 0 switches it off,
+    # a port in use only costs the metrics, never the process.
+    if not port:
+        return None
+    try:
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as err:
+        log.warning('Metrics are not served on port %d: %s', port, err)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+
+import time
+from collections import namedtuple
+
+# Kernel interface counters, read straight from /proc/net/dev instead of running ifstat
+Counters = namedtuple('Counters', ['rx_bytes', 'rx_packets', 'rx_errors', 'rx_drops',
+                                   'tx_bytes', 'tx_packets', 'tx_errors', 'tx_drops'])
+
+Rates = namedtuple('Rates', ['timestamp', 'interval', 'rx_mbps', 'tx_mbps', 'rx_pps', 'tx_pps',
+                             'rx_errors', 'tx_errors', 'rx_drops', 'tx_drops'])
+
+PROC_NET_DEV = '/proc/net/dev'
+
+
+def read_counters(path=PROC_NET_DEV):
+    counters = {}
+    with open(path, 'r') as net_dev:
+        # The first two lines are the table header
+        for line in net_dev.readlines()[2:]:
+            interface, _, values = line.partition(':')
+            fields = [int(value) for value in values.split()]
+            counters[interface.strip()] = Counters(*(fields[0:4] + fields[8:12]))
+    return counters
+
+
+def _delta(current, previous):
+    # Counters can be reset when the interface goes down and up again
+    return current - previous if current >= previous else current
+
+
+class RateSampler:
+    def __init__(self, interface, path=PROC_NET_DEV):
+        self.interface = interface
+        self._path = path
+        self._previous = None
+        self._previous_time = None
+
+    def update(self, counters, now):
+        # Returns the rates since the previous update, None on the first update
+        # or while the interface does not exist. Errors and drops are counts
+        # within the interval, everything else is per second.
+        previous, previous_time = self._previous, self._previous_time
+        self._previous, self._previous_time = counters, now
+        if counters is None or previous is None or now <= previous_time:
+            return None
+        interval = now - previous_time
+
+        def per_second(field):
+            return _delta(getattr(counters, field), getattr(previous, field)) / interval
+
+        return Rates(timestamp=time.time(),
+                     interval=interval,
+                     rx_mbps=per_second('rx_bytes') * 8 / 1000000,
+                     tx_mbps=per_second('tx_bytes') * 8 / 1000000,
+                     rx_pps=per_second('rx_packets'),
+                     tx_pps=per_second('tx_packets'),
+                     rx_errors=_delta(counters.rx_errors, previous.rx_errors),
+                     tx_errors=_delta(counters.tx_errors, previous.tx_errors),
+                     rx_drops=_delta(counters.rx_drops, previous.rx_drops),
+                     tx_drops=_delta(counters.tx_drops, previous.tx_drops))
+
+    def sample(self):
+        return self.update(read_counters(self._path).get(self.interface), time.monotonic())
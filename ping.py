@@ -1,25 +1,42 @@
 #!/usr/bin/python
 
-import re
-import subprocess
+import asyncio
+import logging
+import random
+import signal
 import sys
+from collections import namedtuple
+from datetime import datetime, timezone
 
-import psycopg2
-
+import metrics
 from bin.params import ParameterHandler
-
+from live import LivePublisher
+from metrics import Counter, Histogram
+from probes import LOST, Prober
+from storage import open_storage
+
+# Usage: ping.py [host ...]
+# Runs as a resident service probing the TARGETS of config.json, or the hosts
+# given on the command line with ICMP once a second. Every target is probed on
+# its own schedule by one asyncio loop, no `ping` processes are started.
+Target = namedtuple('Target', ['name', 'protocol', 'host', 'port', 'url', 'interval', 'size', 'timeout'])
+
+PROTOCOLS = ('icmp', 'tcp', 'http')
+DEFAULT_INTERVAL = 1.0
+DEFAULT_SIZE = 56
+DEFAULT_PORT = 443
+
+log = logging.getLogger(__name__)
 ph = ParameterHandler()
 
-# Usage: ping.py [host]
-if len(sys.argv) != 2:
-    print("Usage: ping.py [host]")
-    exit(1)
-
-host = sys.argv[1]
+PROBES = Counter('rpi_ping_probes_total', 'Probes sent', ['target', 'result'])
+INSERT_SECONDS = Histogram('rpi_ping_insert_seconds', 'Time of insert_into_db, queueing a sample and publishing it')
 
 
 class Ping:
-    def __init__(self, destination, ping_time, time_to_live, bytes_rcv):
+    def __init__(self, destination, ping_time, time_to_live, bytes_rcv, recorded_at=None):
+        # Samples are written in batches, so the time is taken here and not by the column default
+        self.recorded_at = recorded_at or datetime.now(timezone.utc)
         self.destination = destination
         self.ping_time = ping_time
         self.ttl = time_to_live
@@ -30,45 +47,98 @@ class Ping:
             .format(self.bytes, self.destination, self.ping_time, self.ttl)
 
 
-# For details: http://initd.org/psycopg/docs/module.html#psycopg2.connect
+pings_buffer = open_storage().ping_writer()
+# The web server keeps the latest samples in memory for the live chart
+live_feed = LivePublisher(ph.live_port)
+
+
 def insert_into_db(ping_entry):
-    with psycopg2.connect(database=ph.db_name,
-                          user=ph.db_username,
-                          password=ph.db_password,
-                          host='0.0.0.0') as conn:
-        # There is no need for transactions here, no risk of inconsistency etc
-        conn.autocommit = True
-
-        cursor = conn.cursor()
-
-        sql_command = """
-            INSERT INTO 
-              pings
-              (destination, bytes_received, ttl, pingtime)
-            VALUES
-              (%s, %s, %s, %s);
-        """
-
-        cursor.execute(sql_command, (ping_entry.destination, ping_entry.bytes, ping_entry.ttl, ping_entry.ping_time))
-        cursor.close()
-
-
-# Do the pings
-with subprocess.Popen(['ping', host, '-c', '60'],
-                      stdout=subprocess.PIPE,
-                      bufsize=1,
-                      universal_newlines=True) as p:
-    for line in p.stdout:
-        line = line.strip()
-        if 'PING' not in line and 'statistics' not in line and 'transmitted' not in line and 'rtt' not in line:
-            parts = re.search(r'(\d+) bytes from .* ttl=(\d+) time=(\d+\.?\d*) ms', line)
-            if parts:
-                bytes_received = parts.group(1)
-                ttl = parts.group(2)
-                time = parts.group(3)
-
-                ping = Ping(host, time, ttl, bytes_received)
-                insert_into_db(ping)
-            else:
-                ping = Ping(host, None, None, None)
-                insert_into_db(ping)
+    with INSERT_SECONDS.time():
+        pings_buffer.add(ping_entry)
+        live_feed.publish_ping(ping_entry)
+
+
+def load_target(config):
+    protocol = config.get('protocol', 'icmp')
+    if protocol not in PROTOCOLS:
+        raise ValueError('Unknown protocol {} of target {}'.format(protocol, config.get('host')))
+    host, port, url = config['host'], config.get('port', DEFAULT_PORT), None
+    if protocol == 'http':
+        url = host if '://' in host else 'http://' + host + '/'
+        name = 'http:' + url.split('://', 1)[1].split('/', 1)[0]
+    elif protocol == 'tcp':
+        name = 'tcp:{}:{}'.format(host, port)
+    else:
+        name = host
+    interval = float(config.get('interval', DEFAULT_INTERVAL))
+    # A probe never outlives its interval, so a target has at most one probe in flight
+    timeout = min(float(config.get('timeout', interval)), interval)
+    return Target(name=config.get('name', name), protocol=protocol, host=host, port=port, url=url,
+                  interval=interval, size=int(config.get('size', DEFAULT_SIZE)), timeout=timeout)
+
+
+async def schedule(prober, target):
+    # Targets start at random offsets within their interval, so their probes are
+    # spread out instead of going out together
+    loop = asyncio.get_event_loop()
+    await asyncio.sleep(random.uniform(0, target.interval))
+    next_probe = loop.time()
+    while True:
+        recorded_at = datetime.now(timezone.utc)
+        try:
+            result = await prober.probe(target)
+        except PermissionError:
+            # No ICMP socket of either kind, no later probe will do better
+            raise
+        except Exception:
+            log.exception('Probe of %s failed', target.name)
+            result = LOST
+        rtt = round(result.rtt, 3) if result.rtt is not None else None
+        PROBES.inc(target.name, 'lost' if rtt is None else 'reply')
+        try:
+            insert_into_db(Ping(target.name, rtt, result.ttl, result.bytes, recorded_at=recorded_at))
+        except Exception:
+            log.exception('Failed to record the probe of %s', target.name)
+        next_probe += target.interval
+        await asyncio.sleep(max(0.0, next_probe - loop.time()))
+
+
+async def run(targets):
+    loop = asyncio.get_event_loop()
+    prober = Prober(loop)
+    probes = [asyncio.ensure_future(schedule(prober, target)) for target in targets]
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: [p.cancel() for p in probes])
+    try:
+        # A target that can not be probed at all takes the service down, so
+        # systemd restarts it and the error ends up in the journal
+        await asyncio.gather(*probes)
+    except asyncio.CancelledError:
+        # SIGINT or SIGTERM
+        pass
+    finally:
+        for probe in probes:
+            probe.cancel()
+        prober.close()
+
+
+def main(targets):
+    metrics.serve(ph.ping_metrics_port)
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(run(targets))
+    finally:
+        pings_buffer.close()
+        loop.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        targets = [load_target({'host': host}) for host in sys.argv[1:]]
+    else:
+        targets = [load_target(config) for config in ph.targets]
+    if not targets:
+        print("Usage: ping.py [host ...], or configure TARGETS in bin/config.json")
+        exit(1)
+
+    main(targets)
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+
+import asyncio
+import itertools
+import os
+import socket
+import ssl
+import struct
+import time
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+# Probes measure one round trip and return a ProbeResult, with rtt None when the
+# target did not answer within the timeout. They all share the event loop of
+# ping.py, so any number of targets costs one process and a few sockets.
+ProbeResult = namedtuple('ProbeResult', ['rtt', 'ttl', 'bytes'])
+
+LOST = ProbeResult(None, None, None)
+
+# Resolved addresses are kept this long, so a probe per second does not mean a DNS query per second
+RESOLVE_INTERVAL = 300
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMP_HEADER = struct.Struct('!BBHHH')
+# Linux socket option asking for the TTL of received packets as ancillary data
+IP_RECVTTL = getattr(socket, 'IP_RECVTTL', 12)
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!{}H'.format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+class Resolver:
+    def __init__(self, loop):
+        self._loop = loop
+        self._addresses = {}
+
+    async def resolve(self, host):
+        address, resolved_at = self._addresses.get(host, (None, 0))
+        if address is None or time.monotonic() - resolved_at > RESOLVE_INTERVAL:
+            infos = await self._loop.getaddrinfo(host, None, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            address = infos[0][4][0]
+            self._addresses[host] = (address, time.monotonic())
+        return address
+
+
+class IcmpSocket:
+    # One socket for every ICMP target, replies are matched to requests by
+    # address and sequence number. Unprivileged ICMP sockets need the user's group
+    # in net.ipv4.ping_group_range, otherwise a raw socket is used, which needs
+    # CAP_NET_RAW (see ping.service).
+    def __init__(self, loop):
+        self._loop = loop
+        self._waiting = {}
+        self._sequence = itertools.count()
+        try:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self.raw = False
+        except PermissionError:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self.raw = True
+        # The kernel picks the identifier of unprivileged sockets, raw ones use our own
+        self._identifier = os.getpid() & 0xffff
+        self._socket.setblocking(False)
+        self._socket.setsockopt(socket.IPPROTO_IP, IP_RECVTTL, 1)
+        loop.add_reader(self._socket.fileno(), self._receive)
+
+    def _receive(self):
+        while True:
+            try:
+                packet, ancillary, _, (address, _) = self._socket.recvmsg(65535, socket.CMSG_SPACE(4))
+            except (BlockingIOError, InterruptedError):
+                return
+            ttl = None
+            if self.raw:
+                # Raw sockets see the IP header and every ICMP packet of the host
+                ttl = packet[8]
+                packet = packet[(packet[0] & 0x0f) * 4:]
+            for level, kind, data in ancillary:
+                if level == socket.IPPROTO_IP and kind == socket.IP_TTL:
+                    ttl = struct.unpack('i', data[:4])[0]
+            if len(packet) < ICMP_HEADER.size:
+                continue
+            icmp_type, _, _, identifier, sequence = ICMP_HEADER.unpack_from(packet)
+            if icmp_type != ICMP_ECHO_REPLY or (self.raw and identifier != self._identifier):
+                continue
+            waiter = self._waiting.pop((address, sequence), None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result((time.perf_counter(), ttl, len(packet)))
+
+    async def ping(self, address, size, timeout):
+        sequence = next(self._sequence) & 0xffff
+        payload = os.urandom(size)
+        header = ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, self._identifier, sequence)
+        if self.raw:
+            header = ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, _checksum(header + payload), self._identifier, sequence)
+        waiter = self._waiting[(address, sequence)] = self._loop.create_future()
+        try:
+            sent_at = time.perf_counter()
+            self._socket.sendto(header + payload, (address, 0))
+            received_at, ttl, received = await asyncio.wait_for(waiter, timeout)
+            return ProbeResult((received_at - sent_at) * 1000, ttl, received)
+        except (asyncio.TimeoutError, OSError):
+            return LOST
+        finally:
+            self._waiting.pop((address, sequence), None)
+
+    def close(self):
+        self._loop.remove_reader(self._socket.fileno())
+        self._socket.close()
+
+
+async def tcp_connect(host, port, timeout):
+    # Round trip of the TCP handshake
+    started = time.perf_counter()
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (asyncio.TimeoutError, OSError):
+        return LOST
+    rtt = (time.perf_counter() - started) * 1000
+    writer.close()
+    return ProbeResult(rtt, None, None)
+
+
+async def http_head(url, timeout):
+    # Time until the status line of a HEAD request arrives, connection setup included
+    parts = urlsplit(url)
+    secure = parts.scheme == 'https'
+    port = parts.port or (443 if secure else 80)
+    request = 'HEAD {} HTTP/1.1\r\nHost: {}\r\nConnection: close\r\nUser-Agent: raspberrybridge\r\n\r\n' \
+        .format(parts.path or '/', parts.hostname)
+    started = time.perf_counter()
+
+    async def exchange():
+        reader, writer = await asyncio.open_connection(parts.hostname, port,
+                                                       ssl=ssl.create_default_context() if secure else None)
+        try:
+            writer.write(request.encode('ascii'))
+            status_line = await reader.readline()
+        finally:
+            writer.close()
+        return status_line
+
+    try:
+        status_line = await asyncio.wait_for(exchange(), timeout)
+    except (asyncio.TimeoutError, OSError, ssl.SSLError):
+        return LOST
+    if not status_line.startswith(b'HTTP/'):
+        return LOST
+    return ProbeResult((time.perf_counter() - started) * 1000, None, len(status_line))
+
+
+class Prober:
+    def __init__(self, loop):
+        self._loop = loop
+        self._resolver = Resolver(loop)
+        self._icmp = None
+
+    async def probe(self, target):
+        if target.protocol == 'http':
+            return await http_head(target.url, target.timeout)
+        try:
+            address = await self._resolver.resolve(target.host)
+        except OSError:
+            return LOST
+        if target.protocol == 'tcp':
+            return await tcp_connect(address, target.port, target.timeout)
+        if self._icmp is None:
+            self._icmp = IcmpSocket(self._loop)
+        return await self._icmp.ping(address, target.size, target.timeout)
+
+    def close(self):
+        if self._icmp is not None:
+            self._icmp.close()
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+
+log = logging.getLogger(__name__)
+
+# value is what render returned, body its serialized form
+Rendered = namedtuple('Rendered', ['body', 'etag', 'last_modified', 'expires', 'value'])
+
+
+class RenderCache:
+    # Caches rendered graphs per (name, arguments, time bucket). A bucket is ttl
+    # seconds long, so every graph is drawn at most once per bucket no matter how
+    # many viewers ask for it. Graphs requested within the last keep_warm seconds
+    # are re-drawn by a background thread right after each bucket starts, so
+    # viewers are served from the cache instead of waiting for matplotlib. Only
+    # the max_entries most recently requested ones are kept warm, arguments come
+    # from the URL and any number of them could keep the Pi drawing otherwise.
+    # Renders that return something other than bytes are kept as they are and
+    # serialized once for the body.
+    def __init__(self, ttl=60, max_entries=32, keep_warm=300, refresh_delay=5, serialize=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.keep_warm = keep_warm
+        # Collectors flush every few seconds, give the last minute time to arrive
+        self.refresh_delay = refresh_delay
+        self.serialize = serialize
+        self._entries = OrderedDict()
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._render_lock = threading.Lock()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+
+    def _bucket(self, now):
+        return int(now // self.ttl)
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _render(self, key, bucket, render):
+        # Rendering is CPU bound, one at a time is all a Pi can take anyway, and
+        # concurrent requests for the same graph find it cached once they get the lock
+        with self._render_lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                return entry
+            value = render()
+            body = value if self.serialize is None else self.serialize(value)
+            entry = Rendered(body=body,
+                             etag=hashlib.md5(body).hexdigest(),
+                             last_modified=datetime.now(timezone.utc).replace(microsecond=0),
+                             expires=(bucket + 1) * self.ttl,
+                             value=value)
+            self._store(key, entry)
+            return entry
+
+    def get(self, name, args, render):
+        now = time.time()
+        bucket = self._bucket(now)
+        key = (name, args, bucket)
+        with self._lock:
+            self._recent[(name, args)] = (render, now)
+            self._recent.move_to_end((name, args))
+            while len(self._recent) > self.max_entries:
+                self._recent.popitem(last=False)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._refresh, name='render-cache', daemon=True)
+                self._thread.start()
+        entry = self._lookup(key)
+        with self._lock:
+            if entry is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is not None:
+            return entry
+        return self._render(key, bucket, render)
+
+    def _refresh(self):
+        while True:
+            now = time.time()
+            time.sleep((self._bucket(now) + 1) * self.ttl + self.refresh_delay - now)
+            now = time.time()
+            bucket = self._bucket(now)
+            with self._lock:
+                self._recent = OrderedDict((graph, recent) for graph, recent in self._recent.items()
+                                           if now - recent[1] <= self.keep_warm)
+                graphs = list(self._recent.items())
+            for (name, args), (render, _) in graphs:
+                try:
+                    self._render((name, args, bucket), bucket, render)
+                except Exception:
+                    log.exception('Failed to refresh %s %s', name, args)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'warm': len(self._recent), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,324 @@
+#!/usr/bin/python
+
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from datetime import datetime
+
+import numpy
+
+from rollups import RESOLUTIONS
+from sketch import Sketch
+
+# Embedded storage backend: one file per destination and per interface, each a
+# fixed size ring of fixed size binary records. The collectors append to a shared
+# memory mapping, the web server maps the same files read only and looks at the
+# records in place through numpy, without copying them or asking a server.
+#
+# File layout: a 64 byte header followed by `capacity` records. Records are
+# appended in time order, so the oldest one sits right after the newest one once
+# the ring has wrapped and the time column of each half is sorted, which is the
+# whole time index a range scan needs.
+HEADER = struct.Struct('<8sIIQ40s')
+MAGIC = b'RPIRING1'
+COUNT_OFFSET = 16
+
+PING_RECORD = numpy.dtype([('time', '<f8'), ('pingtime', '<f4'), ('ttl', '<u2'), ('bytes', '<u2')])
+TRAFFIC_RECORD = numpy.dtype([('time', '<f8'), ('upload', '<f4'), ('download', '<f4'),
+                              ('upload_pps', '<f4'), ('download_pps', '<f4'),
+                              ('errors', '<u4'), ('drops', '<u4')])
+# Speedtests are rare, their ring is small. Failed tests have NaN rates, reason
+# and error message are not kept.
+SPEEDTEST_RECORD = numpy.dtype([('time', '<f8'), ('duration', '<f4'), ('ping', '<f4'), ('download', '<f4'),
+                                ('upload', '<f4')])
+SPEEDTEST_CAPACITY = 10000
+
+
+def _file_name(kind, name):
+    return '{}-{}.ring'.format(kind, re.sub(r'[^A-Za-z0-9._-]', '_', name))
+
+
+class RingFile:
+    def __init__(self, path, dtype, capacity=None, name='', writable=False):
+        self.path = path
+        self.dtype = dtype
+        if writable and not os.path.exists(path):
+            self._create(path, dtype, capacity, name)
+        self._file = open(path, 'r+b' if writable else 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        magic, record_size, self.capacity, _, name = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or record_size != dtype.itemsize:
+            raise ValueError('{} is not a ring file of {} byte records'.format(path, dtype.itemsize))
+        self.name = name.rstrip(b'\0').decode('utf-8')
+        self._records = numpy.frombuffer(self._mmap, dtype=dtype, count=self.capacity, offset=HEADER.size)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _create(path, dtype, capacity, name):
+        # Written aside and renamed, readers never see a half initialised file
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as ring_file:
+            ring_file.write(HEADER.pack(MAGIC, dtype.itemsize, capacity, 0, name.encode('utf-8')[:40]))
+            ring_file.truncate(HEADER.size + capacity * dtype.itemsize)
+        os.replace(temporary, path)
+
+    @property
+    def count(self):
+        return struct.unpack_from('<Q', self._mmap, COUNT_OFFSET)[0]
+
+    def append(self, values):
+        with self._lock:
+            count = self.count
+            self._records[count % self.capacity] = values
+            # The counter is bumped only after the record is complete
+            struct.pack_into('<Q', self._mmap, COUNT_OFFSET, count + 1)
+
+    def segments(self):
+        # Oldest to newest, at most two views into the mapping
+        count = self.count
+        if count <= self.capacity:
+            return [self._records[:count]]
+        head = count % self.capacity
+        return [self._records[head:], self._records[:head]]
+
+    def range(self, start, end=math.inf):
+        parts = []
+        for segment in self.segments():
+            times = segment['time']
+            parts.append(segment[numpy.searchsorted(times, start, 'left'):numpy.searchsorted(times, end, 'left')])
+        return parts[0] if len(parts) == 1 else numpy.concatenate(parts)
+
+    def last(self):
+        count = self.count
+        return self._records[(count - 1) % self.capacity] if count else None
+
+    def flush(self):
+        self._mmap.flush()
+
+    def close(self):
+        self._records = None
+        self._mmap.close()
+        self._file.close()
+
+
+class RingWriter:
+    def __init__(self, store, kind, dtype, key, to_record):
+        self._store = store
+        self._kind = kind
+        self._dtype = dtype
+        self._key = key
+        self._to_record = to_record
+        self.written = 0
+        self.dropped = 0
+
+    def add(self, entry, block=False):
+        # Appending never waits, block is there for the interface of db.WriteBuffer
+        self._store.ring(self._kind, self._key(entry), self._dtype, writable=True).append(self._to_record(entry))
+        self.written += 1
+
+    def close(self):
+        self._store.close()
+
+
+def _float(value):
+    # Records hold single precision floats, rounding keeps them looking like the measured values
+    return None if value is None or math.isnan(value) or math.isinf(value) else round(float(value), 3)
+
+
+def _buckets(times, seconds):
+    # Start of every bucket present and the index of its first record
+    buckets = numpy.floor(times / seconds) * seconds
+    starts = numpy.flatnonzero(numpy.r_[True, buckets[1:] != buckets[:-1]]) if len(buckets) else numpy.array([], int)
+    return buckets[starts], starts
+
+
+class RingStore:
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self._rings = {}
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def ring(self, kind, name, dtype, writable=False, capacity=None):
+        key = (kind, name, writable)
+        with self._lock:
+            ring = self._rings.get(key)
+            if ring is None:
+                path = os.path.join(self.path, _file_name(kind, name))
+                if not writable and not os.path.exists(path):
+                    return None
+                ring = self._rings[key] = RingFile(path, dtype, capacity or self.capacity, name, writable)
+            return ring
+
+    def _rings_of(self, kind, dtype):
+        for file_name in sorted(os.listdir(self.path)):
+            if file_name.startswith(kind + '-') and file_name.endswith('.ring'):
+                # File names are sanitised, the real name is kept in the header
+                with open(os.path.join(self.path, file_name), 'rb') as ring_file:
+                    name = HEADER.unpack(ring_file.read(HEADER.size))[4]
+                ring = self.ring(kind, name.rstrip(b'\0').decode('utf-8'), dtype)
+                if ring is not None:
+                    yield ring
+
+    def ping_writer(self):
+        return RingWriter(self, 'pings', PING_RECORD, lambda ping_entry: ping_entry.destination,
+                          lambda ping_entry: (ping_entry.recorded_at.timestamp(),
+                                              math.nan if ping_entry.ping_time is None else float(ping_entry.ping_time),
+                                              int(ping_entry.ttl or 0),
+                                              int(ping_entry.bytes or 0)))
+
+    def traffic_writer(self):
+        return RingWriter(self, 'traffic', TRAFFIC_RECORD, lambda traffic_entry: traffic_entry.interface,
+                          lambda traffic_entry: (traffic_entry.timestamp.timestamp(),
+                                                 traffic_entry.upload, traffic_entry.download,
+                                                 traffic_entry.upload_pps, traffic_entry.download_pps,
+                                                 traffic_entry.errors or 0, traffic_entry.drops or 0))
+
+    @staticmethod
+    def _window_start(hours, resolution, since):
+        # Same buckets the rollup queries return: the ones starting inside the window
+        seconds = RESOLUTIONS[resolution]
+        start = max(time.time() - hours * 3600, since or 0)
+        return math.ceil(start / seconds) * seconds
+
+    def ping_snapshot(self, hours):
+        rows = []
+        for ring in self._rings_of('pings', PING_RECORD):
+            rows.extend(self.ping_history(ring.name, hours, 'minute'))
+        return rows
+
+    def ping_history(self, destination, hours, resolution, since=None):
+        ring = self.ring('pings', destination, PING_RECORD)
+        if ring is None:
+            return []
+        records = ring.range(self._window_start(hours, resolution, since))
+        buckets, starts = _buckets(records['time'], RESOLUTIONS[resolution])
+        if not len(buckets):
+            return []
+        pingtimes = records['pingtime'].astype(numpy.float64)
+        replied = ~numpy.isnan(pingtimes)
+        replies = numpy.add.reduceat(replied, starts)
+        totals = numpy.add.reduceat(numpy.where(replied, pingtimes, 0.0), starts)
+        lows = numpy.minimum.reduceat(numpy.where(replied, pingtimes, numpy.inf), starts)
+        highs = numpy.maximum.reduceat(numpy.where(replied, pingtimes, -numpy.inf), starts)
+        counts = numpy.diff(numpy.r_[starts, len(records)])
+        return [{'time': float(bucket),
+                 'begin_time': datetime.fromtimestamp(bucket),
+                 'destination': destination,
+                 'count': int(replies[i]),
+                 'lost': int(counts[i] - replies[i]),
+                 'avg': round(float(totals[i] / replies[i]), 2) if replies[i] else None,
+                 'max': _float(highs[i]),
+                 'min': _float(lows[i])}
+                for i, bucket in enumerate(buckets)]
+
+    def traffic_history(self, interface, hours, resolution, since=None):
+        ring = self.ring('traffic', interface, TRAFFIC_RECORD)
+        if ring is None:
+            return []
+        records = ring.range(self._window_start(hours, resolution, since))
+        buckets, starts = _buckets(records['time'], RESOLUTIONS[resolution])
+        if not len(buckets):
+            return []
+        counts = numpy.diff(numpy.r_[starts, len(records)])
+        series = {}
+        for column in ('upload', 'download'):
+            values = records[column].astype(numpy.float64)
+            series[column] = numpy.add.reduceat(values, starts) / counts
+            series[column + '_max'] = numpy.maximum.reduceat(values, starts)
+        return [dict({column: round(float(values[i]), 2) for column, values in series.items()},
+                     time=float(bucket), recorded_at=datetime.fromtimestamp(bucket))
+                for i, bucket in enumerate(buckets)]
+
+    def ping_sketches(self, destination, hours, resolution):
+        ring = self.ring('pings', destination, PING_RECORD)
+        if ring is None:
+            return []
+        records = ring.range(self._window_start(hours, resolution, None))
+        buckets, starts = _buckets(records['time'], RESOLUTIONS[resolution])
+        ends = numpy.r_[starts[1:], len(records)]
+        rows = []
+        for bucket, start, end in zip(buckets, starts, ends):
+            pingtimes = records['pingtime'][start:end]
+            rows.append({'time': float(bucket),
+                         'count': int(end - start),
+                         'lost': int(numpy.isnan(pingtimes).sum()),
+                         'sketch': Sketch.of(pingtimes).to_bytes()})
+        return rows
+
+    def destination_sketches(self, hours, resolution):
+        return {ring.name: self.ping_sketches(ring.name, hours, resolution)
+                for ring in self._rings_of('pings', PING_RECORD)}
+
+    def destination_samples(self, seconds):
+        return {ring.name: self.ping_samples(ring.name, seconds) for ring in self._rings_of('pings', PING_RECORD)}
+
+    def ping_samples(self, destination, seconds):
+        ring = self.ring('pings', destination, PING_RECORD)
+        if ring is None:
+            return numpy.array([]), numpy.array([])
+        records = ring.range(time.time() - seconds)
+        return records['time'], records['pingtime'].astype(numpy.float64)
+
+    def traffic_samples(self, interface, seconds):
+        ring = self.ring('traffic', interface, TRAFFIC_RECORD)
+        if ring is None:
+            return numpy.array([]), numpy.array([]), numpy.array([])
+        records = ring.range(time.time() - seconds)
+        return records['time'], records['upload'].astype(numpy.float64), records['download'].astype(numpy.float64)
+
+    def packet_loss(self, destination):
+        ring = self.ring('pings', destination, PING_RECORD)
+        if ring is None:
+            return {'lost': 0, 'count': 0}
+        pingtimes = ring.range(time.time() - 3600)['pingtime']
+        return {'lost': int(numpy.isnan(pingtimes).sum()), 'count': len(pingtimes)}
+
+    def latest_ping(self):
+        latest = None
+        for ring in self._rings_of('pings', PING_RECORD):
+            record = ring.last()
+            if record is not None and (latest is None or record['time'] > latest['time']):
+                latest = record
+        if latest is None:
+            return None
+        return {'time': float(latest['time']), 'pingtime': _float(latest['pingtime'])}
+
+    def latest_traffic(self, interface):
+        ring = self.ring('traffic', interface, TRAFFIC_RECORD)
+        record = ring.last() if ring is not None else None
+        if record is None:
+            return None
+        return {'recorded_at': datetime.fromtimestamp(record['time']),
+                'download': _float(record['download']),
+                'upload': _float(record['upload'])}
+
+    def save_speedtest(self, job):
+        ring = self.ring('speedtests', 'results', SPEEDTEST_RECORD, writable=True, capacity=SPEEDTEST_CAPACITY)
+        ring.append((job['started_at'], job['duration'],
+                     *(math.nan if job[phase] is None else job[phase] for phase in ('ping', 'download', 'upload'))))
+
+    def speedtests(self, hours):
+        ring = self.ring('speedtests', 'results', SPEEDTEST_RECORD)
+        if ring is None:
+            return []
+        return [{'time': record['time'], 'duration': _float(record['duration']), 'reason': None,
+                 'ping': _float(record['ping']), 'download': _float(record['download']),
+                 'upload': _float(record['upload']), 'error': None}
+                for record in ring.range(time.time() - hours * 3600)]
+
+    def stats(self):
+        with self._lock:
+            return {'path': self.path, 'capacity': self.capacity, 'open_files': len(self._rings)}
+
+    def close(self):
+        with self._lock:
+            for ring in self._rings.values():
+                ring.flush()
+                ring.close()
+            self._rings = {}
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+
+from decimal import Decimal
+
+import psycopg2
+import psycopg2.extras
+
+from sketch import Sketch
+
+# Per minute and per hour aggregates of pings and traffic. They are maintained by
+# the collectors' write buffers in the same transaction as the raw rows, so the
+# graphs read a handful of rows instead of scanning the raw tables. Ping rollups
+# also keep a quantile sketch of their ping times, see sketch.py.
+RESOLUTIONS = {'minute': 60, 'hour': 3600}
+
+
+def rollup_resolution(hours):
+    # Minute buckets up to a day, beyond that hourly ones keep the number of points small
+    return 'minute' if hours <= 24 else 'hour'
+
+
+def _bucket(timestamp, resolution):
+    if resolution == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(second=0, microsecond=0)
+
+
+def _number(value):
+    return None if value is None else Decimal(str(value))
+
+
+def _least(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _greatest(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+def aggregate_pings(entries, resolution):
+    buckets = {}
+    for entry in entries:
+        key = (entry.destination, _bucket(entry.recorded_at, resolution))
+        count, lost, total, low, high = buckets.get(key, (0, 0, Decimal(0), None, None))
+        ping_time = _number(entry.ping_time)
+        if ping_time is None:
+            buckets[key] = (count + 1, lost + 1, total, low, high)
+        else:
+            buckets[key] = (count + 1, lost, total + ping_time, _least(low, ping_time), _greatest(high, ping_time))
+    return [key + values for key, values in buckets.items()]
+
+
+def sketch_pings(entries, resolution):
+    values = {}
+    for entry in entries:
+        key = (entry.destination, _bucket(entry.recorded_at, resolution))
+        values.setdefault(key, []).append(float('nan') if entry.ping_time is None else float(entry.ping_time))
+    return {key: Sketch.of(pingtimes) for key, pingtimes in values.items()}
+
+
+def aggregate_traffic(entries, resolution):
+    buckets = {}
+    for entry in entries:
+        key = (entry.interface, _bucket(entry.timestamp, resolution))
+        count, up_sum, up_max, down_sum, down_max, errors, drops = \
+            buckets.get(key, (0, Decimal(0), None, Decimal(0), None, 0, 0))
+        upload, download = _number(round(entry.upload, 2)), _number(round(entry.download, 2))
+        buckets[key] = (count + 1,
+                        up_sum + upload, _greatest(up_max, upload),
+                        down_sum + download, _greatest(down_max, download),
+                        errors + (entry.errors or 0), drops + (entry.drops or 0))
+    return [key + values for key, values in buckets.items()]
+
+
+UPSERT_PINGS = """
+    INSERT INTO pings_{resolution} AS r
+      (destination, bucket, count, lost, pingtime_sum, pingtime_min, pingtime_max, pingtime_sketch)
+    VALUES %s
+    ON CONFLICT (destination, bucket) DO UPDATE SET
+      count = r.count + EXCLUDED.count,
+      lost = r.lost + EXCLUDED.lost,
+      pingtime_sum = r.pingtime_sum + EXCLUDED.pingtime_sum,
+      pingtime_min = LEAST(r.pingtime_min, EXCLUDED.pingtime_min),
+      pingtime_max = GREATEST(r.pingtime_max, EXCLUDED.pingtime_max),
+      pingtime_sketch = EXCLUDED.pingtime_sketch;
+"""
+
+# Sketches can not be added up in SQL, the stored ones are merged here with the
+# new samples. The rows stay locked until the batch is committed.
+SELECT_PING_SKETCHES = """
+    SELECT destination, bucket, pingtime_sketch
+    FROM pings_{resolution}
+    WHERE (destination, bucket) IN %s
+    FOR UPDATE;
+"""
+
+UPSERT_TRAFFIC = """
+    INSERT INTO traffic_{resolution} AS r
+      (interface, bucket, count, upload_sum, upload_max, download_sum, download_max, errors, drops)
+    VALUES %s
+    ON CONFLICT (interface, bucket) DO UPDATE SET
+      count = r.count + EXCLUDED.count,
+      upload_sum = r.upload_sum + EXCLUDED.upload_sum,
+      upload_max = GREATEST(r.upload_max, EXCLUDED.upload_max),
+      download_sum = r.download_sum + EXCLUDED.download_sum,
+      download_max = GREATEST(r.download_max, EXCLUDED.download_max),
+      errors = r.errors + EXCLUDED.errors,
+      drops = r.drops + EXCLUDED.drops;
+"""
+
+
+def rollup_pings(cursor, entries):
+    if not entries:
+        return
+    for resolution in RESOLUTIONS:
+        sketches = sketch_pings(entries, resolution)
+        cursor.execute(SELECT_PING_SKETCHES.format(resolution=resolution), (tuple(sketches),))
+        for destination, bucket, stored in cursor.fetchall():
+            if stored is not None:
+                key = (destination, bucket)
+                sketches[key] = sketches[key].merge(Sketch.from_bytes(stored))
+        rows = [row + (psycopg2.Binary(sketches[row[:2]].to_bytes()),) for row in aggregate_pings(entries, resolution)]
+        psycopg2.extras.execute_values(cursor, UPSERT_PINGS.format(resolution=resolution), rows)
+
+
+def rollup_traffic(cursor, entries):
+    for resolution in RESOLUTIONS:
+        psycopg2.extras.execute_values(cursor, UPSERT_TRAFFIC.format(resolution=resolution),
+                                       aggregate_traffic(entries, resolution))
@@ -0,0 +1,374 @@
+#!/usr/bin/python
+
+import ipaddress
+import logging
+import re
+import subprocess
+import sys
+from collections import namedtuple
+
+from bin.params import ParameterHandler
+from metrics import SUBPROCESSES
+
+# Usage: shaping.py [--dry-run]
+# Builds the HFSC tree of bin/setup_hfsc_shape.sh from config.json, compares it
+# with what the kernel has and changes only what differs, all in one
+# `tc -batch`. Rate and filter changes leave the rest of the tree alone, so the
+# link stays shaped while they are applied. --dry-run prints the batch instead
+# of running it.
+#
+# Upload is shaped by HFSC on the WAN (Wi-Fi) interface and download by HFSC on
+# the LAN interface, with an ingress policer on the WAN side as a second line.
+# Class 1:10 gets the prioritized traffic, everything else ends up in 1:11.
+Qdisc = namedtuple('Qdisc', ['parent', 'handle', 'kind', 'options'])
+# Rates in Mbit/s, curve is the real-time part of the service curve
+TcClass = namedtuple('TcClass', ['parent', 'classid', 'curve', 'rate', 'ceiling'])
+# u32 matches are (value, mask, offset) keys, fw filters match a firewall mark,
+# police is the rate of the policer in Mbit/s
+Filter = namedtuple('Filter', ['parent', 'prio', 'match', 'mark', 'flowid', 'police'])
+Tree = namedtuple('Tree', ['qdiscs', 'classes', 'filters'])
+
+ROOT_HANDLE = '1:'
+INGRESS_HANDLE = 'ffff:'
+CURVE = 'umax 1540 dmax 5ms'
+POLICER_BURST = '20k'
+LAN_RATE = 1000.0
+LAN_PRIORITY_RATE = 900.0
+# Ports in blocks of 1024 and single ports
+PORT_BLOCK_MASK = 0xfc00
+PORT_MASK = 0xffff
+ICMP = 1
+# Rates reported by the kernel are rounded, anything closer than this is unchanged
+RATE_TOLERANCE = 0.005
+
+RATE_PATTERN = re.compile(r'^\s*([\d.]+)\s*([kmg]?)bit\s*$', re.IGNORECASE)
+RATE_UNITS = {'': 0.000001, 'k': 0.001, 'm': 1.0, 'g': 1000.0}
+
+log = logging.getLogger(__name__)
+ph = ParameterHandler()
+
+
+def parse_rate(rate):
+    # tc style rate to Mbit/s
+    parts = RATE_PATTERN.match(str(rate))
+    if parts is None:
+        raise ValueError('Not a rate: ' + str(rate))
+    return float(parts.group(1)) * RATE_UNITS[parts.group(2).lower()]
+
+
+def format_rate(mbps):
+    return '{}kbit'.format(int(round(mbps * 1000)))
+
+
+def shaping_settings():
+    # Defaults are the settings of setup_hfsc_shape.sh
+    settings = {'lan_network': '10.42.0.1/24',
+                'upload_percent': 0.9,
+                'download_percent': 0.9,
+                'ingress_percent': 0.97,
+                # Prioritized by destination port on the way out, by source port on the way in
+                'interactive_ports': [3074, 30000, 31000, 32000, 33000, 34000, 35000, 36000, 37000, 38000,
+                                      39000, 40000, 41000],
+                # Prioritized by source port on the way out, by destination port on the way in
+                'interactive_source_ports': [3074],
+                'priority_ports': [22, 4500, 9000, 19302, 19303, 19304, 19305, 19306, 19307, 19308, 19309],
+                # Marked by iptables, 2 for small packets like ACKs
+                'priority_marks': [2],
+                'leaf_qdisc': 'sfq perturb 10'}
+    settings.update(ph.shaping)
+    return settings
+
+
+def port_match(port, mask, source):
+    # Both ports share the 32 bits at offset 20 of IP packets without options
+    if source:
+        return (port & mask) << 16, mask << 16, 20
+    return port & mask, mask, 20
+
+
+def network_match(network, source):
+    network = ipaddress.ip_network(network, strict=False)
+    return int(network.network_address), int(network.netmask), 12 if source else 16
+
+
+def protocol_match(protocol):
+    return protocol << 16, 0xff << 16, 8
+
+
+def priority_matches(settings, egress):
+    matches = []
+    for port in settings['interactive_ports']:
+        matches.append((port_match(port, PORT_BLOCK_MASK, source=not egress),))
+    for port in settings['interactive_source_ports']:
+        matches.append((port_match(port, PORT_BLOCK_MASK, source=egress),))
+    for port in settings['priority_ports']:
+        matches.append((port_match(port, PORT_MASK, source=True),))
+        matches.append((port_match(port, PORT_MASK, source=False),))
+    matches.append((protocol_match(ICMP),))
+    return matches
+
+
+def hfsc_tree(settings, classes, filters):
+    leaf_kind, _, leaf_options = settings['leaf_qdisc'].partition(' ')
+    qdiscs = [Qdisc('root', ROOT_HANDLE, 'hfsc', 'default 11'),
+              Qdisc('1:10', '30:', leaf_kind, leaf_options),
+              Qdisc('1:11', '40:', leaf_kind, leaf_options)]
+    return Tree(qdiscs, classes, filters)
+
+
+def wan_tree(settings, upload):
+    classes = [TcClass(ROOT_HANDLE, '1:1', '', upload, upload),
+               TcClass('1:1', '1:10', CURVE, upload / 2, upload),
+               TcClass('1:1', '1:11', CURVE, upload / 2, upload / 2)]
+    ingress = parse_rate(ph.max_download) * settings['ingress_percent']
+    filters = []
+    # Prioritized traffic skips the policer
+    for parent, flowid in ((ROOT_HANDLE, '1:10'), (INGRESS_HANDLE, ':1')):
+        filters.extend(Filter(parent, 1, match, None, flowid, None) for match in priority_matches(settings, True))
+        filters.extend(Filter(parent, 2, (), mark, flowid, None) for mark in settings['priority_marks'])
+    filters.append(Filter(INGRESS_HANDLE, 50, (network_match('0.0.0.0/0', source=True),), None, ':2', ingress))
+    tree = hfsc_tree(settings, classes, filters)
+    tree.qdiscs.append(Qdisc('ingress', INGRESS_HANDLE, 'ingress', ''))
+    return tree
+
+
+def lan_tree(settings, download):
+    classes = [TcClass(ROOT_HANDLE, '1:1', '', LAN_RATE, LAN_RATE),
+               TcClass('1:1', '1:10', CURVE, LAN_PRIORITY_RATE, LAN_PRIORITY_RATE),
+               TcClass('1:1', '1:11', CURVE, download / 2, download)]
+    local = (network_match(settings['lan_network'], source=True), network_match(settings['lan_network'], source=False))
+    filters = [Filter(ROOT_HANDLE, 1, local, None, '1:10', None)]
+    filters.extend(Filter(ROOT_HANDLE, 1, match, None, '1:10', None) for match in priority_matches(settings, False))
+    return hfsc_tree(settings, classes, filters)
+
+
+def shaping_tree(settings, download=None, upload=None):
+    # Device -> Tree, rates default to the configured share of the line rate
+    if download is None:
+        download = parse_rate(ph.max_download) * settings['download_percent']
+    if upload is None:
+        upload = parse_rate(ph.max_upload) * settings['upload_percent']
+    return {ph.inboud_interface: wan_tree(settings, upload),
+            ph.outbound_interface: lan_tree(settings, download)}
+
+
+def tc_show(*arguments):
+    SUBPROCESSES.inc('tc')
+    result = subprocess.run(['tc'] + list(arguments), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    return result.stdout.splitlines() if result.returncode == 0 else []
+
+
+def _option(text, name):
+    parts = re.search(r'\b' + name + r' (\S+)', text)
+    return parts.group(1) if parts else None
+
+
+def kernel_tree(device):
+    # The tree the kernel has for a device, as far as shaping_tree describes it
+    qdiscs = []
+    for line in tc_show('qdisc', 'show', 'dev', device):
+        fields = line.split()
+        if len(fields) < 3 or fields[0] != 'qdisc':
+            continue
+        kind, handle = fields[1], fields[2]
+        if kind == 'ingress':
+            parent = 'ingress'
+        elif 'root' in fields:
+            parent = 'root'
+        else:
+            parent = _option(line, 'parent')
+        # Printed as hex, with 0x by newer iproute2
+        default = _option(line, 'default')
+        qdiscs.append(Qdisc(parent, handle, kind, 'default {:x}'.format(int(default, 16)) if default else ''))
+
+    classes = []
+    for line in tc_show('class', 'show', 'dev', device):
+        parts = re.match(r'class hfsc (\S+) parent (\S+)', line)
+        rate = re.search(r'\b(?:sc|ls) m1 \S+ d \S+ m2 (\S+)', line)
+        ceiling = re.search(r'\bul m1 \S+ d \S+ m2 (\S+)', line)
+        if parts and rate:
+            classes.append(TcClass(parts.group(2), parts.group(1), None, parse_rate(rate.group(1)),
+                                   parse_rate(ceiling.group(1)) if ceiling else None))
+
+    filters = []
+    for qdisc in qdiscs:
+        if qdisc.kind not in ('hfsc', 'ingress'):
+            continue
+        for line in tc_show('filter', 'show', 'dev', device, 'parent', qdisc.handle):
+            line = line.strip()
+            prio = _option(line, 'pref')
+            if line.startswith('filter') and ' fw ' in line and _option(line, 'handle'):
+                filters.append(Filter(qdisc.handle, int(prio), (), int(_option(line, 'handle'), 16),
+                                      _option(line, 'classid'), None))
+            elif line.startswith('filter') and ' u32 ' in line and _option(line, 'flowid'):
+                filters.append(Filter(qdisc.handle, int(prio), (), None, _option(line, 'flowid'), None))
+            elif line.startswith('match') and filters and filters[-1].mark is None:
+                value, mask = _option(line, 'match').split('/')
+                key = (int(value, 16), int(mask, 16), int(_option(line, 'at')))
+                filters[-1] = filters[-1]._replace(match=filters[-1].match + (key,))
+            elif 'police' in line and filters and _option(line, 'rate'):
+                filters[-1] = filters[-1]._replace(police=parse_rate(_option(line, 'rate')))
+    return Tree(qdiscs, classes, filters)
+
+
+def _depth(classes, classid):
+    depth = 0
+    while classid in classes:
+        classid, depth = classes[classid].parent, depth + 1
+    return depth
+
+
+def same_rate(a, b):
+    return a is not None and b is not None and abs(a - b) <= max(a, b) * RATE_TOLERANCE
+
+
+def filter_key(tc_filter):
+    # Filters are compared as a set, in whatever order the kernel lists their keys
+    police = round(tc_filter.police * 1000) if tc_filter.police is not None else None
+    return tc_filter.prio, tuple(sorted(tc_filter.match)), tc_filter.mark, tc_filter.flowid, police
+
+
+def qdisc_command(verb, device, qdisc):
+    if qdisc.parent == 'ingress':
+        return 'qdisc {} dev {} handle {} ingress'.format(verb, device, qdisc.handle)
+    parent = 'root' if qdisc.parent == 'root' else 'parent ' + qdisc.parent
+    return ' '.join(part for part in ('qdisc', verb, 'dev', device, parent, 'handle', qdisc.handle, qdisc.kind,
+                                      qdisc.options) if part)
+
+
+def class_command(verb, device, tc_class):
+    curve = 'sc ' + tc_class.curve + ' rate' if tc_class.curve else 'sc rate'
+    return 'class {} dev {} parent {} classid {} hfsc {} {} ul rate {}'.format(
+        verb, device, tc_class.parent, tc_class.classid, curve, format_rate(tc_class.rate),
+        format_rate(tc_class.ceiling))
+
+
+def filter_command(device, tc_filter):
+    command = 'filter add dev {} parent {} protocol ip prio {}'.format(device, tc_filter.parent, tc_filter.prio)
+    if tc_filter.mark is not None:
+        return command + ' handle {} fw flowid {}'.format(tc_filter.mark, tc_filter.flowid)
+    command += ' u32' + ''.join(' match u32 0x{:08x} 0x{:08x} at {}'.format(*key) for key in tc_filter.match)
+    if tc_filter.police is not None:
+        command += ' police rate {} burst {} drop'.format(format_rate(tc_filter.police), POLICER_BURST)
+    return command + ' flowid ' + tc_filter.flowid
+
+
+def device_plan(device, desired, current):
+    commands = []
+    current_qdiscs = {qdisc.parent: qdisc for qdisc in current.qdiscs}
+    current_classes = {tc_class.classid: tc_class for tc_class in current.classes}
+    current_filters = current.filters
+
+    root = next(qdisc for qdisc in desired.qdiscs if qdisc.parent == 'root')
+    existing_root = current_qdiscs.get('root')
+    desired_parents = {tc_class.classid: tc_class.parent for tc_class in desired.classes}
+    # A different root or classes that moved mean a new tree. The kernel's
+    # default root (handle 0:) can be replaced in one step, any other root is
+    # deleted first: replacing a root of the same handle only changes its
+    # parameters and keeps the classes and filters below it.
+    if existing_root is None or (existing_root.handle, existing_root.kind) != (root.handle, root.kind) or \
+            _option(existing_root.options, 'default') != _option(root.options, 'default') or \
+            any(current_classes[classid].parent != parent
+                for classid, parent in desired_parents.items() if classid in current_classes):
+        if existing_root is None or existing_root.handle == '0:':
+            commands.append(qdisc_command('replace', device, root))
+        else:
+            commands.append('qdisc del dev {} root'.format(device))
+            commands.append(qdisc_command('add', device, root))
+        current_qdiscs = {parent: qdisc for parent, qdisc in current_qdiscs.items() if parent == 'ingress'}
+        current_classes = {}
+        current_filters = [tc_filter for tc_filter in current_filters if tc_filter.parent == INGRESS_HANDLE]
+    if any(qdisc.parent == 'ingress' for qdisc in desired.qdiscs) and 'ingress' not in current_qdiscs:
+        commands.append(qdisc_command('add', device, Qdisc('ingress', INGRESS_HANDLE, 'ingress', '')))
+        current_filters = [tc_filter for tc_filter in current_filters if tc_filter.parent != INGRESS_HANDLE]
+
+    # Parents come before their children in desired.classes
+    for tc_class in desired.classes:
+        existing = current_classes.get(tc_class.classid)
+        if existing is None:
+            commands.append(class_command('add', device, tc_class))
+        elif not same_rate(existing.rate, tc_class.rate) or not same_rate(existing.ceiling, tc_class.ceiling):
+            commands.append(class_command('change', device, tc_class))
+
+    for qdisc in desired.qdiscs:
+        existing = current_qdiscs.get(qdisc.parent)
+        if qdisc.parent not in ('root', 'ingress') and (existing is None or existing.kind != qdisc.kind):
+            commands.append(qdisc_command('replace', device, qdisc))
+
+    # Filters of a priority are replaced together when any of them differs
+    groups, current_groups = {}, {}
+    for tc_filter in desired.filters:
+        groups.setdefault((tc_filter.parent, tc_filter.prio), []).append(tc_filter)
+    for tc_filter in current_filters:
+        current_groups.setdefault((tc_filter.parent, tc_filter.prio), []).append(tc_filter)
+    for (parent, prio), tc_filters in groups.items():
+        existing = current_groups.get((parent, prio), [])
+        if sorted(map(filter_key, existing)) == sorted(map(filter_key, tc_filters)):
+            continue
+        if existing:
+            commands.append('filter del dev {} parent {} protocol ip prio {}'.format(device, parent, prio))
+        commands.extend(filter_command(device, tc_filter) for tc_filter in tc_filters)
+    for parent, prio in current_groups:
+        if (parent, prio) not in groups:
+            commands.append('filter del dev {} parent {} protocol ip prio {}'.format(device, parent, prio))
+
+    # Leftovers of an earlier tree, children first
+    desired_qdiscs = {qdisc.parent for qdisc in desired.qdiscs}
+    for qdisc in current_qdiscs.values():
+        if qdisc.parent not in desired_qdiscs:
+            commands.append('qdisc del dev {} parent {}'.format(device, qdisc.parent))
+    for classid in sorted(set(current_classes) - set(desired_parents),
+                          key=lambda classid: _depth(current_classes, classid), reverse=True):
+        commands.append('class del dev {} classid {}'.format(device, classid))
+    return commands
+
+
+def plan(desired, current):
+    # tc commands that turn the current trees into the desired ones
+    commands = []
+    for device, tree in desired.items():
+        commands.extend(device_plan(device, tree, current.get(device, Tree([], [], []))))
+    return commands
+
+
+class Shaper:
+    # Keeps the tree it applied last, so later rate changes are planned without
+    # asking the kernel again
+    def __init__(self, settings):
+        self.settings = settings
+        self._applied = None
+
+    def commands(self, download=None, upload=None):
+        desired = shaping_tree(self.settings, download, upload)
+        current = self._applied
+        if current is None:
+            current = {device: kernel_tree(device) for device in desired}
+        return desired, plan(desired, current)
+
+    def apply(self, download=None, upload=None):
+        desired, commands = self.commands(download, upload)
+        if not commands:
+            return True
+        # -force carries on after an error, the kernel state is read again next time
+        SUBPROCESSES.inc('tc')
+        result = subprocess.run(['tc', '-force', '-batch', '-'], input='\n'.join(commands) + '\n',
+                                universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            log.warning('tc failed: %s', result.stderr.strip())
+            self._applied = None
+            return False
+        self._applied = desired
+        return True
+
+
+def main(arguments):
+    shaper = Shaper(shaping_settings())
+    if '--dry-run' in arguments:
+        print('\n'.join(shaper.commands()[1]))
+        return 0
+    return 0 if shaper.apply() else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+import struct
+
+import numpy
+
+# Mergeable quantile sketch of ping times with logarithmic buckets (DDSketch):
+# a value v lands in bucket ceil(log(v) / log(GAMMA)) and every bucket is read
+# back as a value within RELATIVE_ACCURACY of all values in it. Merging two
+# sketches adds their counts per bucket, so a percentile of an hour or a day is
+# exact to 1% whether it comes from the raw rows or from 60 or 1440 minute
+# sketches. A minute of one ping per second fills a few dozen buckets.
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = numpy.log(GAMMA)
+# Anything below a microsecond is counted as zero
+MIN_VALUE = 0.001
+
+# Serialized: version, zero count, number of buckets, then the bucket indexes
+# (int16) and their counts (uint32)
+HEADER = struct.Struct('<BII')
+VERSION = 1
+
+
+class Sketch:
+    def __init__(self, indexes=None, counts=None, zeros=0):
+        self.indexes = numpy.array([] if indexes is None else indexes, dtype=numpy.int16)
+        self.counts = numpy.array([] if counts is None else counts, dtype=numpy.uint32)
+        self.zeros = zeros
+
+    @classmethod
+    def of(cls, values):
+        values = numpy.asarray(values, dtype=numpy.float64)
+        values = values[~numpy.isnan(values)]
+        positive = values[values >= MIN_VALUE]
+        indexes, counts = numpy.unique(numpy.ceil(numpy.log(positive) / LOG_GAMMA), return_counts=True)
+        return cls(indexes, counts, len(values) - len(positive))
+
+    @property
+    def count(self):
+        return self.zeros + int(self.counts.sum())
+
+    def merge(self, *others):
+        return merge([self] + list(others))
+
+    def quantiles(self, quantiles):
+        # Values at the given quantiles (0..1), None for an empty sketch
+        count = self.count
+        if not count:
+            return [None for _ in quantiles]
+        ranks = numpy.asarray(quantiles, dtype=numpy.float64) * (count - 1)
+        bounds = self.zeros + numpy.cumsum(self.counts, dtype=numpy.int64)
+        positions = numpy.minimum(numpy.searchsorted(bounds, ranks, 'right'), len(bounds) - 1)
+        values = 2 * GAMMA ** self.indexes[positions].astype(numpy.float64) / (GAMMA + 1)
+        return [0.0 if rank < self.zeros else round(float(value), 3) for rank, value in zip(ranks, values)]
+
+    def quantile(self, quantile):
+        return self.quantiles([quantile])[0]
+
+    def to_bytes(self):
+        return HEADER.pack(VERSION, self.zeros, len(self.indexes)) + \
+               self.indexes.astype('<i2').tobytes() + self.counts.astype('<u4').tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        version, zeros, size = HEADER.unpack_from(data, 0)
+        if version != VERSION:
+            raise ValueError('Unknown sketch version {}'.format(version))
+        indexes = numpy.frombuffer(data, dtype='<i2', count=size, offset=HEADER.size)
+        counts = numpy.frombuffer(data, dtype='<u4', count=size, offset=HEADER.size + 2 * size)
+        return cls(indexes, counts, zeros)
+
+
+def merge(sketches):
+    # All at once: the buckets of every sketch are summed with one bincount
+    sketches = [sketch for sketch in sketches if sketch is not None]
+    if not sketches:
+        return Sketch()
+    indexes = numpy.concatenate([sketch.indexes for sketch in sketches])
+    counts = numpy.concatenate([sketch.counts for sketch in sketches])
+    merged, positions = numpy.unique(indexes, return_inverse=True)
+    return Sketch(merged, numpy.bincount(positions, weights=counts, minlength=len(merged)).astype(numpy.uint32),
+                  sum(sketch.zeros for sketch in sketches))
+
+
+def merge_serialized(blobs):
+    return merge([Sketch.from_bytes(blob) for blob in blobs if blob is not None])
@@ -0,0 +1,244 @@
+#!/usr/bin/python
+
+import http.client
+import http.server
+import logging
+import os
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs, urlsplit
+
+from bin.params import ParameterHandler
+from metrics import SUBPROCESSES, Counter, Histogram
+
+# Usage: speedtests.py --serve [port]
+# Speedtests of the dashboard. SpeedtestManager runs one test at a time: a
+# request while a test runs joins that test instead of starting a second one
+# that would compete with it for the uplink. Progress goes to every viewer and
+# finished tests are stored for trending.
+#
+# A test is SPEEDTEST_COMMAND (speedtest-cli --simple or anything printing the
+# same Ping:/Download:/Upload: lines), or, with SPEEDTEST_URL set, a single
+# stream HTTP test against that server. --serve starts such a server, a local
+# stand-in for exercising the whole path without the internet.
+PHASES = ('ping', 'download', 'upload')
+SIMPLE_LINE = re.compile(r'^(Ping|Download|Upload):\s*([\d.]+)')
+
+TRANSFER_SIZE = 1 << 20
+LATENCY_PROBES = 5
+STAND_IN_PORT = 8081
+# Scheduled tests wait this long for the link to become idle, then skip the day
+SCHEDULE_RETRY = 300
+SCHEDULE_GIVE_UP = 3600
+
+log = logging.getLogger(__name__)
+ph = ParameterHandler()
+
+REQUESTS = Counter('rpi_speedtest_requests_total', 'Speedtests asked for, started or joining the running one',
+                   ['reason', 'result'])
+DURATION = Histogram('rpi_speedtest_seconds', 'Duration of finished speedtests', ['state'],
+                     buckets=(5, 10, 20, 30, 45, 60, 90, 120, 300))
+
+
+def run_command(command, progress):
+    # speedtest-cli --simple prints one line per finished phase
+    output = []
+    results = {}
+    SUBPROCESSES.inc(os.path.basename(command[0]))
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+                          env=dict(os.environ, PYTHONUNBUFFERED='1')) as test:
+        for line in test.stdout:
+            parts = SIMPLE_LINE.match(line.strip())
+            if parts is None:
+                output.append(line.strip())
+                continue
+            phase = parts.group(1).lower()
+            results[phase] = float(parts.group(2))
+            progress(phase, results[phase])
+    if test.returncode != 0 or len(results) < len(PHASES):
+        raise RuntimeError(' '.join(output) or '{} exited with {}'.format(command[0], test.returncode))
+    return results
+
+
+def run_http(url, seconds, progress):
+    # Ping is the median round trip of a tiny request on an open connection, the
+    # rates are what one connection moves in `seconds` per direction
+    parts = urlsplit(url)
+    base = parts.path.rstrip('/')
+    connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=10)
+    payload = os.urandom(TRANSFER_SIZE)
+
+    def exchange(method, path, body=None):
+        connection.request(method, base + path, body=body)
+        response = connection.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise RuntimeError('{} {} answered {}'.format(method, url + path, response.status))
+        return len(data)
+
+    def transfer(phase, method, path, body=None):
+        started = reported = time.perf_counter()
+        moved = 0
+        while time.perf_counter() - started < seconds:
+            received = exchange(method, path, body)
+            moved += received if body is None else len(body)
+            if time.perf_counter() - reported >= 1:
+                reported = time.perf_counter()
+                progress(phase, moved * 8 / (reported - started) / 1e6, final=False)
+        mbps = moved * 8 / (time.perf_counter() - started) / 1e6
+        progress(phase, mbps)
+        return mbps
+
+    try:
+        round_trips = []
+        for _ in range(LATENCY_PROBES):
+            started = time.perf_counter()
+            exchange('GET', '/latency')
+            round_trips.append((time.perf_counter() - started) * 1000)
+        ping = statistics.median(round_trips)
+        progress('ping', ping)
+        download = transfer('download', 'GET', '/download?bytes={}'.format(TRANSFER_SIZE))
+        upload = transfer('upload', 'POST', '/upload', payload)
+    except (OSError, http.client.HTTPException) as err:
+        raise RuntimeError('Speedtest against {} failed: {}'.format(url, err))
+    finally:
+        connection.close()
+    return {'ping': ping, 'download': download, 'upload': upload}
+
+
+def speedtest_runner():
+    if ph.speedtest_url:
+        return lambda progress: run_http(ph.speedtest_url, ph.speedtest_seconds, progress)
+    return lambda progress: run_command(ph.speedtest_command, progress)
+
+
+class SpeedtestManager:
+    def __init__(self, run, save, publish):
+        self._run = run
+        self._save = save
+        self._publish = publish
+        self._lock = threading.Lock()
+        self._job = None
+        self.last = None
+
+    def current(self):
+        with self._lock:
+            return dict(self._job) if self._job is not None else None
+
+    def start(self, reason):
+        # Returns the job and whether it is a new one
+        with self._lock:
+            if self._job is not None:
+                REQUESTS.inc(reason, 'joined')
+                return dict(self._job), False
+            REQUESTS.inc(reason, 'started')
+            self._job = {'state': 'running', 'reason': reason, 'started_at': time.time(), 'duration': None,
+                         'phase': None, 'estimate': None, 'ping': None, 'download': None, 'upload': None,
+                         'error': None}
+            job = dict(self._job)
+        self._publish(job)
+        threading.Thread(target=self._execute, name='speedtest', daemon=True).start()
+        return job, True
+
+    def _progress(self, phase, value, final=True):
+        # Running estimates are shown as such, only final values are results
+        with self._lock:
+            if final:
+                self._job.update({'phase': phase, 'estimate': None, phase: round(value, 2)})
+            else:
+                self._job.update({'phase': phase, 'estimate': round(value, 2)})
+            job = dict(self._job)
+        self._publish(job)
+
+    def _execute(self):
+        error = None
+        try:
+            self._run(self._progress)
+        except Exception as err:
+            log.exception('Speedtest failed')
+            error = str(err) or type(err).__name__
+        with self._lock:
+            job, self._job = self._job, None
+            job.update(state='failed' if error else 'done', error=error, duration=time.time() - job['started_at'])
+            self.last = dict(job)
+        DURATION.observe(job['duration'], job['state'])
+        try:
+            self._save(job)
+        except Exception:
+            log.exception('Failed to store speedtest result')
+        self._publish(job)
+
+
+def next_run(schedule, now):
+    # Next of the local times "HH:MM" after now
+    candidates = []
+    for at in schedule:
+        hour, minute = (int(part) for part in at.split(':'))
+        candidate = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        candidates.append(candidate if candidate > now else candidate + timedelta(days=1))
+    return min(candidates)
+
+
+def run_schedule(manager, schedule, idle):
+    # Runs a test at every SPEEDTEST_SCHEDULE time, later while idle() says the
+    # link is in use, never when it stays busy for SCHEDULE_GIVE_UP seconds
+    while True:
+        due = next_run(schedule, datetime.now())
+        time.sleep(max(0.0, (due - datetime.now()).total_seconds()))
+        while not idle() and (datetime.now() - due).total_seconds() < SCHEDULE_GIVE_UP:
+            time.sleep(SCHEDULE_RETRY)
+        if idle():
+            manager.start('schedule')
+        else:
+            log.warning('Link busy since %s, skipping the scheduled speedtest', due.strftime('%H:%M'))
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    # The server side of run_http
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, without this every reply waits for a delayed ACK
+    disable_nagle_algorithm = True
+    payload = os.urandom(TRANSFER_SIZE)
+
+    def _reply(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path.endswith('/latency'):
+            self._reply(b'test=test')
+        elif url.path.endswith('/download'):
+            size = int(parse_qs(url.query).get('bytes', [TRANSFER_SIZE])[0])
+            self._reply(self.payload[:min(size, TRANSFER_SIZE)])
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        remaining = received = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            remaining -= len(self.rfile.read(min(remaining, 65536)))
+        self._reply('size={}'.format(received).encode('ascii'))
+
+    def log_message(self, message_format, *args):
+        pass
+
+
+def serve(port):
+    print('Speedtest stand-in listening on port', port)
+    http.server.ThreadingHTTPServer(('0.0.0.0', port), StandInHandler).serve_forever()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != '--serve':
+        print('Usage: speedtests.py --serve [port]')
+        sys.exit(1)
+    serve(int(sys.argv[2]) if len(sys.argv) > 2 else STAND_IN_PORT)
@@ -10,10 +10,20 @@ $(document).ready(function(){
         document.getElementById("testingSpinner").style.display = "inline-block";
         document.getElementById("testingResultsHolder").style.display = "none";
     };
-    speedtest_socket.on('testing', function(msg) {
-        document.getElementById("testingResults").textContent = msg.data
-        document.getElementById("testingSpinner").style.display = "none";
-        document.getElementById("testingResultsHolder").style.display = "inline-block";
+    // Every viewer gets the progress of the one running test, whoever started it
+    speedtest_socket.on('progress', function(job) {
+        var parts = [];
+        if (job.ping !== null) parts.push("Ping: " + job.ping + " ms");
+        if (job.download !== null) parts.push("Download: " + job.download + " Mbit/s");
+        if (job.upload !== null) parts.push("Upload: " + job.upload + " Mbit/s");
+        if (job.estimate !== null) {
+            parts.push(job.phase.charAt(0).toUpperCase() + job.phase.slice(1) + ": ~" + job.estimate + " Mbit/s");
+        }
+        if (job.state === "failed") parts.push("Failed: " + job.error);
+        var running = job.state === "running";
+        document.getElementById("testingResults").textContent = parts.join(" ");
+        document.getElementById("testingSpinner").style.display = running ? "inline-block" : "none";
+        document.getElementById("testingResultsHolder").style.display = parts.length ? "inline-block" : "none";
     });
 
     var traffic_socket = io.connect('http://' + document.domain + '/traffic');
@@ -90,10 +100,7 @@ $(document).ready(function(){
 
     const lineChart = new Chart(context, config);
 
-    const source = new EventSource("/chart-data");
-
-    source.onmessage = function (event) {
-        const data = JSON.parse(event.data);
+    function addPoint(data) {
         if (config.data.labels.length === 30) {
             config.data.labels.shift();
             config.data.datasets[0].data.shift();
@@ -104,8 +111,99 @@ $(document).ready(function(){
         config.data.datasets[0].data.push(data.ping);
         config.data.datasets[1].data.push(data.download);
         config.data.datasets[2].data.push(data.upload);
+    }
+
+    // Start with the last 30 seconds the server has in memory, then follow the stream
+    $.getJSON('/api/live?n=30', function (data) {
+        data.points.forEach(addPoint);
         lineChart.update();
+    }).always(function () {
+        const source = new EventSource("/chart-data");
+
+        source.onmessage = function (event) {
+            const data = JSON.parse(event.data);
+            // The first sample may be the last one of the backfill
+            if (config.data.labels[config.data.labels.length - 1] !== data.time) {
+                addPoint(data);
+                lineChart.update();
+            }
+        }
+    });
+
+    // History graphs are drawn here from the rollup series. One snapshot of the
+    // last hour carries the series, overview and loss of every destination and
+    // the traffic, it is fetched again every minute.
+    function historyChart(canvas, series, yLabel) {
+        const chart = new Chart(canvas.getContext('2d'), {
+            type: 'line',
+            data: {
+                labels: [],
+                datasets: series.map(function (s) {
+                    return {label: s.label, backgroundColor: s.color, borderColor: s.color,
+                            data: [], fill: false, pointRadius: 1};
+                })
+            },
+            options: {
+                responsive: true,
+                maintainAspectRatio: false,
+                animation: {duration: 0},
+                tooltips: {mode: 'index', intersect: false},
+                scales: {
+                    yAxes: [{ticks: {beginAtZero: true}, scaleLabel: {display: true, labelString: yLabel}}]
+                }
+            }
+        });
+
+        return function (data) {
+            chart.data.labels = data.time.map(function (t) {
+                return new Date(t * 1000).toLocaleTimeString([], {hour: '2-digit', minute: '2-digit'});
+            });
+            series.forEach(function (s, i) {
+                chart.data.datasets[i].data = data[s.key];
+            });
+            chart.update();
+        };
+    }
+
+    const updates = [];
+
+    document.querySelectorAll('.destination').forEach(function (element) {
+        const name = element.dataset.destination;
+        const draw = historyChart(element.querySelector('.history-chart'), [
+            {key: 'max', label: 'max', color: 'rgb(255, 99, 132)'},
+            {key: 'avg', label: 'avg', color: 'rgb(255, 159, 64)'},
+            {key: 'min', label: 'min', color: 'rgb(75, 192, 192)'}
+        ], 'Round Trip (ms)');
+        updates.push(function (snapshot) {
+            const destination = snapshot.destinations.find(function (d) { return d.destination === name; });
+            if (!destination) return;
+            element.querySelector('.ping-min').textContent = destination.min;
+            element.querySelector('.ping-avg').textContent = destination.avg;
+            element.querySelector('.ping-max').textContent = destination.max;
+            element.querySelector('.packet-loss').textContent = destination.loss_percent.toFixed(3) + "% (" +
+                destination.lost + "/" + destination.sent + ")";
+            draw(destination.series);
+        });
+    });
+
+    document.querySelectorAll('.traffic-history-chart').forEach(function (canvas) {
+        const draw = historyChart(canvas, [
+            {key: 'upload', label: 'upload', color: 'rgb(73, 85, 166)'},
+            {key: 'download', label: 'download', color: 'rgb(65, 138, 84)'}
+        ], 'Bandwidth (Mbps)');
+        updates.push(function (snapshot) {
+            draw(snapshot.traffic);
+        });
+    });
+
+    function refresh() {
+        $.getJSON('/api/snapshot', function (snapshot) {
+            updates.forEach(function (update) { update(snapshot); });
+        });
     }
 
+    refresh();
+    setInterval(refresh, 60000);
+
     console.log('Started!')
 });
\ No newline at end of file
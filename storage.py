@@ -0,0 +1,327 @@
+#!/usr/bin/python
+
+from contextlib import contextmanager
+
+import psycopg2.extras
+
+from bin.params import ParameterHandler
+from db import ConnectionPool, WriteBuffer
+from metrics import Gauge, Histogram
+from ringstore import RingStore
+from rollups import rollup_pings, rollup_traffic
+
+ph = ParameterHandler()
+
+QUERY_SECONDS = Histogram('rpi_db_query_seconds', 'Time of a database query, waiting for a connection included',
+                          ['query'])
+POOL_CONNECTIONS = Gauge('rpi_db_pool_connections', 'Connections of the pool of the web server', ['state'])
+
+# Everything the collectors write and the web server reads goes through one of
+# these backends, STORAGE_BACKEND in config.json picks which one:
+#   postgres  the pings/traffic tables with their rollups
+#   ringfile  memory mapped ring buffer files, one per destination and interface,
+#             no database server needed
+# Both hand out writers with add(entry)/close() for the collectors and return rows
+# that can be indexed by column name.
+
+
+class PostgresStorage:
+    def __init__(self):
+        self._pool = None
+
+    @property
+    def pool(self):
+        # Collectors only write through their own connection, no need for a pool there
+        if self._pool is None:
+            self._pool = ConnectionPool(max_size=ph.db_pool_size, idle_timeout=ph.db_pool_idle_timeout)
+            POOL_CONNECTIONS.track(lambda: self._pool.stats()['in_use'], 'in_use')
+            POOL_CONNECTIONS.track(lambda: self._pool.stats()['idle'], 'idle')
+        return self._pool
+
+    @contextmanager
+    def cursor(self, query):
+        with QUERY_SECONDS.time(query), self.pool.connection() as conn:
+            yield conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+    @staticmethod
+    def ping_writer():
+        return WriteBuffer('pings', ('recorded_at', 'destination', 'bytes_received', 'ttl', 'pingtime'),
+                           lambda ping_entry: (ping_entry.recorded_at.isoformat(), ping_entry.destination,
+                                               ping_entry.bytes, ping_entry.ttl, ping_entry.ping_time),
+                           rollups=[rollup_pings])
+
+    @staticmethod
+    def traffic_writer():
+        # traffic.recorded_at has no time zone, so samples carry local time like the column default
+        return WriteBuffer('traffic', ('recorded_at', 'interface', 'upload', 'download',
+                                       'upload_pps', 'download_pps', 'errors', 'drops'),
+                           lambda traffic_entry: (traffic_entry.timestamp.isoformat(),
+                                                  traffic_entry.interface,
+                                                  '%.2f' % traffic_entry.upload,
+                                                  '%.2f' % traffic_entry.download,
+                                                  '%.1f' % traffic_entry.upload_pps,
+                                                  '%.1f' % traffic_entry.download_pps,
+                                                  traffic_entry.errors,
+                                                  traffic_entry.drops),
+                           rollups=[rollup_traffic])
+
+    def ping_snapshot(self, hours):
+        # The minute rollups of every destination in one go, rows as ping_history returns them
+        with self.cursor('ping_snapshot') as cur:
+            ping_snapshot_query = """
+                SELECT
+                  extract(epoch FROM bucket) AS time,
+                  destination,
+                  count - lost AS count,
+                  lost,
+                  round(pingtime_sum / NULLIF(count - lost, 0), 2) AS avg,
+                  pingtime_max AS max,
+                  pingtime_min AS min
+                FROM pings_minute
+                WHERE
+                  bucket >= now() - %s * INTERVAL '1 hour'
+                ORDER BY destination, bucket ASC;
+            """
+
+            cur.execute(ping_snapshot_query, (hours,))
+
+            return cur.fetchall()
+
+    def ping_history(self, destination, hours, resolution, since=None):
+        with self.cursor('ping_history') as cur:
+            destination_history_query = """
+                SELECT
+                  extract(epoch FROM bucket) AS time,
+                  bucket AT TIME ZONE 'Europe/Berlin' AS begin_time,
+                  destination,
+                  count - lost AS count,
+                  lost,
+                  round(pingtime_sum / NULLIF(count - lost, 0), 2) AS avg,
+                  pingtime_max AS max,
+                  pingtime_min AS min
+                FROM pings_{resolution}
+                WHERE
+                  destination = %s
+                  AND bucket >= greatest(now() - %s * INTERVAL '1 hour', to_timestamp(%s))
+                ORDER BY bucket ASC;
+            """.format(resolution=resolution)
+
+            cur.execute(destination_history_query, (destination, hours, since or 0))
+
+            return cur.fetchall()
+
+    def traffic_history(self, interface, hours, resolution, since=None):
+        with self.cursor('traffic_history') as cur:
+            traffic_history_query = """
+                SELECT
+                  extract(epoch FROM bucket::timestamp with time zone) AS time,
+                  bucket AS recorded_at,
+                  round(upload_sum / count, 2) AS upload,
+                  round(download_sum / count, 2) AS download,
+                  upload_max,
+                  download_max
+                FROM traffic_{resolution}
+                WHERE
+                  interface = %s
+                  AND bucket >= greatest(now() - %s * INTERVAL '1 hour', to_timestamp(%s))
+                ORDER BY bucket ASC;
+            """.format(resolution=resolution)
+
+            cur.execute(traffic_history_query, (interface, hours, since or 0))
+
+            return cur.fetchall()
+
+    def ping_sketches(self, destination, hours, resolution):
+        # Rollup buckets with their quantile sketches, count includes the lost pings
+        with self.cursor('ping_sketches') as cur:
+            destination_sketches_query = """
+                SELECT
+                  extract(epoch FROM bucket) AS time,
+                  count,
+                  lost,
+                  pingtime_sketch AS sketch
+                FROM pings_{resolution}
+                WHERE
+                  destination = %s
+                  AND bucket >= now() - %s * INTERVAL '1 hour'
+                ORDER BY bucket ASC;
+            """.format(resolution=resolution)
+
+            cur.execute(destination_sketches_query, (destination, hours))
+
+            return cur.fetchall()
+
+    def destination_sketches(self, hours, resolution):
+        # ping_sketches of every destination in one go, by destination
+        with self.cursor('destination_sketches') as cur:
+            destination_sketches_query = """
+                SELECT
+                  destination,
+                  extract(epoch FROM bucket) AS time,
+                  count,
+                  lost,
+                  pingtime_sketch AS sketch
+                FROM pings_{resolution}
+                WHERE
+                  bucket >= now() - %s * INTERVAL '1 hour'
+                ORDER BY destination, bucket ASC;
+            """.format(resolution=resolution)
+
+            cur.execute(destination_sketches_query, (hours,))
+
+            sketches = {}
+            for row in cur.fetchall():
+                sketches.setdefault(row['destination'], []).append(row)
+            return sketches
+
+    def destination_samples(self, seconds):
+        # ping_samples of every destination in one go, by destination
+        with self.cursor('destination_samples') as cur:
+            destination_samples_query = """
+                SELECT
+                  destination,
+                  extract(epoch FROM recorded_at)::float8 AS time,
+                  pingtime::float8 AS pingtime
+                FROM pings
+                WHERE
+                  recorded_at > now() - %s * INTERVAL '1 second'
+                ORDER BY destination, recorded_at ASC;
+            """
+
+            cur.execute(destination_samples_query, (seconds,))
+
+            samples = {}
+            for row in cur.fetchall():
+                times, pingtimes = samples.setdefault(row['destination'], ([], []))
+                times.append(row['time'])
+                pingtimes.append(row['pingtime'])
+            return samples
+
+    def ping_samples(self, destination, seconds):
+        # Raw samples of the last `seconds` as two columns, None for lost pings
+        with self.cursor('ping_samples') as cur:
+            destination_samples_query = """
+                SELECT
+                  extract(epoch FROM recorded_at)::float8 AS time,
+                  pingtime::float8 AS pingtime
+                FROM pings
+                WHERE
+                  destination = %s
+                  AND recorded_at > now() - %s * INTERVAL '1 second'
+                ORDER BY recorded_at ASC;
+            """
+
+            cur.execute(destination_samples_query, (destination, seconds))
+            rows = cur.fetchall()
+
+            return [row['time'] for row in rows], [row['pingtime'] for row in rows]
+
+    def traffic_samples(self, interface, seconds):
+        # Raw samples of the last `seconds` as three columns: time, upload and download
+        with self.cursor('traffic_samples') as cur:
+            traffic_samples_query = """
+                SELECT
+                  extract(epoch FROM recorded_at::timestamp with time zone)::float8 AS time,
+                  upload::float8 AS upload,
+                  download::float8 AS download
+                FROM traffic
+                WHERE
+                  interface = %s
+                  AND recorded_at > localtimestamp - %s * INTERVAL '1 second'
+                ORDER BY recorded_at ASC;
+            """
+
+            cur.execute(traffic_samples_query, (interface, seconds))
+            rows = cur.fetchall()
+
+            return [row['time'] for row in rows], [row['upload'] for row in rows], [row['download'] for row in rows]
+
+    def packet_loss(self, destination):
+        with self.cursor('packet_loss') as cur:
+            destination_loss_query = """
+                SELECT
+                  coalesce(sum(lost), 0) AS lost,
+                  coalesce(sum(count), 0) AS count
+                FROM pings_minute
+                WHERE
+                  destination = %s
+                  AND bucket >= now() - INTERVAL '1 hour';
+            """
+
+            cur.execute(destination_loss_query, (destination,))
+
+            return cur.fetchone()
+
+    def latest_ping(self):
+        with self.cursor('latest_ping') as cur:
+            get_last_ping = """
+                SELECT
+                    extract(epoch FROM recorded_at) AS time,
+                    pingtime
+                FROM pings
+                ORDER BY recorded_at DESC
+                LIMIT 1
+            """
+
+            cur.execute(get_last_ping)
+
+            return cur.fetchone()
+
+    def latest_traffic(self, interface):
+        with self.cursor('latest_traffic') as cur:
+            get_last_traffic = """
+                SELECT
+                    recorded_at,
+                    download,
+                    upload
+                FROM traffic
+                WHERE interface = %s
+                ORDER BY recorded_at DESC
+                LIMIT 1
+            """
+
+            cur.execute(get_last_traffic, (interface,))
+
+            return cur.fetchone()
+
+    def save_speedtest(self, job):
+        with QUERY_SECONDS.time('save_speedtest'), self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO speedtests (started_at, duration, reason, ping, download, upload, error)
+                    VALUES (to_timestamp(%s), %s, %s, %s, %s, %s, %s);
+                """, (job['started_at'], job['duration'], job['reason'], job['ping'], job['download'], job['upload'],
+                      job['error']))
+            conn.commit()
+
+    def speedtests(self, hours):
+        with self.cursor('speedtests') as cur:
+            speedtests_query = """
+                SELECT
+                  extract(epoch FROM started_at) AS time,
+                  duration,
+                  reason,
+                  ping,
+                  download,
+                  upload,
+                  error
+                FROM speedtests
+                WHERE started_at >= now() - %s * INTERVAL '1 hour'
+                ORDER BY started_at ASC;
+            """
+
+            cur.execute(speedtests_query, (hours,))
+
+            return cur.fetchall()
+
+    def stats(self):
+        return self.pool.stats()
+
+
+def open_storage(backend=None):
+    backend = backend or ph.storage_backend
+    if backend == 'postgres':
+        return PostgresStorage()
+    if backend == 'ringfile':
+        return RingStore(ph.ring_store_path, ph.ring_capacity)
+    raise ValueError('Unknown STORAGE_BACKEND: ' + str(backend))
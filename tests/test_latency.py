@@ -0,0 +1,87 @@
+#!/usr/bin/python
+
+import math
+import unittest
+
+import numpy
+
+import latency
+
+NAN = float('nan')
+
+
+def recurrence_jitter(pingtimes):
+    # RFC 3550 section 6.4.1, one difference at a time
+    replies = [pingtime for pingtime in pingtimes if not math.isnan(pingtime)]
+    if len(replies) < 2:
+        return None
+    estimate = 0.0
+    for previous, current in zip(replies, replies[1:]):
+        estimate += (abs(current - previous) - estimate) / 16
+    return estimate
+
+
+class JitterTest(unittest.TestCase):
+    def test_matches_the_recurrence(self):
+        random = numpy.random.RandomState(7)
+        pingtimes = 20 + random.exponential(5, 500)
+        pingtimes[random.rand(500) < 0.1] = NAN
+        self.assertAlmostEqual(latency.jitter(pingtimes), recurrence_jitter(pingtimes), places=9)
+
+    def test_short_series(self):
+        self.assertIsNone(latency.jitter(numpy.array([])))
+        self.assertIsNone(latency.jitter(numpy.array([12.0, NAN])))
+        self.assertAlmostEqual(latency.jitter(numpy.array([10.0, 26.0])), 1.0)
+
+
+class LossBurstsTest(unittest.TestCase):
+    def bursts(self, pingtimes):
+        return list(latency.loss_bursts(numpy.array(pingtimes, dtype=numpy.float64)))
+
+    def test_runs(self):
+        self.assertEqual(self.bursts([1, NAN, NAN, 2, NAN, 3]), [2, 1])
+
+    def test_leading_and_trailing_runs(self):
+        self.assertEqual(self.bursts([NAN, NAN, NAN, 1, 2, NAN, NAN]), [3, 2])
+        self.assertEqual(self.bursts([NAN, NAN]), [2])
+
+    def test_no_loss(self):
+        self.assertEqual(self.bursts([1, 2, 3]), [])
+        self.assertEqual(self.bursts([]), [])
+
+
+class WindowTest(unittest.TestCase):
+    def setUp(self):
+        # One ping a second for an hour up to now = 3600, every tenth one lost
+        self.times = numpy.arange(1.0, 3601.0)
+        self.pingtimes = numpy.arange(1.0, 3601.0) % 50 + 10
+        self.pingtimes[::10] = NAN
+
+    def test_trailing_stats(self):
+        windows = latency.trailing_stats(self.times, self.pingtimes, 3600.0, windows=(60, 3600))
+        self.assertEqual(windows[60]['count'], 60)
+        self.assertEqual(windows[60]['lost'], 6)
+        self.assertEqual(windows[3600]['count'], 3600)
+        self.assertEqual(windows[3600]['loss_ratio'], 0.1)
+        self.assertEqual(windows[3600]['max_loss_burst'], 1)
+        replies = self.pingtimes[-60:][~numpy.isnan(self.pingtimes[-60:])]
+        self.assertEqual(windows[60]['p50'], round(float(numpy.percentile(replies, 50)), 3))
+        self.assertEqual(windows[60]['max'], float(replies.max()))
+
+    def test_empty_window(self):
+        stats = latency.trailing_stats(self.times, self.pingtimes, 10000.0, windows=(60,))[60]
+        self.assertEqual(stats['count'], 0)
+        self.assertIsNone(stats['loss_ratio'])
+        self.assertIsNone(stats['p99'])
+
+    def test_sliding_stats_match_trailing_stats(self):
+        series = latency.sliding_stats(self.times, self.pingtimes, 300, 600, 0.0, 3600.0)
+        self.assertEqual(series['time'], [600.0, 1200.0, 1800.0, 2400.0, 3000.0, 3600.0])
+        for index, end in enumerate(series['time']):
+            until = self.times <= end
+            expected = latency.trailing_stats(self.times[until], self.pingtimes[until], end, windows=(300,))[300]
+            self.assertEqual({name: values[index] for name, values in series.items() if name != 'time'}, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
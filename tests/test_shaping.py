@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+import os
+import unittest
+from unittest import mock
+
+import shaping
+from bin.params import ParameterHandler
+
+# Usage: python -m unittest discover tests
+# tc/ holds `tc ... show` output of the tree bin/setup_hfsc_shape.sh builds for
+# its 30mbit defaults, wlan0 as WAN and eth0 as LAN. iproute2 6.1 printed the
+# filters; the qdisc and class lines follow its HFSC output.
+TC_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tc')
+WAN = ParameterHandler().inboud_interface
+LAN = ParameterHandler().outbound_interface
+# The script shapes to 90% of 30mbit in both directions
+RATE = 27.0
+
+
+def recorded(name):
+    with open(os.path.join(TC_OUTPUT, name + '.txt')) as output:
+        return output.read().splitlines()
+
+
+class RecordedTc:
+    # Stands in for tc_show, answering from the files of tc/, optionally edited
+    def __init__(self, **replacements):
+        self.replacements = replacements
+
+    def __call__(self, *arguments):
+        device = {WAN: 'wan', LAN: 'lan'}[arguments[3]]
+        name = '{}_{}'.format(device, arguments[0])
+        if arguments[0] == 'filter':
+            name += '_ingress' if arguments[5] == shaping.INGRESS_HANDLE else '_root'
+        if not os.path.exists(os.path.join(TC_OUTPUT, name + '.txt')):
+            return []
+        lines = recorded(name)
+        for old, new in self.replacements.get(name, []):
+            lines = [line.replace(old, new) for line in lines]
+        return lines
+
+
+def kernel_trees(tc=None):
+    with mock.patch.object(shaping, 'tc_show', tc or RecordedTc()):
+        return {device: shaping.kernel_tree(device) for device in (WAN, LAN)}
+
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        self.settings = shaping.shaping_settings()
+        # The configured ports and marks may differ from the script, its own are compared here
+        self.settings.update({'lan_network': '10.42.0.1/24',
+                              'interactive_ports': [3074, 30000, 31000, 32000, 33000, 34000, 35000, 36000, 37000,
+                                                    38000, 39000, 40000, 41000],
+                              'interactive_source_ports': [3074],
+                              'priority_ports': [22, 4500, 9000, 19302, 19303, 19304, 19305, 19306, 19307, 19308,
+                                                 19309],
+                              'priority_marks': [2],
+                              'ingress_percent': 0.97,
+                              'leaf_qdisc': 'sfq perturb 10'})
+
+    def desired(self, download=RATE, upload=RATE):
+        with mock.patch.object(ParameterHandler, 'max_download', '30mbit'):
+            return shaping.shaping_tree(self.settings, download, upload)
+
+    def test_kernel_tree_parses_the_script_tree(self):
+        trees = kernel_trees()
+        wan, lan = trees[WAN], trees[LAN]
+        self.assertEqual(wan.qdiscs[0], shaping.Qdisc('root', '1:', 'hfsc', 'default 11'))
+        self.assertEqual([tc_class.classid for tc_class in wan.classes], ['1:1', '1:10', '1:11'])
+        self.assertEqual(wan.classes[1].rate, 15.0)
+        self.assertEqual(wan.classes[1].ceiling, 27.0)
+        self.assertEqual(len(wan.filters), 2 * (13 + 1 + 2 * 11 + 1 + 1) + 1)
+        self.assertEqual([tc_filter.police for tc_filter in wan.filters if tc_filter.prio == 50], [29.0])
+        self.assertEqual(lan.filters[0].match, ((0x0a2a0000, 0xffffff00, 12), (0x0a2a0000, 0xffffff00, 16)))
+
+    def test_script_tree_plans_rate_changes(self):
+        # The script gives both WAN leaves half the line rate and the LAN bulk
+        # class half the line rate as its guarantee, shaping.py half of the
+        # shaped rate. Its policer is rounded to whole Mbit/s.
+        commands = shaping.plan(self.desired(), kernel_trees())
+        self.assertEqual(commands, [
+            'class change dev {} parent 1:1 classid 1:10 hfsc sc umax 1540 dmax 5ms rate 13500kbit '
+            'ul rate 27000kbit'.format(WAN),
+            'class change dev {} parent 1:1 classid 1:11 hfsc sc umax 1540 dmax 5ms rate 13500kbit '
+            'ul rate 13500kbit'.format(WAN),
+            'filter del dev {} parent ffff: protocol ip prio 50'.format(WAN),
+            'filter add dev {} parent ffff: protocol ip prio 50 u32 match u32 0x00000000 0x00000000 at 12 '
+            'police rate 29100kbit burst 20k drop flowid :2'.format(WAN),
+            'class change dev {} parent 1:1 classid 1:11 hfsc sc umax 1540 dmax 5ms rate 13500kbit '
+            'ul rate 27000kbit'.format(LAN)])
+
+    def test_reapplying_plans_nothing(self):
+        self.assertEqual(shaping.plan(self.desired(), self.desired()), [])
+        # The same once the kernel reports the tree back
+        applied = RecordedTc(wan_class=[('m2 15Mbit', 'm2 13500Kbit')],
+                             lan_class=[('m2 15Mbit', 'm2 13500Kbit')],
+                             wan_filter_ingress=[('rate 29Mbit', 'rate 29100Kbit')])
+        self.assertEqual(shaping.plan(self.desired(), kernel_trees(applied)), [])
+
+    def test_rate_change_plans_class_changes(self):
+        commands = shaping.plan(self.desired(download=20.0, upload=10.0), self.desired())
+        self.assertTrue(commands)
+        self.assertTrue(all(command.startswith('class change ') for command in commands), commands)
+        self.assertEqual(len(commands), 4)
+
+    def test_changed_root_is_deleted_and_rebuilt(self):
+        # Replacing 1: by 1: would keep the old classes and filters below it
+        current = kernel_trees(RecordedTc(wan_qdisc=[('default 0x11', 'default 0x12')]))
+        commands = shaping.plan(self.desired(), current)
+        wan = [command for command in commands if ' dev {} '.format(WAN) in command]
+        self.assertEqual(wan[:2], ['qdisc del dev {} root'.format(WAN),
+                                   'qdisc add dev {} root handle 1: hfsc default 11'.format(WAN)])
+        self.assertEqual(len([command for command in wan if command.startswith('class add ')]), 3)
+        self.assertFalse([command for command in wan if command.startswith('class change ')])
+        # The ingress filters are left alone
+        self.assertFalse([command for command in wan if 'parent ffff: protocol ip prio 1' in command])
+
+    def test_default_root_is_replaced(self):
+        # A fresh interface has a pfifo_fast or noqueue root and no classes
+        tc = RecordedTc(wan_qdisc=[('qdisc hfsc 1: root refcnt 2 default 0x11', 'qdisc pfifo_fast 0: root refcnt 2')],
+                        wan_class=[('class hfsc', 'class none')])
+        current = kernel_trees(tc)
+        commands = shaping.plan({WAN: self.desired()[WAN]}, current)
+        self.assertEqual(commands[0], 'qdisc replace dev {} root handle 1: hfsc default 11'.format(WAN))
+
+
+if __name__ == '__main__':
+    unittest.main()
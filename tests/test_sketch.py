@@ -0,0 +1,66 @@
+#!/usr/bin/python
+
+import unittest
+
+import numpy
+
+import sketch
+
+QUANTILES = [0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]
+
+
+def ping_times(seed, size):
+    # Ping times in ms around 20 with a long tail
+    return numpy.random.RandomState(seed).lognormal(3, 0.5, size)
+
+
+class SketchTest(unittest.TestCase):
+    def assertWithinAccuracy(self, estimates, values):
+        expected = numpy.percentile(values, [100 * quantile for quantile in QUANTILES])
+        for quantile, estimate, exact in zip(QUANTILES, estimates, expected):
+            self.assertLessEqual(abs(estimate - exact), sketch.RELATIVE_ACCURACY * exact + 0.001,
+                                 'p{} {} != {}'.format(100 * quantile, estimate, exact))
+
+    def test_quantiles_within_relative_accuracy(self):
+        values = ping_times(1, 10000)
+        self.assertWithinAccuracy(sketch.Sketch.of(values).quantiles(QUANTILES), values)
+
+    def test_merge_equals_sketch_of_all_values(self):
+        minutes = [ping_times(seed, 60) for seed in range(60)]
+        merged = sketch.merge([sketch.Sketch.of(values) for values in minutes])
+        whole = sketch.Sketch.of(numpy.concatenate(minutes))
+        self.assertEqual(merged.count, 3600)
+        self.assertEqual(merged.indexes.tolist(), whole.indexes.tolist())
+        self.assertEqual(merged.counts.tolist(), whole.counts.tolist())
+        self.assertWithinAccuracy(merged.quantiles(QUANTILES), numpy.concatenate(minutes))
+
+    def test_merged_sketch_survives_serialization(self):
+        first = sketch.Sketch.of(ping_times(2, 300))
+        second = sketch.Sketch.of(numpy.append(ping_times(3, 300), [0.0, numpy.nan]))
+        merged = first.merge(second)
+        restored = sketch.Sketch.from_bytes(merged.to_bytes())
+        self.assertEqual(restored.zeros, 1)
+        self.assertEqual(restored.count, 601)
+        self.assertEqual(restored.indexes.tolist(), merged.indexes.tolist())
+        self.assertEqual(restored.counts.tolist(), merged.counts.tolist())
+        self.assertEqual(restored.quantiles(QUANTILES), merged.quantiles(QUANTILES))
+        self.assertEqual(sketch.merge_serialized([first.to_bytes(), None, second.to_bytes()]).quantiles(QUANTILES),
+                         merged.quantiles(QUANTILES))
+
+    def test_unknown_version(self):
+        data = bytearray(sketch.Sketch.of([10.0]).to_bytes())
+        data[0] = sketch.VERSION + 1
+        with self.assertRaises(ValueError):
+            sketch.Sketch.from_bytes(data)
+
+    def test_empty_sketch_and_zeros(self):
+        self.assertIsNone(sketch.Sketch().quantile(0.5))
+        self.assertEqual(sketch.merge([]).count, 0)
+        zeros = sketch.Sketch.of([0.0, 0.0005, 0.0, 12.0])
+        self.assertEqual(zeros.zeros, 3)
+        self.assertEqual(zeros.quantile(0.5), 0.0)
+        self.assertAlmostEqual(zeros.quantile(1.0), 12.0, delta=12.0 * sketch.RELATIVE_ACCURACY)
+
+
+if __name__ == '__main__':
+    unittest.main()
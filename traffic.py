@@ -1,60 +1,93 @@
 #!/usr/bin/python
 
-import re
-import subprocess
-
-import psycopg2
+import signal
+import threading
+import time
+from datetime import datetime
 
+import metrics
 from bin.params import ParameterHandler
+from live import LivePublisher
+from metrics import Counter, Histogram
+from netdev import RateSampler, read_counters
+from storage import open_storage
 
 ph = ParameterHandler()
 
+SAMPLES = Counter('rpi_traffic_samples_total', 'Rate samples taken', ['interface'])
+SKIPPED_TICKS = Counter('rpi_traffic_skipped_ticks_total', 'Sampling ticks missed because the loop fell behind')
+INSERT_SECONDS = Histogram('rpi_traffic_insert_seconds', 'Time of insert_into_db, queueing a sample and publishing it')
+
 
 class Traffic:
-    def __init__(self, timestamp, up, down):
+    def __init__(self, timestamp, up, down, interface=None, up_pps=None, down_pps=None, errors=None, drops=None):
         self.timestamp = timestamp
         self.download = down
         self.upload = up
+        self.interface = interface
+        self.download_pps = down_pps
+        self.upload_pps = up_pps
+        self.errors = errors
+        self.drops = drops
+
+    @classmethod
+    def from_rates(cls, interface, rates, lan_side):
+        # Upload is always traffic from the LAN towards the internet: it is received
+        # on the LAN facing interface and sent on the WAN facing one
+        if lan_side:
+            up, down, up_pps, down_pps = rates.rx_mbps, rates.tx_mbps, rates.rx_pps, rates.tx_pps
+        else:
+            up, down, up_pps, down_pps = rates.tx_mbps, rates.rx_mbps, rates.tx_pps, rates.rx_pps
+        return cls(timestamp=datetime.fromtimestamp(rates.timestamp), up=up, down=down, interface=interface,
+                   up_pps=up_pps, down_pps=down_pps,
+                   errors=rates.rx_errors + rates.tx_errors,
+                   drops=rates.rx_drops + rates.tx_drops)
 
     def __repr__(self):
-        return 'TRAFFIC: {} {}Mbps {}Mbps'.format(self.timestamp, self.download, self.upload)
+        return 'TRAFFIC: {} {} {}Mbps {}Mbps'.format(self.timestamp, self.interface, self.download, self.upload)
+
+
+traffic_buffer = open_storage().traffic_writer()
+# The web server keeps the latest samples in memory for the live chart
+live_feed = LivePublisher(ph.live_port)
 
 
-# For details: http://initd.org/psycopg/docs/module.html#psycopg2.connect
 def insert_into_db(traffic_entry):
-    with psycopg2.connect(database=ph.db_name,
-                          user=ph.db_username,
-                          password=ph.db_password,
-                          host='0.0.0.0') as conn:
-        # There is no need for transactions here, no risk of inconsistency etc
-        conn.autocommit = True
-
-        cursor = conn.cursor()
-
-        sql_command = """
-            INSERT INTO 
-              traffic
-              (upload, download)
-            VALUES
-              (%s, %s);
-        """
-
-        cursor.execute(sql_command, ('%.1f' % traffic_entry.upload, '%.1f' % traffic_entry.download))
-
-        cursor.close()
-
-
-# Do the traffics
-with subprocess.Popen(['ifstat', '-i', ph.outbound_interface, '-t', '-b', '-w', '-n', '1', '60'],
-                      stdout=subprocess.PIPE,
-                      bufsize=1,
-                      universal_newlines=True) as p:
-    for line in p.stdout:
-        line = line.strip()
-        download = upload = None
-        match_output = re.search(r'(\d\d:\d\d:\d\d)\s*(\d+\.\d+)\s*(\d+\.\d+)', ' '.join(line.split()))
-        if match_output is not None:
-            upload = float(match_output.group(2)) / 1000
-            download = float(match_output.group(3)) / 1000
-
-            insert_into_db(Traffic(timestamp=None, up=upload, down=download))
+    with INSERT_SECONDS.time():
+        traffic_buffer.add(traffic_entry)
+        live_feed.publish_traffic(traffic_entry)
+
+
+def run(interval, stop):
+    # The LAN facing interface is the one the dashboard has always shown
+    samplers = [(RateSampler(ph.outbound_interface), True), (RateSampler(ph.inboud_interface), False)]
+    deadline = time.monotonic()
+    while not stop.is_set():
+        counters = read_counters()
+        now = time.monotonic()
+        for sampler, lan_side in samplers:
+            rates = sampler.update(counters.get(sampler.interface), now)
+            if rates is not None:
+                SAMPLES.inc(sampler.interface)
+                insert_into_db(Traffic.from_rates(sampler.interface, rates, lan_side))
+        # Sleep to the next tick of a fixed schedule so sampling does not drift
+        deadline += interval
+        if deadline < time.monotonic():
+            SKIPPED_TICKS.inc(amount=int((time.monotonic() - deadline) // interval) + 1)
+            deadline = time.monotonic()
+        stop.wait(deadline - time.monotonic())
+
+
+def main():
+    metrics.serve(ph.traffic_metrics_port)
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stop.set())
+    try:
+        run(ph.traffic_sample_interval, stop)
+    finally:
+        traffic_buffer.close()
+
+
+if __name__ == '__main__':
+    main()